@@ -1,16 +1,36 @@
 #! /usr/bin/env python3
 """
-Tighten up an Ubuntu host box
+Tighten up an Ubuntu host box, or (with --performance) tune a Linux host for the federated node's IO heavy workload
 """
 import os
 import sys
 import re
+import json
+import time
 import logging
+import argparse
+import subprocess
 import socket
 import platform
 
 
 DIST_PATH = os.path.join(os.path.dirname(__file__), "dist")
+HOST_ROOT = "/"  # where the /sys, /proc, /etc and /run the performance profile reads and writes are
+DOCKER_ROOT = "/var/lib/docker"
+DOCKER_DAEMON_CONFIG = "/etc/docker/daemon.json"
+# preferred IO schedulers (multiqueue, then legacy names), for rotational disks and for SSD/NVMe
+IO_SCHEDULERS = {True: ['mq-deadline', 'bfq', 'deadline'], False: ['none', 'noop', 'mq-deadline', 'deadline']}
+# the databases mostly do small random reads, but HDDs still gain from a larger read-ahead (so theirs is only ever raised)
+READ_AHEAD_KB = {True: 1024, False: 128}
+DOCKER_DAEMON_OPTIONS = {
+    'log-driver': 'json-file',
+    'log-opts': {'max-size': '30m', 'max-file': '10'},
+    'default-ulimits': {'nofile': {'Name': 'nofile', 'Soft': 1048576, 'Hard': 1048576}},
+}
+SYSCTL_RAISE_ONLY = ['vm.max_map_count', 'fs.file-max', 'net.core.somaxconn']  # never lower these
+BENCH_FILE_SIZE = 256 * 1024 * 1024
+BENCH_FSYNCS = 200
+BENCH_RANDOM_READS = 2000
 
 
 def runcmd(command, abort_on_failure=True):
@@ -100,7 +120,243 @@ def do_security_setup():
     modify_config(r'guard email="root@localhost"', 'guard email="noreply@%s"' % socket.gethostname(), '/etc/iwatch/iwatch.xml')
     runcmd("service iwatch restart")
 
+
+def host_path(path):
+    return os.path.join(HOST_ROOT, path.lstrip("/"))
+
+
+def read_file(path, default=None):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return default
+
+
+def get_block_device(path=None, name=None):
+    """The whole disk (e.g. sda, nvme0n1) holding path (or partition name), and whether it's rotational"""
+    if path:
+        st = os.stat(path)
+        sys_path = os.path.realpath(host_path("/sys/dev/block/%d:%d" % (os.major(st.st_dev), os.minor(st.st_dev))))
+    else:
+        sys_path = os.path.realpath(os.path.join(host_path("/sys/class/block"), name))
+    if os.path.exists(os.path.join(sys_path, "partition")):
+        sys_path = os.path.dirname(sys_path)
+    slaves_path = os.path.join(sys_path, "slaves")
+    if os.path.isdir(slaves_path) and os.listdir(slaves_path):  # device mapper (LVM, crypt): tune the disk underneath
+        return get_block_device(name=os.listdir(slaves_path)[0])
+    if not os.path.exists(os.path.join(sys_path, "queue")):
+        return None, None
+    return os.path.basename(sys_path), read_file(os.path.join(sys_path, "queue", "rotational")) == "1"
+
+
+def disk_benchmark(directory):
+    """Sequential write (fsync'ed at the end), fsync latency of small writes, and uncached 4k random reads"""
+    path = os.path.join(directory, ".fednode-bench.%d" % os.getpid())
+    block = os.urandom(1024 * 1024)
+    results = {}
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o600)
+        start = time.time()
+        for _ in range(BENCH_FILE_SIZE // len(block)):
+            os.write(fd, block)
+        os.fsync(fd)
+        results['seq_write_mb_s'] = round(BENCH_FILE_SIZE / 1024.0 ** 2 / (time.time() - start), 1)
+
+        latencies = []
+        for _ in range(BENCH_FSYNCS):
+            start = time.time()
+            os.write(fd, block[:4096])
+            os.fsync(fd)
+            latencies.append(time.time() - start)
+        os.close(fd)
+        latencies.sort()
+        results['fsync_avg_ms'] = round(sum(latencies) / len(latencies) * 1000, 2)
+        results['fsync_p99_ms'] = round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 2)
+
+        fd = os.open(path, os.O_RDONLY)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)  # drop it from the page cache
+        pages = BENCH_FILE_SIZE // 4096
+        offsets = [(i * 7919) % pages * 4096 for i in range(BENCH_RANDOM_READS)]
+        start = time.time()
+        for offset in offsets:
+            os.pread(fd, 4096, offset)
+        results['random_read_iops'] = int(BENCH_RANDOM_READS / (time.time() - start))
+        os.close(fd)
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+    return results
+
+
+def plan_performance_setup(docker_root):
+    """The changes to make, as a list of (description, function to apply it)"""
+    plan = []
+
+    # IO scheduler and read-ahead of the disk holding the docker volumes, now and (through udev) at boot
+    device, rotational = get_block_device(docker_root if os.path.exists(docker_root) else "/")
+    if device:
+        queue_path = os.path.join(host_path("/sys/block"), device, "queue")
+        available = re.findall(r'[\w-]+', read_file(os.path.join(queue_path, "scheduler"), ""))
+        current = (re.findall(r'\[([\w-]+)\]', read_file(os.path.join(queue_path, "scheduler"), "")) or [None])[0]
+        scheduler = next((s for s in IO_SCHEDULERS[rotational] if s in available), None)
+        current_read_ahead = read_file(os.path.join(queue_path, "read_ahead_kb"))
+        read_ahead = READ_AHEAD_KB[rotational]
+        if rotational and current_read_ahead and current_read_ahead.isdigit():
+            read_ahead = max(read_ahead, int(current_read_ahead))
+        udev_rule = 'ACTION=="add|change", KERNEL=="%s", ATTR{queue/read_ahead_kb}="%d"' % (device, read_ahead)
+        if scheduler:
+            udev_rule += ', ATTR{queue/scheduler}="%s"' % scheduler
+        if scheduler and scheduler != current:
+            plan.append(("set the IO scheduler of %s (%s) from %s to %s" % (device, "HDD" if rotational else "SSD", current, scheduler),
+                lambda: write_file(os.path.join(queue_path, "scheduler"), scheduler)))
+        if current_read_ahead != str(read_ahead):
+            plan.append(("set the read-ahead of %s from %s to %d KB" % (device, current_read_ahead, read_ahead),
+                lambda: write_file(os.path.join(queue_path, "read_ahead_kb"), str(read_ahead))))
+        udev_rule_path = host_path("/etc/udev/rules.d/60-fednode-io.rules")
+        if read_file(udev_rule_path) != udev_rule:
+            plan.append(("persist them in %s: %s" % (udev_rule_path, udev_rule), lambda: write_file(udev_rule_path, udev_rule + "\n")))
+    else:
+        logging.warning("Couldn't find the disk holding %s, so its IO scheduler and read-ahead are left alone" % docker_root)
+
+    # vm.dirty_*, swappiness etc.
+    with open(os.path.join(DIST_PATH, "sysctl_performance.conf")) as f:
+        sysctls = re.findall(r'^([\w.]+)\s*=\s*(\S+)', f.read(), re.MULTILINE)
+    sysctl_path = lambda key: host_path("/proc/sys/" + key.replace('.', '/'))
+    sysctls = [(key, value) for key, value in sysctls if not (key in SYSCTL_RAISE_ONLY and
+        int(read_file(sysctl_path(key), "0")) >= int(value))]
+    changes = ["%s %s -> %s" % (key, read_file(sysctl_path(key)), value) for key, value in sysctls if read_file(sysctl_path(key)) != value]
+    if changes:
+        sysctl_conf = "".join("%s = %s\n" % (key, value) for key, value in sysctls)
+        sysctl_conf_path = host_path("/etc/sysctl.d/61-fednode-performance.conf")
+        plan.append(("set sysctls (in %s): %s" % (sysctl_conf_path, ", ".join(changes)), lambda: (
+            write_file(sysctl_conf_path, sysctl_conf),
+            runcmd("sysctl -p %s > /dev/null" % sysctl_conf_path))))
+
+    # transparent hugepages (redis and mongodb want them off)
+    thp_path = host_path("/sys/kernel/mm/transparent_hugepage")
+    thp = read_file(os.path.join(thp_path, "enabled"), "")
+    if thp and "[never]" not in thp:
+        plan.append(("disable transparent hugepages (currently: %s), now and at boot" % thp, lambda: (
+            write_file(os.path.join(thp_path, "enabled"), "never"),
+            write_file(os.path.join(thp_path, "defrag"), "never"),
+            os.path.isdir(host_path("/run/systemd/system")) and (  # booted with systemd
+                runcmd("install -m 0644 -o root -g root -D %s/disable-thp.service %s" % (
+                    DIST_PATH, host_path("/etc/systemd/system/disable-thp.service"))),
+                runcmd("systemctl daemon-reload && systemctl enable disable-thp.service")))))
+
+    # open files and processes
+    limits_path = host_path("/etc/security/limits.d/90-fednode.conf")
+    with open(os.path.join(DIST_PATH, "limits_performance.conf")) as f:
+        limits_conf = f.read()
+    if read_file(limits_path) != limits_conf.strip():
+        plan.append(("raise the nofile/nproc limits (in %s)" % limits_path, lambda: write_file(limits_path, limits_conf)))
+
+    # docker daemon log and storage options, added to (never replacing) what's already configured
+    daemon_config_path = host_path(DOCKER_DAEMON_CONFIG)
+    try:
+        with open(daemon_config_path) as f:
+            daemon_config = json.load(f)
+    except (IOError, OSError) as e:
+        daemon_config = {} if not os.path.exists(daemon_config_path) else None
+        if daemon_config is None:
+            logging.warning("Can't read %s (%s), so the docker daemon options are left alone" % (daemon_config_path, e))
+    except ValueError as e:
+        daemon_config = None
+        logging.warning("%s isn't valid JSON (%s), so the docker daemon options are left alone" % (daemon_config_path, e))
+    if daemon_config is not None:
+        wanted = dict(DOCKER_DAEMON_OPTIONS)
+        storage_driver = get_docker_storage_driver()
+        if storage_driver == "overlay2":
+            wanted['storage-driver'] = "overlay2"  # pin it (switching from another driver would hide the existing images and volumes)
+        elif storage_driver:
+            logging.warning("Docker uses the %s storage driver: overlay2 performs better, but switching needs the images rebuilt" % storage_driver)
+        if daemon_config.get('log-driver', 'json-file') != 'json-file':
+            del wanted['log-opts']  # they are json-file's options, which another driver would refuse
+        new_daemon_config, added, conflicts = merge_config(daemon_config, wanted)
+        for key, current, value in conflicts:
+            logging.warning("Keeping %s = %s in %s (we'd set %s)" % (key, json.dumps(current), daemon_config_path, json.dumps(value)))
+        if added:
+            plan.append(("add the docker daemon options %s to %s (applied on the next docker restart)" % (
+                ", ".join("%s = %s" % (key, json.dumps(value)) for key, value in added), daemon_config_path),
+                lambda: write_file(daemon_config_path, json.dumps(new_daemon_config, indent=2, sort_keys=True) + "\n")))
+    return plan
+
+
+def get_docker_storage_driver():
+    try:
+        return subprocess.check_output(["docker", "info", "--format", "{{.Driver}}"], stderr=subprocess.DEVNULL).decode().strip() or None
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def merge_config(current, wanted, prefix=""):
+    """Merge of wanted into current (two levels deep), only adding what's missing: returns the merged config, the
+    (key, value)s added and the (key, current value, wanted value)s left as they were"""
+    merged, added, conflicts = dict(current), [], []
+    for key, value in sorted(wanted.items()):
+        path = prefix + key
+        if key not in current:
+            merged[key] = value
+            added.append((path, value))
+        elif isinstance(current[key], dict) and isinstance(value, dict) and not prefix:
+            # one level down only: e.g. a missing log option is added, but an existing ulimit is kept whole
+            merged[key], sub_added, sub_conflicts = merge_config(current[key], value, path + ".")
+            added += sub_added
+            conflicts += sub_conflicts
+        elif current[key] != value:
+            conflicts.append((path, current[key], value))
+    return merged, added, conflicts
+
+
+def write_file(path, content):
+    if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def do_performance_setup(docker_root=DOCKER_ROOT, dry_run=False, bench=True):
+    """Tune the IO scheduler, VM, limits and docker daemon for the IO heavy services, benchmarking the disk before and after"""
+    plan = plan_performance_setup(docker_root)
+    bench_dir = docker_root if os.path.isdir(docker_root) else "/var/tmp"
+    if dry_run:
+        logging.info("Planned changes (dry run, nothing changed):")
+        for description, _ in plan:
+            logging.info("  - %s" % description)
+        return
+
+    before = disk_benchmark(bench_dir) if bench else None
+    for description, apply in plan:
+        logging.info("Going to %s" % description)
+        apply()
+    if bench:
+        after = disk_benchmark(bench_dir)
+        logging.info("Disk benchmark in %s (before -> after):" % bench_dir)
+        for key in sorted(before):
+            logging.info("  %-18s %10s -> %s" % (key, before[key], after[key]))
+    logging.info("Done. Log out and back in for the new limits, and restart docker (%s) for its new options" % DOCKER_DAEMON_CONFIG)
+
+
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--performance", action="store_true", help="tune the host for performance instead (any Linux)")
+    parser.add_argument("--dry-run", action="store_true", help="with --performance, only print the changes it would make")
+    parser.add_argument("--docker-root", default=DOCKER_ROOT, help="docker's data directory, whose disk to tune")
+    parser.add_argument("--no-bench", action="store_true", help="with --performance, skip the disk benchmark before and after")
+    args = parser.parse_args()
+
+    if args.performance:
+        if not sys.platform.startswith("linux"):
+            logging.error("Script requires linux")
+            sys.exit(1)
+        if not args.dry_run and os.geteuid() != 0:
+            logging.error("Script requires root (or use --dry-run)")
+            sys.exit(1)
+        do_performance_setup(args.docker_root, dry_run=args.dry_run, bench=not args.no_bench)
+        sys.exit(0)
+
     if platform.dist()[0] != "Ubuntu":
         logging.error("Script requires Ubuntu linux")
         sys.exit(1)
@@ -11,12 +11,41 @@ import copy
 import subprocess
 import configparser
 import socket
+import asyncio
 import glob
 import shutil
+import threading
 import json
 import difflib
+import hashlib
+import heapq
+import mmap
+import collections
+import bisect
+import sqlite3
+import struct
+import zlib
+import http.client
+import urllib.parse
+import urllib.request
+import urllib.error
+import base64
+import random
+import http.server
+import time
+import tempfile
+import concurrent.futures
 from datetime import datetime, timezone
 
+try:
+    import yaml
+except ImportError:
+    yaml = None  # fall back to our own parser for the (simple) subset of YAML used by the compose files
+try:
+    import zmq
+except ImportError:
+    zmq = None  # only needed by trace-blocks
+
 
 VERSION="2.3.0"
 
@@ -31,19 +60,141 @@ REPO_BASE_SSH = "git@github.com:CounterpartyXCP/{}.git"
 REPOS_BASE = ['counterparty-lib', 'counterparty-cli', 'addrindexrs', 'xcp-proxy', 'http-addrindexrs']
 REPOS_COUNTERBLOCK = REPOS_BASE + ['counterblock']
 REPOS_FULL = REPOS_COUNTERBLOCK + ['counterwallet', 'armory-utxsvr', 'xcp-proxy']
+GIT_CHECKOUT_JOBS = 4
 
-HOST_PORTS_USED = {
-    'base': [8332, 18332, 8432, 18432, 4000, 14000, 8097, 18097, 8098, 18098, 9000, 9001, 19000, 19001],
-    'base_extbtc': [8432, 18432, 4000, 14000, 8097, 18097, 8098, 18098, 9000, 9001, 19000, 19001],
-    'counterblock': [8332, 18332, 8432, 18432, 4000, 14000, 8097, 18097, 8098, 18098, 4100, 14100, 27017, 9000, 9001, 19000, 19001],
-    'full': [8332, 18332, 8432, 18432, 4000, 14000, 8097, 18097, 8098, 18098, 4100, 14100, 27017, 80, 443, 9000, 9001, 19000, 19001]
+COMPOSE_CACHE_PATH = os.path.join(SCRIPTDIR, ".fednode.compose-cache.json")
+COMPOSE_CACHE_VERSION = 1
+# service keys that compose merges (rather than overrides) when a service extends another one
+COMPOSE_CONCAT_KEYS = ('ports', 'expose', 'external_links', 'dns', 'dns_search', 'tmpfs')
+COMPOSE_DICT_KEYS = ('environment', 'labels')
+# ...and the ones that are never inherited
+COMPOSE_UNSHARED_KEYS = ('links', 'volumes_from', 'depends_on')
+DOCKER_SOCKET_PATH = "/var/run/docker.sock"
+DOCKER_API_TIMEOUT = 60
+PREFLIGHT_TIMEOUT = 2.0
+# services whose health/sync state 'status' probes: service, probe type, host port, config file (under config/) holding the RPC credentials
+STATUS_SERVICES = [
+    ('bitcoin', 'bitcoind', 8332, ('bitcoin', 'bitcoin.conf')),
+    ('bitcoin-testnet', 'bitcoind', 18332, ('bitcoin', 'bitcoin.testnet.conf')),
+    ('addrindexrs', 'addrindexrs', 8432, None),
+    ('addrindexrs-testnet', 'addrindexrs', 18432, None),
+    ('counterparty', 'counterparty', 4000, ('counterparty', 'server.conf')),
+    ('counterparty-testnet', 'counterparty', 14000, ('counterparty', 'server.testnet.conf')),
+    ('counterblock', 'counterblock', 4100, ('counterblock', 'server.conf')),
+    ('counterblock-testnet', 'counterblock', 14100, ('counterblock', 'server.testnet.conf')),
+    ('xcp-proxy', 'http', 8097, None),
+    ('xcp-proxy-testnet', 'http', 18097, None),
+]
+STATUS_TIMEOUT = 5.0
+# read calls 'bench' can replay: name -> (backend, method or path, params)
+BENCH_CALLS = {
+    'counterparty.get_running_info': ('counterparty', 'get_running_info', {}),
+    'counterparty.get_balances': ('counterparty', 'get_balances', {'filters': [{'field': 'address', 'op': '==', 'value': '{address}'}]}),
+    'counterparty.get_unspent_txouts': ('counterparty', 'get_unspent_txouts', {'address': '{address}'}),
+    'http-addrindexrs.utxos': ('http-addrindexrs', '/a/{address}/utxos', None),
+    'bitcoind.getblockcount': ('bitcoind', 'getblockcount', []),
+    'bitcoind.getblockchaininfo': ('bitcoind', 'getblockchaininfo', []),
+}
+BENCH_DEFAULT_MIX = "counterparty.get_running_info=2,counterparty.get_balances=3,counterparty.get_unspent_txouts=2,http-addrindexrs.utxos=2,bitcoind.getblockcount=1"
+# backend -> (mainnet host port, testnet host port, config file holding the RPC credentials, user key, password key)
+BENCH_BACKENDS = {
+    'counterparty': (4000, 14000, ('counterparty', 'server{}.conf'), 'rpc-user', 'rpc-password'),
+    'http-addrindexrs': (9000, 19000, None, None, None),
+    'bitcoind': (8332, 18332, ('bitcoin', 'bitcoin{}.conf'), 'rpcuser', 'rpcpassword'),
+}
+BENCH_ADDRESS = "1CounterpartyXXXXXXXXXXXXXXXUWLpVr"
+BENCH_ADDRESS_TESTNET = "mvCounterpartyXXXXXXXXXXXXXXW24Hef"
+EXPORTER_PORT = 9615
+EXPORTER_INTERVAL = 15.0  # seconds between collections; scrapes are served from the last one
+EXPORTER_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# the block notifications bitcoind publishes (see zmqpubhashblock in config/bitcoin/), and the services downstream of it
+TRACE_ZMQ_URLS = {'mainnet': "tcp://127.0.0.1:28832", 'testnet': "tcp://127.0.0.1:38832"}
+TRACE_STAGES = ['addrindexrs', 'counterparty', 'counterblock']  # in pipeline order (the services with a block height to probe)
+TRACE_POLL_INTERVAL = 0.25
+TRACE_TIMEOUT = 600  # seconds a block may take to get through the pipeline, before giving up on it
+TRACE_WINDOW = 100  # blocks the rolling histograms are kept over
+TRACE_BUCKETS = (0.5, 1, 2, 5, 10, 30, 60, 120, 300)
+LOG_LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']
+LOG_LEVEL_RE = re.compile(r'\b(DEBUG|INFO|WARN|WARNING|ERROR|CRITICAL)\b')
+LOG_FOLLOW_INTERVAL = 0.5
+LOG_INDEX_DIR = os.path.join(SCRIPTDIR, ".fednode.logindex")
+LOG_INDEX_VERSION = 1
+LOG_INDEX_INTERVAL = 1024 * 1024  # bytes of log between index points
+REBUILD_JOBS = 3
+REBUILD_CACHE_PATH = os.path.join(SCRIPTDIR, ".fednode.build-cache")
+REBUILD_BUILDER = "fednode"  # buildx builder (docker-container driver, as the docker driver can't export a cache)
+TUNE_COMPOSE_FILE = "docker-compose.tune.yml"
+# relative (memory, cpu) weights of the services when splitting the host's resources between them
+TUNE_SERVICE_WEIGHTS = {
+    'bitcoin': (6, 4), 'bitcoin-testnet': (2, 1),
+    'addrindexrs': (4, 3), 'addrindexrs-testnet': (1, 1),
+    'counterparty': (3, 2), 'counterparty-testnet': (1, 1),
+    'counterblock': (2, 1), 'counterblock-testnet': (1, 1),
+    'mongodb': (2, 1), 'redis': (1, 1),
+    'xcp-proxy': (1, 1), 'xcp-proxy-testnet': (0.5, 0.5),
+    'http-addrindexrs': (0.5, 0.5), 'http-addrindexrs-testnet': (0.5, 0.5),
+    'armory-utxsvr': (1, 1), 'armory-utxsvr-testnet': (0.5, 0.5),
+    'counterwallet': (0.5, 0.5),
 }
-VOLUMES_USED = {
-    'base': ['bitcoin-data', 'addrindexrs-data', 'counterparty-data'],
-    'base_extbtc': ['addrindexrs-data', 'counterparty-data'],
-    'counterblock': ['bitcoin-data', 'addrindexrs-data', 'counterparty-data', 'counterblock-data', 'mongodb-data'],
-    'full': ['bitcoin-data', 'addrindexrs-data', 'counterparty-data', 'counterblock-data', 'mongodb-data', 'armory-data']
+TUNE_HOST_RESERVED_MEMORY = 1024 ** 3  # at least this much (or 10%) of the RAM is left to the host
+TUNE_MIN_MEMORY = 256  # MB each service gets before the rest is split by weight (less if even that doesn't fit)
+TUNE_BITCOIN_OVERHEAD = 128  # MB of a bitcoind's limit kept for everything besides the UTXO cache and the mempool
+TUNE_BITCOIN_MAX_MEMPOOL = 300  # MB (bitcoind's default)
+BOOTSTRAP_URLS = {
+    'counterparty': "https://bootstrap.counterparty.io/counterparty.latest.tar.gz",
+    'counterparty-testnet': "https://bootstrap.counterparty.io/counterparty-testnet.latest.tar.gz",
 }
+BOOTSTRAP_VOLUME = 'counterparty-data'
+BOOTSTRAP_JOBS = 4
+BOOTSTRAP_CHUNK_SIZE = 16  # MB
+BOOTSTRAP_RETRIES = 5
+BOOTSTRAP_STAGING_DIR = ".fednode-bootstrap"
+COUNTERPARTY_DB_FILES = {
+    'counterparty': 'counterparty.db',
+    'counterparty-testnet': 'counterparty.testnet.db',
+}
+SNAPSHOT_CHOICES = ['counterparty', 'counterparty-testnet']
+REPLICAS_COMPOSE_FILE = "docker-compose.replicas.yml"
+REPLICA_CHOICES = ['counterparty', 'counterparty-testnet']
+REPLICA_MAX = 8
+REPLICA_NAME_RE = re.compile(r'^(counterparty(?:-testnet)?)-replica(\d+)$')
+# per network: (BTC_NETWORK, config file, RPC port, balancer host port, host port of the first replica)
+REPLICA_NETWORKS = {
+    'counterparty': ('mainnet', 'server.conf', 4000, 4001, 4002),
+    'counterparty-testnet': ('testnet', 'server.testnet.conf', 14000, 14001, 14002),
+}
+BALANCER_CHECK_INTERVAL = 2.0
+BALANCER_MAX_LAG = 1  # blocks a backend may be behind the most advanced one, and still get requests
+# backends reached over the compose network without a link, that the startup stages should still wait for
+STARTUP_DEPENDENCIES = {'addrindexrs': ['bitcoin'], 'addrindexrs-testnet': ['bitcoin-testnet']}
+CACHE_PORTS = {'counterparty': 4090, 'counterparty-testnet': 14090}
+CACHE_MAX_MEMORY = 256  # MB, for the in-memory backend
+CACHE_REDIS_DBS = {'counterparty': 10, 'counterparty-testnet': 11}  # in the stack's redis (xcp-proxy uses 8 and 9)
+CACHE_REDIS_TTL = 3600  # entries need a TTL to be evicted by redis' volatile-lru policy (see config/redis/redis.conf)
+CACHE_HEIGHT_POLL_INTERVAL = 5.0  # seconds between checks of counterparty-server's block height (besides the ZMQ feed)
+# read methods whose answer depends on more than the last parsed block (the mempool, or bitcoind/addrindexrs)
+CACHE_UNCACHEABLE_METHODS = ['get_mempool', 'get_unspent_txouts', 'get_tx_info', 'get_raw_transactions', 'search_raw_transactions',
+    'get_tx_info_legacy', 'get_dispensers_info']
+STARTUP_STAGE_TIMEOUT = 900  # seconds to wait for the services of a stage to be ready, before moving on anyway
+STARTUP_POLL_INTERVAL = 5
+STARTUP_MAX_LAG = 6  # blocks behind the tip still counted as synced
+STARTUP_CATCHUP_WEIGHTS = (2048, 1000)  # cpu shares and block IO weight of the services while they catch up
+STARTUP_DEFAULT_WEIGHTS = (1024, 0)  # ...and after (0: docker's default block IO weight)
+SNAPSHOT_STORE_PATH = os.path.join(SCRIPTDIR, "snapshots")
+SNAPSHOT_CHUNK_PAGES = 64  # db pages per content-addressed chunk
+SNAPSHOT_BACKUP_STEP_PAGES = 4096  # pages copied per online backup step, between which the server may write
+PROGRESS_BLOCK_RE = re.compile(r'\bblock(?:_index)?[:=]?\s*#?(\d{3,})\b', re.IGNORECASE)
+PROGRESS_RATE_WINDOW = 10  # seconds over which the current blocks/sec is measured
+PROGRESS_AVERAGE_WINDOW = 300  # ...and the moving average
+PROGRESS_SAMPLE_INTERVAL = 5  # seconds between samples of the container memory and the bitcoind tip
+PROFILES_PATH = os.path.join(SCRIPTDIR, "profiles")
+VALIDATE_STATE_PATH = os.path.join(SCRIPTDIR, ".fednode.validate.json")
+VALIDATE_CHECKPOINT_INTERVAL = 1000  # blocks between recorded consensus hash checkpoints
+VALIDATE_CONFIRMATIONS = 10  # blocks below the tip left out, as a reorg could still roll them back
+VALIDATE_RANGE_BLOCKS = 5000  # max blocks checked per worker task
+VACUUM_INCREMENTAL_STEP = 256  # free pages reclaimed per transaction, between which the server may write
+VACUUM_INCREMENTAL_PAUSE = 0.05
+VACUUM_ANALYSIS_LIMIT = 1000  # rows sampled per index by ANALYZE in incremental mode
 UPDATE_CHOICES = ['addrindexrs', 'addrindexrs-testnet',
                   'counterparty', 'counterparty-testnet', 'counterblock',
                   'counterblock-testnet', 'counterwallet', 'armory-utxsvr',
@@ -53,7 +204,12 @@ REPARSE_CHOICES = ['counterparty', 'counterparty-testnet', 'counterblock', 'coun
 ROLLBACK_CHOICES = ['counterparty', 'counterparty-testnet']
 VALIDATE_CHOICES = ['counterparty', 'counterparty-testnet']
 VACUUM_CHOICES = ['counterparty', 'counterparty-testnet']
-SHELL_CHOICES = UPDATE_CHOICES + ['mongodb', 'redis', 'bitcoin', 'bitcoin-testnet', 'addrindexrs', 'addrindexrs-testnet']
+
+DU_HISTORY_PATH = os.path.join(SCRIPTDIR, ".fednode.du.json")
+DU_HISTORY_MAX = 200  # scans kept for the growth rate
+DU_GROWTH_WINDOW = 7 * 86400  # seconds of history the growth rate is measured over
+DU_GROWTH_MIN_SPAN = 3600  # the history must span at least this long for a growth rate
+DU_JOBS = 16  # directory scans in flight (mostly waiting on the disk, so more than the CPUs)
 
 CONFIGCHECK_FILES_BASE_EXTERNAL_BITCOIN = [
     ['addrindexrs', 'addrindexrs.env.default', 'addrindexrs.env'],
@@ -90,6 +246,8 @@ SESSION_USER = None
 SUDO_CMD = None
 # set in main()
 DOCKER_CONFIG_PATH = None
+# set in get_docker_client()
+DOCKER_CLIENT = None
 
 
 def parse_args():
@@ -108,19 +266,51 @@ def parse_args():
     parser_install.add_argument("--mongodb-interface", default="127.0.0.1",
         help="Bind mongo to this host interface. Localhost by default, enter 0.0.0.0 for all host interfaces.")
     parser_install.add_argument("--no-bootstrap", action="store_true", help="It doesn't download any bootstrap, so the parse will begin from scratch")
-    
+    parser_install.add_argument("--jobs", type=int, default=GIT_CHECKOUT_JOBS, help="Number of source checkouts to run concurrently")
+    parser_install.add_argument("--shallow", action="store_true", help="Make shallow, single-branch source checkouts (no git history)")
+    parser_install.add_argument("--git-cache-dir", default=None,
+        help="Keep bare mirrors of the source repos in this directory and use them as a clone reference, so later installs only fetch new objects")
+    parser_install.add_argument("--counterparty-replicas", type=int, default=0, choices=range(0, REPLICA_MAX + 1), metavar="N",
+        help="Number of read replicas of each counterparty-server to run (to put behind the 'balancer')")
 
     parser_uninstall = subparsers.add_parser('uninstall', help="uninstall fednode services")
 
     parser_start = subparsers.add_parser('start', help="start fednode services")
     parser_start.add_argument("services", nargs='*', default='', help="The service or services to start (or blank for all services)")
 
+    for parser_staged in (parser_install, parser_start):
+        parser_staged.add_argument("--staged", action="store_true",
+            help="Start the services in stages along their links, each once the backends it links to are answering and synced")
+        parser_staged.add_argument("--stage-timeout", type=int, default=STARTUP_STAGE_TIMEOUT,
+            help="Seconds to wait for the services of a stage to be ready, before starting the next one anyway")
+
     parser_stop = subparsers.add_parser('stop', help="stop fednode services")
     parser_stop.add_argument("services", nargs='*', default='', help="The service or services to stop (or blank for all services)")
 
     parser_restart = subparsers.add_parser('restart', help="restart fednode services")
     parser_restart.add_argument("services", nargs='*', default='', help="The service or services to restart (or blank for all services)")
 
+    parser_replicas = subparsers.add_parser('replicas', help="set the number of read replicas of a counterparty-server")
+    parser_replicas.add_argument("service", choices=REPLICA_CHOICES, help="The counterparty-server service to replicate")
+    parser_replicas.add_argument("count", type=int, choices=range(0, REPLICA_MAX + 1), metavar="COUNT", help="Number of replicas (0 to remove them)")
+    parser_replicas.add_argument("--no-seed", action="store_true",
+        help="Let new replicas parse the blockchain from scratch, rather than copying the database of the primary")
+
+    parser_balancer = subparsers.add_parser('balancer', help="serve the API of a counterparty-server and its replicas, balanced by health and lag")
+    parser_balancer.add_argument("service", choices=REPLICA_CHOICES, help="The counterparty-server service whose replica group to balance")
+    parser_balancer.add_argument("--listen", default="127.0.0.1", help="Interface to listen on (0.0.0.0 for all)")
+    parser_balancer.add_argument("--port", type=int, default=None, help="Port to listen on (default: 4001 for mainnet, 14001 for testnet)")
+
+    parser_cache = subparsers.add_parser('cache', help="serve the API of a counterparty-server through a response cache, invalidated on each new block")
+    parser_cache.add_argument("service", choices=REPLICA_CHOICES, help="The counterparty-server service to cache the responses of")
+    parser_cache.add_argument("--listen", default="127.0.0.1", help="Interface to listen on (0.0.0.0 for all)")
+    parser_cache.add_argument("--port", type=int, default=None, help="Port to listen on (default: 4090 for mainnet, 14090 for testnet)")
+    parser_cache.add_argument("--upstream-port", type=int, default=None,
+        help="Port of the API to cache (default: the counterparty-server's own; use the balancer's to cache in front of the replicas)")
+    parser_cache.add_argument("--backend", choices=['memory', 'redis'], default='memory', help="Where to keep the cached responses")
+    parser_cache.add_argument("--max-memory", type=int, default=CACHE_MAX_MEMORY, help="Memory cap of the in-memory backend, in MB")
+    parser_cache.add_argument("--redis-url", default=None, help="redis://host:port/db to use (default: the stack's redis container)")
+
     parser_reparse = subparsers.add_parser('reparse', help="reparse a counterparty-server or counterblock service")
     parser_reparse.add_argument("service", choices=REPARSE_CHOICES, help="The name of the service for which to kick off a reparse")
 
@@ -130,12 +320,79 @@ def parse_args():
 
     parser_validate = subparsers.add_parser('validate', help="makes a database integrity check in counterparty-server")
     parser_validate.add_argument("service", choices=VALIDATE_CHOICES, help="The name of the service to make the integrity check")
+    parser_validate.add_argument("--incremental", action="store_true",
+        help="Only check the blocks added since the last incremental run (and its recorded checkpoints), while the service keeps running")
+    parser_validate.add_argument("--jobs", type=int, default=None, help="Number of worker processes for --incremental (default: one per CPU)")
+    parser_validate.add_argument("--reset", action="store_true", help="Forget the recorded checkpoints and check all the blocks again")
+
+    for parser_progress in (parser_reparse, parser_rollback, parser_validate):
+        parser_progress.add_argument("--no-progress", action="store_true", help="Just show the raw container output")
+        parser_progress.add_argument("--profile", default=None,
+            help="Where to write the JSON timing profile of the run (default: under federatednode/profiles/)")
 
     parser_vacuum = subparsers.add_parser('vacuum', help="vacuum the counterparty-server database for better runtime performance")
     parser_vacuum.add_argument("service", choices=VACUUM_CHOICES, help="The name of the service whose database to vacuum")
+    parser_vacuum_mode = parser_vacuum.add_mutually_exclusive_group()
+    parser_vacuum_mode.add_argument("--analyze", action="store_true",
+        help="Only report the free pages, fragmentation and estimated savings, reading the database while the service keeps running")
+    parser_vacuum_mode.add_argument("--incremental", action="store_true",
+        help="Reclaim free pages in small steps (and refresh the query planner statistics) while the service keeps running")
+    parser_vacuum_mode.add_argument("--enable-incremental", action="store_true",
+        help="Switch the database to incremental auto-vacuum, which needs one full (offline) vacuum")
+    parser_vacuum.add_argument("--budget", type=int, default=None, help="Maximum number of pages to reclaim with --incremental")
+
+    parser_bootstrap = subparsers.add_parser('bootstrap', help="download and install a counterparty-server database bootstrap")
+    parser_bootstrap.add_argument("service", choices=sorted(BOOTSTRAP_URLS.keys()), help="The name of the service to bootstrap")
+    parser_bootstrap.add_argument("--url", default=None, help="URL of the bootstrap archive (.tar, .tar.gz, .tar.bz2 or .tar.xz)")
+    parser_bootstrap.add_argument("--checksum", default=None, help="Expected MD5, SHA1 or SHA256 hex digest of the archive")
+    parser_bootstrap.add_argument("--checksum-url", default=None, help="URL of a file holding the expected digest of the archive")
+    parser_bootstrap.add_argument("--jobs", type=int, default=BOOTSTRAP_JOBS, help="Number of ranges to download concurrently")
+    parser_bootstrap.add_argument("--chunk-size", type=int, default=BOOTSTRAP_CHUNK_SIZE, help="Size in MB of each range request")
+    parser_bootstrap.add_argument("--force", action="store_true", help="Replace an existing database")
+
+    parser_snapshot = subparsers.add_parser('snapshot', help="create, list or restore counterparty-server database snapshots")
+    parser_snapshot.add_argument("action", choices=['create', 'list', 'restore'], help="What to do")
+    parser_snapshot.add_argument("service", choices=SNAPSHOT_CHOICES, help="The name of the service whose database to snapshot")
+    parser_snapshot.add_argument("snapshot_id", nargs='?', default=None, help="The snapshot to restore (default: the latest)")
+    parser_snapshot.add_argument("--store", default=SNAPSHOT_STORE_PATH, help="Directory holding the snapshots")
 
     parser_ps = subparsers.add_parser('ps', help="list installed services")
 
+    parser_du = subparsers.add_parser('du', help="show the disk usage and growth of the fednode volumes and logs")
+    parser_du.add_argument("--jobs", type=int, default=DU_JOBS, help="Number of directories to scan concurrently")
+    parser_du.add_argument("--json", action="store_true", help="Output the disk usage as JSON")
+    parser_du.add_argument("--no-history", action="store_true", help="Don't record this scan in the history the growth rate is computed from")
+
+    parser_status = subparsers.add_parser('status', help="show the health and sync state of the fednode services")
+    parser_status.add_argument("services", nargs='*', default='', help="The service or services to check (or blank for all services)")
+    parser_status.add_argument("--json", action="store_true", help="Output the status as JSON")
+    parser_status.add_argument("--watch", type=float, metavar="SECONDS", default=None, help="Keep refreshing the status every SECONDS")
+    parser_status.add_argument("--timeout", type=float, default=STATUS_TIMEOUT, help="Seconds to wait for each service to answer")
+
+    parser_exporter = subparsers.add_parser('exporter', help="serve Prometheus metrics of the fednode services and containers")
+    parser_exporter.add_argument("--listen", default="127.0.0.1", help="Interface to serve /metrics on (0.0.0.0 for all)")
+    parser_exporter.add_argument("--port", type=int, default=EXPORTER_PORT, help="Port to serve /metrics on")
+    parser_exporter.add_argument("--interval", type=float, default=EXPORTER_INTERVAL, help="Seconds between collections")
+    parser_exporter.add_argument("--timeout", type=float, default=STATUS_TIMEOUT, help="Seconds to wait for each service to answer")
+
+    parser_trace = subparsers.add_parser('trace-blocks', help="time how long each new block takes to get through the indexing pipeline")
+    parser_trace.add_argument("--network", choices=['mainnet', 'testnet'], default='mainnet', help="The network whose pipeline to trace")
+    parser_trace.add_argument("--count", type=int, default=None, help="Stop after this many blocks (default: run until interrupted)")
+    parser_trace.add_argument("--zmq-url", default=None, help="bitcoind's block notification endpoint (default: the one from config/bitcoin/)")
+    parser_trace.add_argument("--timeout", type=float, default=TRACE_TIMEOUT, help="Seconds to wait for a block to get through the pipeline")
+
+    parser_bench = subparsers.add_parser('bench', help="load-test the service APIs and report latency percentiles and throughput")
+    parser_bench.add_argument("--mix", default=BENCH_DEFAULT_MIX,
+        help="Comma separated call=weight list to replay, from: {}".format(', '.join(sorted(BENCH_CALLS))))
+    parser_bench.add_argument("-c", "--concurrency", default="1,4,16", help="Comma separated concurrency levels to run at")
+    parser_bench.add_argument("-r", "--requests", type=int, default=200, help="Number of requests to make at each concurrency level")
+    parser_bench.add_argument("--address", default=None, help="Address to use for the address based calls")
+    parser_bench.add_argument("--testnet", action="store_true", help="Benchmark the testnet services")
+    parser_bench.add_argument("--timeout", type=float, default=30.0, help="Seconds to wait for each request")
+    parser_bench.add_argument("-o", "--output", default=None, help="Save the results as JSON to this file")
+    parser_bench.add_argument("--compare", default=None, help="Compare the results against a previously saved JSON results file")
+    parser_bench.add_argument("--stub", action="store_true", help="Run against a bundled local stub backend (to test the harness itself)")
+
     parser_tail = subparsers.add_parser('tail', help="tail fednode logs")
     parser_tail.add_argument("services", nargs='*', default='', help="The name of the service or services whose logs to tail (or blank for all services)")
     parser_tail.add_argument("-n", "--num-lines", type=int, default=50, help="Number of lines to tail")
@@ -143,26 +400,52 @@ def parse_args():
     parser_logs = subparsers.add_parser('logs', help="tail fednode logs")
     parser_logs.add_argument("services", nargs='*', default='', help="The name of the service or services whose logs to view (or blank for all services)")
 
+    for parser_log in (parser_tail, parser_logs):
+        parser_log.add_argument("-g", "--grep", default=None, help="Only show lines matching this regular expression")
+        parser_log.add_argument("-l", "--level", choices=LOG_LEVELS, default=None, help="Only show lines logged at this level or above")
+        parser_log.add_argument("--since", default=None, help="Only show lines since this time (ISO 8601, or relative like 30m, 2h, 1d)")
+        parser_log.add_argument("--until", default=None, help="Only show lines until this time (ISO 8601, or relative like 30m, 2h, 1d)")
+        parser_log.add_argument("-t", "--timestamps", action="store_true", help="Show the timestamp of each line")
+
     parser_exec = subparsers.add_parser('exec', help="execute a command on a specific container")
-    parser_exec.add_argument("service", choices=SHELL_CHOICES, help="The name of the service to execute the command on")
+    parser_exec.add_argument("service", help="The name of the service to execute the command on")
     parser_exec.add_argument("cmd", nargs=argparse.REMAINDER, help="The shell command to execute")
 
     parser_shell = subparsers.add_parser('shell', help="get a shell on a specific service container")
-    parser_shell.add_argument("service", choices=SHELL_CHOICES, help="The name of the service to shell into")
+    parser_shell.add_argument("service", help="The name of the service to shell into")
 
     parser_update = subparsers.add_parser('update', help="upgrade fednode services (i.e. update source code and restart the container, but don't update the container itself')")
     parser_update.add_argument("-n", "--no-restart", action="store_true", help="Don't restart the container after updating the code'")
+    parser_update.add_argument("-f", "--force-restart", action="store_true", help="Restart the services even if their source code didn't change")
+    parser_update.add_argument("--jobs", type=int, default=GIT_CHECKOUT_JOBS, help="Number of source repos to pull concurrently")
     parser_update.add_argument("services", nargs='*', default='', help="The name of the service or services to update (or blank to for all applicable services)")
 
     parser_rebuild = subparsers.add_parser('rebuild', help="rebuild fednode services (i.e. remove and refetch/install docker containers)")
     parser_rebuild.add_argument("services", nargs='*', default='', help="The name of the service or services to rebuild (or blank for all services)")
     parser_rebuild.add_argument("--mongodb-interface", default="127.0.0.1")
     parser_rebuild.add_argument("--no-cache", action="store_true", help="Rebuilds service or services images from scratch before installing containers")
+    parser_rebuild.add_argument("--parallel", action="store_true",
+        help="Build each distinct image once, several at a time, with a persistent build cache, and only recreate the containers whose image changed")
+    parser_rebuild.add_argument("--jobs", type=int, default=REBUILD_JOBS, help="Number of images to build concurrently with --parallel")
+    parser_rebuild.add_argument("--cache-dir", default=REBUILD_CACHE_PATH, help="Where to keep the build cache for --parallel")
 
     parser_docker_clean = subparsers.add_parser('docker_clean', help="remove ALL docker containers and cached images (use with caution!)")
 
     parser_configcheck = subparsers.add_parser('configcheck', help="check configuration")
 
+    parser_tune = subparsers.add_parser('tune', help="tune the service configs and resource limits to the host hardware")
+    parser_tune.add_argument("--dry-run", action="store_true", help="Only show the changes that would be made")
+    parser_tune.add_argument("--cores", type=int, default=None, help="Number of CPU cores to tune for (default: detected)")
+    parser_tune.add_argument("--memory", type=float, default=None, help="GB of RAM to tune for (default: detected)")
+    parser_tune.add_argument("--disk", choices=['ssd', 'hdd'], default=None, help="Type of the disk holding the docker volumes (default: detected)")
+
+    parser_preflight = subparsers.add_parser('preflight', help="check that the host ports needed by fednode services are free")
+    parser_preflight.add_argument("config", nargs='?', choices=['base', 'base_extbtc', 'counterblock', 'full'],
+        help="The service configuration to check for (defaults to the installed configuration)")
+    parser_preflight.add_argument("--mongodb-interface", default="127.0.0.1", help="The host interface mongo will be bound to")
+    parser_preflight.add_argument("--timeout", type=float, default=PREFLIGHT_TIMEOUT, help="Seconds to wait for each port probe")
+    parser_preflight.add_argument("--json", action="store_true", help="Output the report as JSON")
+
     return parser.parse_args()
 
 
@@ -172,16 +455,349 @@ def write_config(config):
     cfg_file.close()
 
 
-def run_compose_cmd(cmd):
+def get_compose_cmd(cmd):
     assert DOCKER_CONFIG_PATH
     assert os.environ['FEDNODE_RELEASE_TAG']
-    return os.system("{} docker-compose -f {} -p {} {}".format(SUDO_CMD, DOCKER_CONFIG_PATH, PROJECT_NAME, cmd))
+    compose_files = "-f {}".format(DOCKER_CONFIG_PATH)
+    replicas_compose_path = os.path.join(SCRIPTDIR, REPLICAS_COMPOSE_FILE)
+    if os.path.exists(replicas_compose_path):  # counterparty-server replicas added by 'replicas'
+        compose_files += " -f {}".format(replicas_compose_path)
+    tune_compose_path = os.path.join(SCRIPTDIR, TUNE_COMPOSE_FILE)
+    if os.path.exists(tune_compose_path):  # resource limits etc. generated by 'tune' (for the replicas too)
+        compose_files += " -f {}".format(tune_compose_path)
+    return "{} docker-compose {} -p {} {}".format(SUDO_CMD, compose_files, PROJECT_NAME, cmd)
+
+
+def run_compose_cmd(cmd):
+    return os.system(get_compose_cmd(cmd))
+
+
+def parse_simple_yaml(text):
+    # block mappings/sequences of scalars only -- enough for the fednode compose files
+    lines = []
+    for line in text.splitlines():
+        stripped = re.sub(r"""(^|\s)#(?=(?:[^"']|"[^"]*"|'[^']*')*$).*$""", '', line).rstrip()
+        if stripped.strip():
+            lines.append((len(stripped) - len(stripped.lstrip()), stripped.strip()))
+
+    def scalar(value):
+        value = value.strip()
+        if not value:
+            return None
+        if len(value) >= 2 and value[0] == value[-1] and value[0] in '"\'':
+            return value[1:-1]
+        return value
+
+    def parse_block(i, indent):
+        if lines[i][1].startswith('-'):
+            result = []
+            while i < len(lines) and lines[i][0] == indent and lines[i][1].startswith('-'):
+                result.append(scalar(lines[i][1][1:]))
+                i += 1
+            return result, i
+        result = {}
+        while i < len(lines) and lines[i][0] == indent:
+            key, sep, value = lines[i][1].partition(':')
+            if not sep:
+                raise ValueError("Unsupported YAML line: {}".format(lines[i][1]))
+            i += 1
+            if value.strip():
+                result[scalar(key)] = scalar(value)
+            elif i < len(lines) and (lines[i][0] > indent or (lines[i][0] == indent and lines[i][1].startswith('-'))):
+                result[scalar(key)], i = parse_block(i, lines[i][0])
+            else:
+                result[scalar(key)] = None
+        return result, i
+
+    return parse_block(0, lines[0][0])[0] if lines else None
+
+
+def load_yaml_file(path):
+    with open(path) as f:
+        text = f.read()
+    return yaml.safe_load(text) if yaml else parse_simple_yaml(text)
+
+
+def interpolate_compose_value(value):
+    # ${VAR}, ${VAR:-default}, ${VAR-default}, $VAR and $$, as docker-compose does
+    if isinstance(value, dict):
+        return dict((k, interpolate_compose_value(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return [interpolate_compose_value(v) for v in value]
+    if not isinstance(value, str):
+        return value
+
+    def substitute(match):
+        if match.group(0) == '$$':
+            return '$'
+        name = match.group(1) or match.group(4)
+        env_value = os.environ.get(name)
+        if match.group(2) is not None:
+            if env_value is None or (match.group(2) == ':-' and not env_value):
+                return match.group(3)
+        return env_value or ''
+    return re.sub(r'\$\$|\$\{(\w+)(?:(:?-)([^}]*))?\}|\$(?!\{)(\w+)', substitute, value)
+
+
+def compose_env_dict(environment):
+    if isinstance(environment, dict):
+        return dict(environment)
+    return dict(e.split('=', 1) if '=' in e else (e, None) for e in environment or [])
+
+
+def merge_compose_service(base, override):
+    merged = dict((k, v) for k, v in base.items() if k not in COMPOSE_UNSHARED_KEYS)
+    for key, value in override.items():
+        if key in COMPOSE_CONCAT_KEYS and key in merged:
+            merged[key] = merged[key] + [v for v in value if v not in merged[key]]
+        elif key in COMPOSE_DICT_KEYS and key in merged:
+            merged[key] = dict(compose_env_dict(merged[key]), **compose_env_dict(value))
+        elif key in ('volumes', 'devices') and key in merged:
+            # merged on the container path
+            by_target = dict((v.split(':')[1] if ':' in v else v, v) for v in merged[key])
+            by_target.update((v.split(':')[1] if ':' in v else v, v) for v in value)
+            merged[key] = list(by_target.values())
+        else:
+            merged[key] = value
+    return merged
+
+
+def resolve_compose_file(compose_path):
+    # returns the compose model with the 'extends' chains resolved (but not yet interpolated), and the files it was read from
+    compose_path = os.path.abspath(compose_path)
+    files = {}
+
+    def load(path):
+        if path not in files:
+            files[path] = load_yaml_file(path) or {}
+        return files[path]
+
+    def resolve_service(path, name, chain):
+        if (path, name) in chain:
+            raise ValueError("Circular extends of service {} in {}".format(name, path))
+        service = dict(load(path)['services'][name] or {})
+        extends = service.pop('extends', None)
+        if extends:
+            if isinstance(extends, str):
+                extends = {'service': extends}
+            base_path = os.path.join(os.path.dirname(path), extends['file']) if extends.get('file') else path
+            service = merge_compose_service(resolve_service(os.path.abspath(base_path), extends['service'], chain + [(path, name)]), service)
+        for key in COMPOSE_DICT_KEYS:
+            if key in service:
+                service[key] = compose_env_dict(service[key])
+        return service
+
+    compose = load(compose_path)
+    model = {
+        'services': dict((name, resolve_service(compose_path, name, [])) for name in compose.get('services', {})),
+        'volumes': list((compose.get('volumes') or {}).keys()),
+    }
+    return model, sorted(files.keys())
+
+
+def file_sha256(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def get_compose_model(compose_path, use_cache=True):
+    # the resolved (and interpolated) compose model, cached on disk until one of the compose files it was built from changes
+    compose_path = os.path.abspath(compose_path)
+    cache = {}
+    if use_cache and os.path.exists(COMPOSE_CACHE_PATH):
+        try:
+            with open(COMPOSE_CACHE_PATH) as f:
+                cache = json.load(f)
+            if cache.get('version') != COMPOSE_CACHE_VERSION:
+                cache = {}
+        except (OSError, ValueError):
+            cache = {}
+
+    entry = cache.get('models', {}).get(compose_path)
+    try:
+        is_fresh = entry is not None and all(file_sha256(path) == digest for path, digest in entry['files'].items())
+    except OSError:
+        is_fresh = False
+    if not is_fresh:
+        model, paths = resolve_compose_file(compose_path)
+        entry = {'files': dict((path, file_sha256(path)) for path in paths), 'model': model}
+        if use_cache:
+            cache = {'version': COMPOSE_CACHE_VERSION, 'models': dict(cache.get('models', {}), **{compose_path: entry})}
+            try:
+                with open(COMPOSE_CACHE_PATH, 'w') as f:
+                    json.dump(cache, f)
+            except OSError:
+                pass  # the cache is just an optimization
+    return interpolate_compose_value(entry['model'])
+
+
+def get_compose_config_path(build_config):
+    return os.path.join(SCRIPTDIR, "docker-compose.{}.yml".format(build_config))
+
+
+def get_compose_services(compose_path):
+    return list(get_compose_model(compose_path)['services'].keys())
+
+
+def get_compose_links(compose_path):
+    # maps each service to the services it links to
+    return dict((name, [l.split(':')[0] for l in service.get('links') or []])
+        for name, service in get_compose_model(compose_path)['services'].items())
+
+
+def get_compose_host_ports(compose_path):
+    # list of (host interface, host port) published by the services ('' meaning all interfaces)
+    host_ports = []
+    for service in get_compose_model(compose_path)['services'].values():
+        for port_spec in service.get('ports') or []:
+            parts = str(port_spec).split('/')[0].split(':')
+            if len(parts) < 2 or not parts[-2]:
+                continue  # not published on a fixed host port
+            interface = parts[-3] if len(parts) > 2 else ''
+            for port in range(int(parts[-2].split('-')[0]), int(parts[-2].split('-')[-1]) + 1):
+                if (interface, port) not in host_ports:
+                    host_ports.append((interface, port))
+    return host_ports
+
+
+def get_compose_volumes(compose_path):
+    return get_compose_model(compose_path)['volumes']
+
 
+def get_replica_groups():
+    # maps each counterparty-server service with replicas to their service names, in order
+    replicas_compose_path = os.path.join(SCRIPTDIR, REPLICAS_COMPOSE_FILE)
+    if not os.path.exists(replicas_compose_path):
+        return {}
+    groups = {}
+    for name in (load_yaml_file(replicas_compose_path).get('services') or {}):
+        match = REPLICA_NAME_RE.match(name)
+        if match:
+            groups.setdefault(match.group(1), []).append((int(match.group(2)), name))
+    return dict((service, [name for _, name in sorted(replicas)]) for service, replicas in groups.items())
 
-def is_port_open(port):
+
+def expand_replica_groups(services):
+    # a counterparty-server service stands for its whole replica group
+    groups = get_replica_groups()
+    expanded = []
+    for service in services:
+        for name in [service] + groups.get(service, []):
+            if name not in expanded:
+                expanded.append(name)
+    return expanded
+
+
+def render_replicas_compose(replica_counts, links):
+    lines = ["version: '2'", "", "# generated by 'fednode replicas': read replicas of counterparty-server", "services:"]
+    volumes = []
+    for service in sorted(replica_counts):
+        network, config_file, rpc_port, _, first_port = REPLICA_NETWORKS[service]
+        for n in range(1, replica_counts[service] + 1):
+            name = "{}-replica{}".format(service, n)
+            volumes.append("{}-data".format(name))
+            lines += [
+                "  {}:".format(name),
+                "    extends:",
+                "      file: docker-compose.tmpl.yml",
+                "      service: counterparty-base",
+                "    hostname: ${{HOSTNAME_BASE}}-cp{}-r{}".format('-t' if network == 'testnet' else '', n),
+                "    ports:",
+                "      - \"127.0.0.1:{}:{}\"".format(first_port + n - 1, rpc_port),
+                "    environment:",
+                "      - PARAMS=--config-file=/root/.config/counterparty/{}".format(config_file),
+                "      - BTC_NETWORK={}".format(network),
+                "      - NO_BOOTSTRAP=${NO_BOOTSTRAP}",
+                "    volumes:",
+                "      - ./config/counterparty:/root/.config/counterparty",
+                "      - {}-data:/root/.local/share/counterparty".format(name),
+            ]
+            if links.get(service):
+                lines += ["    links:"] + ["      - {}".format(link) for link in links[service]]
+            lines.append("")
+    lines += ["volumes:"] + ["  {}:".format(volume) for volume in volumes]
+    return "\n".join(lines) + "\n"
+
+
+async def probe_port(interface, port, timeout):
     # TCP ports only
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    return sock.connect_ex(('127.0.0.1', port)) == 0  # returns True if the port is open
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(interface, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return True  # something is listening on the port
+
+
+def get_listening_processes():
+    # maps each listening TCP port to the processes holding it, from /proc (Linux only, and only the processes we can see)
+    port_inodes = {}
+    for proc_net in ('/proc/net/tcp', '/proc/net/tcp6'):
+        try:
+            with open(proc_net) as f:
+                next(f)
+                for line in f:
+                    fields = line.split()
+                    if fields[3] == '0A':  # TCP_LISTEN
+                        port_inodes.setdefault(int(fields[1].split(':')[1], 16), set()).add(fields[9])
+        except (OSError, StopIteration):
+            continue
+    if not port_inodes:
+        return {}
+
+    inode_procs = {}
+    for fd_dir in glob.glob('/proc/[0-9]*/fd'):
+        pid = int(fd_dir.split('/')[2])
+        try:
+            inodes = [os.readlink(os.path.join(fd_dir, fd))[8:-1] for fd in os.listdir(fd_dir)
+                if os.readlink(os.path.join(fd_dir, fd)).startswith('socket:[')]
+            if not inodes:
+                continue
+            with open('/proc/{}/comm'.format(pid)) as f:
+                name = f.read().strip()
+        except OSError:
+            continue
+        for inode in inodes:
+            inode_procs[inode] = (pid, name)
+    return {port: sorted(set(inode_procs[i] for i in inodes if i in inode_procs)) for port, inodes in port_inodes.items()}
+
+
+def port_preflight(host_ports, timeout=PREFLIGHT_TIMEOUT):
+    # host_ports is a list of (host interface, port), as from get_compose_host_ports()
+    probes = []
+    for interface, port in host_ports:
+        interfaces = ['127.0.0.1']
+        if interface and interface not in ('0.0.0.0', '127.0.0.1'):
+            interfaces.append(interface)
+        probes += [(i, port) for i in interfaces if (i, port) not in probes]
+
+    async def probe_all():
+        return await asyncio.gather(*[probe_port(interface, port, timeout) for interface, port in probes])
+    results = asyncio.run(probe_all())
+
+    listening_processes = get_listening_processes() if any(results) else {}
+    report = []
+    for (interface, port), in_use in zip(probes, results):
+        processes = listening_processes.get(port, []) if in_use else []
+        report.append({'port': port, 'interface': interface, 'in_use': in_use,
+            'processes': [{'pid': pid, 'name': name} for pid, name in processes]})
+    return report
+
+
+def print_preflight_report(report, as_json=False):
+    if as_json:
+        print(json.dumps(report, indent=2))
+        return
+    for entry in report:
+        if entry['in_use']:
+            held_by = ', '.join("{} (pid {})".format(p['name'], p['pid']) for p in entry['processes']) or "unknown process"
+            print("{}:{}: IN USE by {}".format(entry['interface'], entry['port'], held_by))
+        else:
+            print("{}:{}: free".format(entry['interface'], entry['port']))
 
 
 def setup_env():
@@ -209,19 +825,141 @@ def setup_env():
         os.system("bash -c 'sudo whoami > /dev/null'")
 
 
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=DOCKER_API_TIMEOUT):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class DockerAPIError(Exception):
+    def __init__(self, status, message):
+        super().__init__("Docker API error {}: {}".format(status, message))
+        self.status = status
+        self.message = message
+
+
+class DockerClient(object):
+    """Minimal Docker Engine API client, keeping a single HTTP connection open to the docker daemon socket"""
+
+    def __init__(self, socket_path=DOCKER_SOCKET_PATH, timeout=DOCKER_API_TIMEOUT):
+        self.conn = UnixHTTPConnection(socket_path, timeout=timeout)
+
+    def close(self):
+        self.conn.close()
+
+    def request(self, method, path, query=None, not_found_ok=False):
+        if query:
+            path = "{}?{}".format(path, urllib.parse.urlencode(query))
+        for attempt in range(2):
+            try:
+                self.conn.request(method, path, headers={'Host': 'docker'})
+                response = self.conn.getresponse()
+                body = response.read()
+                break
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                # the daemon closed our keep-alive connection; reconnect once
+                self.conn.close()
+                if attempt:
+                    raise
+        if response.status == 404 and not_found_ok:
+            return None
+        if response.getheader('Content-Type', '').startswith('application/json'):
+            data = json.loads(body.decode("utf-8"))
+        else:
+            data = body.decode("utf-8", errors="replace") or None
+        if response.status >= 400:
+            raise DockerAPIError(response.status, data.get('message') if isinstance(data, dict) else body)
+        return data
+
+    def inspect_container(self, name):
+        return self.request('GET', '/containers/{}/json'.format(urllib.parse.quote(name)), not_found_ok=True)
+
+    def inspect_containers(self, names):
+        return dict((name, self.inspect_container(name)) for name in names)
+
+    def list_containers(self, all=True):
+        return self.request('GET', '/containers/json', {'all': int(all)})
+
+    def remove_containers(self, ids, force=False):
+        # returns a dict of id -> error message (None if removed)
+        return self._remove_all('/containers/{}', ids, {'force': int(force)})
+
+    def list_images(self):
+        return self.request('GET', '/images/json')
+
+    def remove_images(self, ids, force=False):
+        return self._remove_all('/images/{}', ids, {'force': int(force)})
+
+    def inspect_image(self, name):
+        return self.request('GET', '/images/{}/json'.format(urllib.parse.quote(name)), not_found_ok=True)
+
+    def inspect_volume(self, name):
+        return self.request('GET', '/volumes/{}'.format(urllib.parse.quote(name)), not_found_ok=True)
+
+    def inspect_volumes(self, names):
+        return dict((name, self.inspect_volume(name)) for name in names)
+
+    def list_volumes(self):
+        return self.request('GET', '/volumes')['Volumes'] or []
+
+    def remove_volumes(self, names, force=False):
+        return self._remove_all('/volumes/{}', names, {'force': int(force)})
+
+    def _remove_all(self, path_fmt, ids, query):
+        errors = {}
+        for id in ids:
+            try:
+                self.request('DELETE', path_fmt.format(urllib.parse.quote(id)), query)
+                errors[id] = None
+            except DockerAPIError as e:
+                errors[id] = e.message
+        return errors
+
+
+def get_docker_client():
+    # returns None if we can't talk to the docker daemon socket directly (e.g. the user isn't in the docker group),
+    # in which case callers fall back to the (sudo'd) docker CLI
+    global DOCKER_CLIENT
+    if DOCKER_CLIENT is None:
+        if IS_WINDOWS or not os.access(DOCKER_SOCKET_PATH, os.R_OK | os.W_OK):
+            return None
+        client = DockerClient(DOCKER_SOCKET_PATH)
+        try:
+            client.request('GET', '/_ping')
+        except (OSError, ValueError, http.client.HTTPException, DockerAPIError):
+            return None
+        DOCKER_CLIENT = client
+    return DOCKER_CLIENT
+
+
 def is_container_running(service, abort_on_not_exist=True):
-    try:
-        container_running = subprocess.check_output('{} docker inspect --format="{{{{ .State.Running }}}}" federatednode_{}_1'.format(SUDO_CMD, service), shell=True).decode("utf-8").strip()
-        container_running = container_running == 'true'
-    except subprocess.CalledProcessError:
-        container_running = None
-        if abort_on_not_exist:
-            print("Container {} doesn't seem to exist'".format(service))
-            sys.exit(1)
+    container_name = "federatednode_{}_1".format(service)
+    client = get_docker_client()
+    if client:
+        container_info = client.inspect_container(container_name)
+        container_running = container_info['State']['Running'] if container_info else None
+    else:
+        try:
+            container_running = subprocess.check_output('{} docker inspect --format="{{{{ .State.Running }}}}" {}'.format(SUDO_CMD, container_name), shell=True).decode("utf-8").strip()
+            container_running = container_running == 'true'
+        except subprocess.CalledProcessError:
+            container_running = None
+    if container_running is None and abort_on_not_exist:
+        print("Container {} doesn't seem to exist'".format(service))
+        sys.exit(1)
     return container_running
 
 
 def get_docker_volume_path(volume_name):
+    client = get_docker_client()
+    if client:
+        volume_info = client.inspect_volume(volume_name)
+        return volume_info['Mountpoint'] if volume_info else None
     try:
         json_output = subprocess.check_output('{} docker volume inspect {}'.format(SUDO_CMD, volume_name), shell=True).decode("utf-8").strip()
     except subprocess.CalledProcessError:
@@ -229,177 +967,3078 @@ def get_docker_volume_path(volume_name):
     volume_info = json.loads(json_output)
     return volume_info[0]['Mountpoint']
 
-def file_mtime(path):
-    t = datetime.fromtimestamp(os.stat(path).st_mtime, timezone.utc)
-    return t.astimezone().isoformat()
 
-def config_check(build_config):
-    for dirname, fromfile, tofile in CONFIGCHECK_FILES[build_config]:
-        # dirname, fromfile, tofile = config_spec
+def get_docker_volume_paths(volume_names):
+    client = get_docker_client()
+    if client:
+        return dict((name, info['Mountpoint'] if info else None) for name, info in client.inspect_volumes(volume_names).items())
+    # inspect the volumes concurrently, rather than one blocking docker fork after another
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(volume_names), 1)) as executor:
+        return dict(zip(volume_names, executor.map(get_docker_volume_path, volume_names)))
 
-        try:
-            fromfilepath = os.path.join(SCRIPTDIR, 'config', dirname, fromfile)
-            fromdate = file_mtime(fromfilepath)
-        except FileNotFoundError as e:
-            print("Config file not found at {}".format(fromfilepath))
+
+def as_session_user(cmd):
+    if IS_WINDOWS:
+        return cmd
+    # make sure to run the command as the original user, so the permissions are right
+    return "{} -u {} bash -c \"{}\"".format(SUDO_CMD, SESSION_USER, cmd)
+
+
+def git_checkout(repo, repo_url, repo_branch, repo_dir, shallow=False, cache_dir=None):
+    start = time.time()
+    clone_args = ["-b", repo_branch]
+    if shallow:
+        clone_args += ["--depth", "1", "--single-branch"]
+    cmds = []
+    if cache_dir:
+        mirror_dir = os.path.join(cache_dir, "{}.git".format(repo))
+        if os.path.exists(mirror_dir):
+            cmds.append("git --git-dir={} remote update --prune".format(mirror_dir))
+        else:
+            cmds.append("git clone --mirror {} {}".format(repo_url, mirror_dir))
+        # --dissociate copies the borrowed objects, so the checkout doesn't depend on the cache afterwards
+        clone_args += ["--reference-if-able", mirror_dir, "--dissociate"]
+    cmds.append("git clone {} {} {}".format(' '.join(clone_args), repo_url, repo_dir))
+
+    output = ''
+    for cmd in cmds:
+        proc = subprocess.run(as_session_user(cmd), shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output += proc.stdout.decode("utf-8", errors="replace")
+        if proc.returncode != 0:
+            return repo, False, time.time() - start, output
+    return repo, True, time.time() - start, output
+
+
+def git_checkout_all(repos, repo_branch, use_ssh_uris=False, shallow=False, cache_dir=None, jobs=GIT_CHECKOUT_JOBS):
+    if cache_dir:
+        cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    checkouts = []
+    for repo in repos:
+        repo_dir = os.path.join(SCRIPTDIR, "src", repo)
+        if os.path.exists(repo_dir) or repo in [c[0] for c in checkouts]:
             continue
+        repo_url = REPO_BASE_SSH.format(repo) if use_ssh_uris else REPO_BASE_HTTPS.format(repo)
+        checkouts.append((repo, repo_url, repo_branch, repo_dir, shallow, cache_dir))
+    if not checkouts:
+        return
 
-        try:
-            tofilepath = os.path.join(SCRIPTDIR, 'config', dirname, tofile)
-            todate = file_mtime(tofilepath)
-        except FileNotFoundError as e:
-            print("Config file not found at {}".format(tofilepath))
+    print("Checking out {} source repos ({} at a time)...".format(len(checkouts), jobs))
+    start = time.time()
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        futures = [executor.submit(git_checkout, *checkout) for checkout in checkouts]
+        for future in concurrent.futures.as_completed(futures):
+            repo, ok, elapsed, output = future.result()
+            print("  {:<20} {:>7.1f}s  {}".format(repo, elapsed, "OK" if ok else "FAILED"))
+            if not ok:
+                failed.append((repo, output))
+    print("Source checkout finished in {:.1f}s".format(time.time() - start))
+
+    if failed:
+        for repo, output in failed:
+            print("\nCheckout of {} failed:\n{}".format(repo, output.strip()))
+            # don't leave a partial checkout behind, as it would be skipped on the next install attempt
+            shutil.rmtree(os.path.join(SCRIPTDIR, "src", repo), ignore_errors=True)
+        print("Cannot install, as {} source checkout(s) failed".format(len(failed)))
+        sys.exit(1)
+
+
+def git_update(repo_dir):
+    def git_output(cmd):
+        return subprocess.check_output("git -C {} {}".format(repo_dir, cmd), shell=True).decode("utf-8").strip()
+
+    start = time.time()
+    branch = git_output("symbolic-ref --short -q HEAD || true")
+    if not branch:
+        return repo_dir, None, time.time() - start, "Unknown service git branch name, or repo in detached state"
+    head_before = git_output("rev-parse HEAD")
+    proc = subprocess.run(as_session_user("git -C {} pull origin {}".format(repo_dir, branch)), shell=True,
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = proc.stdout.decode("utf-8", errors="replace")
+    if proc.returncode != 0:
+        return repo_dir, None, time.time() - start, output
+    return repo_dir, git_output("rev-parse HEAD") != head_before, time.time() - start, output
+
+
+def get_update_service_dirs(service_base):
+    if service_base == 'counterparty':  # special case
+        service_dirs = ["counterparty-lib", "counterparty-cli"]
+    else:
+        service_dirs = [service_base,]
+    return [os.path.join(SCRIPTDIR, "src", d) for d in service_dirs if os.path.exists(os.path.join(SCRIPTDIR, "src", d))]
+
+
+def sort_services_by_dependency(services, links):
+    # dependencies (links) first, keeping the given order otherwise
+    ordered = []
+    def visit(service, seen):
+        if service in ordered or service in seen:
+            return
+        for dep in links.get(service, []):
+            visit(dep, seen + [service])
+        ordered.append(service)
+    for service in services:
+        visit(service, [])
+    return [s for s in ordered if s in services]
+
+
+def get_image_id(image=None, container=None):
+    # the id of an image, or of the image a container runs (None if there's no such image/container)
+    client = get_docker_client()
+    if client:
+        info = client.inspect_image(image) if image else client.inspect_container(container)
+        return (info['Id'] if image else info['Image']) if info else None
+    try:
+        return subprocess.check_output('{} docker inspect --type {} --format="{{{{ {} }}}}" {}'.format(SUDO_CMD,
+            'image' if image else 'container', '.Id' if image else '.Image', image or container),
+            shell=True, stderr=subprocess.DEVNULL).decode("utf-8").strip() or None
+    except subprocess.CalledProcessError:
+        return None
+
+
+def get_build_groups(services):
+    # the services grouped by identical build (context, dockerfile and args), e.g. the mainnet/testnet pairs
+    model_services = get_compose_model(DOCKER_CONFIG_PATH)['services']
+    groups = collections.OrderedDict()
+    for service in services:
+        match = REPLICA_NAME_RE.match(service)
+        build = model_services.get(match.group(1) if match else service, {}).get('build')
+        if not build:
             continue
+        if isinstance(build, str):
+            build = {'context': build}
+        args = build.get('args') or {}
+        if isinstance(args, list):
+            args = dict(arg.split('=', 1) for arg in args)
+        context = os.path.normpath(os.path.join(SCRIPTDIR, build['context']))
+        dockerfile = build.get('dockerfile', 'Dockerfile')
+        key = json.dumps([context, dockerfile, sorted(args.items())])
+        groups.setdefault(key, {'context': context, 'dockerfile': dockerfile, 'args': args, 'services': []})['services'].append(service)
+    return list(groups.values())
 
 
-        linejunk_filter = lambda x: len(x.strip()) > 0 and x.strip()[0:1] != '#'
-        with open(fromfilepath) as ff:
-            fromlines = list(filter(linejunk_filter, ff.readlines()))
-        with open(tofilepath) as tf:
-            tolines = list(filter(linejunk_filter, tf.readlines()))
+def build_image(group, cache_dir, use_buildx, no_cache=False):
+    # builds the image of a group of services once, tagging it for each of them as docker-compose would name it
+    tags = ["{}_{}".format(PROJECT_NAME, service) for service in group['services']]
+    cmd = SUDO_CMD.split() + ['docker']
+    if use_buildx:
+        # (only the stages' layers are cached: cargo/pip caches would need cache mounts in the upstream Dockerfiles)
+        # one cache per distinct build, so concurrent builds of the same context with another dockerfile or args don't share it
+        build_key = hashlib.sha256(json.dumps([group['context'], group['dockerfile'], sorted(group['args'].items())]).encode()).hexdigest()
+        layer_cache_dir = os.path.join(cache_dir, 'layers', "{}-{}".format(os.path.basename(group['context']), build_key[:12]))
+        cmd += ['buildx', 'build', '--builder', REBUILD_BUILDER, '--load',
+            '--cache-to', 'type=local,mode=max,dest={}'.format(layer_cache_dir)]
+        if os.path.exists(os.path.join(layer_cache_dir, 'index.json')):
+            cmd += ['--cache-from', 'type=local,src={}'.format(layer_cache_dir)]
+    else:
+        cmd += ['build']
+    cmd += ['-t', tags[0], '-f', os.path.join(group['context'], group['dockerfile'])]
+    for key, value in sorted(group['args'].items()):
+        cmd += ['--build-arg', "{}={}".format(key, value)]
+    if no_cache:
+        cmd += ['--no-cache']
+    cmd.append(group['context'])
 
-        diff = difflib.unified_diff(fromlines, tolines, fromfile, tofile, fromdate, todate, n=3)
-        diff_string = "".join(diff)
-        if len(diff_string):
-            print("Found these differences in the file {}:\n".format(tofilepath))
-            print("{}".format(diff_string))
-        else:
-            print("{}: OK".format(os.path.join(dirname, tofile)))
+    log_path = os.path.join(cache_dir, 'logs', "{}.log".format(tags[0]))
+    start = time.time()
+    with open(log_path, 'w') as log:
+        ok = subprocess.call(cmd, stdout=log, stderr=subprocess.STDOUT) == 0
+        for tag in tags[1:]:
+            ok = ok and subprocess.call(SUDO_CMD.split() + ['docker', 'tag', tags[0], tag], stdout=log, stderr=subprocess.STDOUT) == 0
+    return {'image': tags[0], 'services': group['services'], 'seconds': time.time() - start, 'ok': ok, 'log': log_path}
 
-    return
 
-def main():
-    global DOCKER_CONFIG_PATH
-    setup_env()
-    args = parse_args()
+def parallel_rebuild(services, jobs=REBUILD_JOBS, cache_dir=REBUILD_CACHE_PATH, no_cache=False):
+    # builds the distinct images concurrently, then recreates only the containers whose image changed
+    start = time.time()
+    os.makedirs(os.path.join(cache_dir, 'logs'), exist_ok=True)
+    model_services = get_compose_model(DOCKER_CONFIG_PATH)['services']
+    previous_images = dict((service, get_image_id(container="federatednode_{}_1".format(service))) for service in services)
 
-    use_docker_pulls = not args.no_pull
+    use_buildx = subprocess.call("{} docker buildx version > /dev/null 2>&1".format(SUDO_CMD), shell=True) == 0
+    if use_buildx and subprocess.call("{} docker buildx inspect {} > /dev/null 2>&1".format(SUDO_CMD, REBUILD_BUILDER), shell=True):
+        use_buildx = subprocess.call("{} docker buildx create --name {} --driver docker-container > /dev/null".format(
+            SUDO_CMD, REBUILD_BUILDER), shell=True) == 0
+    if not use_buildx:
+        print("docker buildx isn't available, so only the docker daemon's own layer cache is used")
 
-    # run utility commands (docker_clean) if specified
-    if args.command == 'docker_clean':
-        docker_containers = subprocess.check_output("{} docker ps -a -q".format(SUDO_CMD), shell=True).decode("utf-8").split('\n')
-        docker_images = subprocess.check_output("{} docker images -q".format(SUDO_CMD), shell=True).decode("utf-8").split('\n')
-        for container in docker_containers:
-            if not container:
-                continue
-            os.system("{} docker rm {}".format(SUDO_CMD, container))
-        for image in docker_images:
-            if not image:
-                continue
-            os.system("{} docker rmi {}".format(SUDO_CMD, image))
-        sys.exit(1)
+    groups = get_build_groups(services)
+    print("Building {} image(s) for {} service(s), {} at a time (logs under {})...".format(
+        len(groups), sum(len(group['services']) for group in groups), jobs, os.path.join(cache_dir, 'logs')))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        results = list(executor.map(lambda group: build_image(group, cache_dir, use_buildx, no_cache), groups))
 
-    # for all other commands
-    # if config doesn't exist, only the 'install' command may be run
-    config_existed = os.path.exists(FEDNODE_CONFIG_PATH)
-    config = configparser.ConfigParser()
-    if not config_existed:
-        if args.command != 'install':
-            print("config file {} does not exist. Please run the 'install' command first".format(FEDNODE_CONFIG_FILE))
-            sys.exit(1)
+    print("\n{:<40} {:>9}  {:<7} {}".format("IMAGE", "TIME", "RESULT", "SERVICES"))
+    for result in sorted(results, key=lambda result: -result['seconds']):
+        print("{:<40} {:>8.1f}s  {:<7} {}".format(result['image'], result['seconds'], "ok" if result['ok'] else "FAILED",
+            ', '.join(result['services'])))
+    failed = [result for result in results if not result['ok']]
+    for result in failed:
+        print("Building {} failed, see {}".format(result['image'], result['log']))
 
-        # write default config
-        config.add_section('Default')
-        config.set('Default', 'branch', args.branch)
-        config.set('Default', 'config', args.config)
-        write_config(config)
+    # compare the image ids (of the images just built, or pulled for the services that use an image)
+    built = dict((service, result['image']) for result in results if result['ok'] for service in result['services'])
+    changed, unchanged = [], []
+    for service in services:
+        match = REPLICA_NAME_RE.match(service)
+        image = built.get(service) or model_services.get(match.group(1) if match else service, {}).get('image')
+        if image is None:
+            continue  # its build failed
+        if previous_images[service] is None or previous_images[service] != get_image_id(image=image):
+            changed.append(service)
+        else:
+            unchanged.append(service)
+    if unchanged:
+        print("Image unchanged, not recreating: {}".format(', '.join(unchanged)))
+    if changed:
+        run_compose_cmd("up -d --no-deps --force-recreate {}".format(' '.join(changed)))
+    print("Rebuilt in {:.1f}s ({} container(s) recreated)".format(time.time() - start, len(changed)))
+    return not failed
 
-    # load and read config
-    assert os.path.exists(FEDNODE_CONFIG_PATH)
-    config.read(FEDNODE_CONFIG_PATH)
-    build_config = config.get('Default', 'config')
-    docker_config_file = "docker-compose.{}.yml".format(build_config)
-    DOCKER_CONFIG_PATH = os.path.join(SCRIPTDIR, docker_config_file)
-    repo_branch = config.get('Default', 'branch')
-    os.environ['FEDNODE_RELEASE_TAG'] = 'latest' if repo_branch == 'master' else repo_branch
-    os.environ['HOSTNAME_BASE'] = socket.gethostname()
-    os.environ['MONGODB_HOST_INTERFACE'] = getattr(args, 'mongodb_interface', "127.0.0.1")
-    os.environ["NO_BOOTSTRAP"] = "true" if hasattr(args, "no_bootstrap") and args.no_bootstrap else "false"
 
-    # perform action for the specified command
-    if args.command == 'install':
-        if config_existed:
-            print("Cannot install, as it appears a configuration already exists. Please run the 'uninstall' command first")
-            sys.exit(1)
+def read_service_config(dirname, filename):
+    # flattened key/values of a service config file (falling back to its .default), whether or not it has sections
+    path = os.path.join(SCRIPTDIR, 'config', dirname, filename)
+    if not os.path.exists(path):
+        path += '.default'
+    parser = configparser.ConfigParser(allow_no_value=True, strict=False, interpolation=None)
+    try:
+        with open(path) as f:
+            parser.read_string("[Default]\n" + f.read())
+    except (OSError, configparser.Error):
+        return {}
+    service_config = {}
+    for section in parser.sections():
+        service_config.update(parser.items(section))
+    return service_config
 
-        # check port usage
-        for port in HOST_PORTS_USED[build_config]:
-            if is_port_open(port):
-                print("Cannot install, as it appears a process is already listening on host port {}".format(port))
-                sys.exit(1)
 
-        # check out the necessary source trees (don't use submodules due to detached HEAD and other problems)
-        REPOS = REPOS_BASE if build_config == 'base' else (REPOS_COUNTERBLOCK if build_config == 'counterblock' else REPOS_FULL)
-        for repo in REPOS:
-            repo_url = REPO_BASE_SSH.format(repo) if args.use_ssh_uris else REPO_BASE_HTTPS.format(repo)
-            repo_dir = os.path.join(SCRIPTDIR, "src", repo)
-            if not os.path.exists(repo_dir):
-                git_cmd = "git clone -b {} {} {}".format(repo_branch, repo_url, repo_dir)
-                if not IS_WINDOWS:  # make sure to check out the code as the original user, so the permissions are right
-                    os.system("{} -u {} bash -c \"{}\"".format(SUDO_CMD, SESSION_USER, git_cmd))
-                else:
-                    os.system(git_cmd)
+def json_rpc_call(url, method, params=None, user=None, password=None, timeout=STATUS_TIMEOUT):
+    payload = json.dumps({'method': method, 'params': params if params is not None else [], 'jsonrpc': '2.0', 'id': 0}).encode('utf-8')
+    request = urllib.request.Request(url, data=payload, headers={'Content-Type': 'application/json'})
+    if user is not None:
+        credentials = base64.b64encode("{}:{}".format(user, password).encode('utf-8')).decode('ascii')
+        request.add_header('Authorization', 'Basic {}'.format(credentials))
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            reply = json.loads(response.read().decode('utf-8'))
+    except urllib.error.HTTPError as e:
+        # bitcoind answers RPC errors with an HTTP error status, but still a JSON body
+        try:
+            reply = json.loads(e.read().decode('utf-8'))
+        except ValueError:
+            raise e
+    if reply.get('error'):
+        raise RuntimeError(reply['error'].get('message', reply['error']) if isinstance(reply['error'], dict) else reply['error'])
+    return reply['result']
 
-        # make sure we have the newest image for each service
-        if use_docker_pulls:
-            run_compose_cmd("pull --ignore-pull-failures")
+
+def tcp_json_rpc_call(host, port, method, params=None, timeout=STATUS_TIMEOUT):
+    # newline delimited JSON-RPC over a raw TCP socket, as spoken by addrindexrs
+    with socket.create_connection((host, port), timeout=timeout) as sock:
+        sock.sendall((json.dumps({'method': method, 'params': params or [], 'id': 0}) + '\n').encode('utf-8'))
+        reply = b''
+        while not reply.endswith(b'\n'):
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            reply += chunk
+    reply = json.loads(reply.decode('utf-8'))
+    if reply.get('error'):
+        raise RuntimeError(reply['error'].get('message', reply['error']) if isinstance(reply['error'], dict) else reply['error'])
+    return reply['result']
+
+
+def probe_service_status(service, probe, port, config_file, host='127.0.0.1', timeout=STATUS_TIMEOUT):
+    service_config = read_service_config(*config_file) if config_file else {}
+    status = {'service': service, 'up': False, 'height': None, 'backend_height': None, 'lag': None, 'latency_ms': None, 'error': None}
+    start = time.time()
+    try:
+        if probe == 'bitcoind':
+            info = json_rpc_call("http://{}:{}/".format(host, port), 'getblockchaininfo',
+                user=service_config.get('rpcuser'), password=service_config.get('rpcpassword'), timeout=timeout)
+            status['height'] = info['blocks']
+            status['backend_height'] = info['headers']
+        elif probe == 'addrindexrs':
+            header = tcp_json_rpc_call(host, port, 'blockchain.headers.subscribe', timeout=timeout)
+            status['height'] = header.get('height', header.get('block_height')) if isinstance(header, dict) else None
+        elif probe == 'counterparty':
+            info = json_rpc_call("http://{}:{}/api/".format(host, port), 'get_running_info',
+                user=service_config.get('rpc-user'), password=service_config.get('rpc-password'), timeout=timeout)
+            status['height'] = info['last_block']['block_index'] if info.get('last_block') else None
+            status['backend_height'] = info.get('bitcoin_block_count')
+        elif probe == 'counterblock':
+            info = json_rpc_call("http://{}:{}/api/".format(host, port), 'is_ready', timeout=timeout)
+            status['height'] = info.get('block_height')
         else:
-            print("skipping docker pull command")
+            with urllib.request.urlopen("http://{}:{}/".format(host, port), timeout=timeout):
+                pass
+        status['up'] = True
+    except urllib.error.HTTPError:
+        status['up'] = True  # answering, if not happily
+    except Exception as e:
+        status['error'] = str(e) or e.__class__.__name__
+    status['latency_ms'] = round((time.time() - start) * 1000, 1)
+    return status
 
 
-        # copy over the configs from .default to active versions, if they don't already exist
-        for default_config in glob.iglob(os.path.join(SCRIPTDIR, 'config', '**/*.default'), recursive=True):
-            active_config = default_config.replace('.default', '')
-            if not os.path.exists(active_config):
-                print("Generating config from defaults at {} ...".format(active_config))
-                shutil.copy2(default_config, active_config)
-                default_config_stat = os.stat(default_config)
-                if not IS_WINDOWS:
-                    os.chown(active_config, default_config_stat.st_uid, default_config_stat.st_gid)
+def get_status_specs():
+    # STATUS_SERVICES, plus the counterparty-server replicas (on their host ports)
+    specs = list(STATUS_SERVICES)
+    for service, replicas in get_replica_groups().items():
+        _, config_file, _, _, first_port = REPLICA_NETWORKS[service]
+        specs += [(name, 'counterparty', first_port + int(REPLICA_NAME_RE.match(name).group(2)) - 1, ('counterparty', config_file))
+            for name in replicas]
+    return specs
 
-        # create symlinks to the data volumes (for ease of use)
-        if not IS_WINDOWS:
-            data_dir = os.path.join(SCRIPTDIR, "data")
-            if not os.path.exists(data_dir):
-                os.mkdir(data_dir)
 
-            for volume in VOLUMES_USED[build_config]:
-                symlink_path = os.path.join(data_dir, volume.replace('-data', ''))
-                volume_name = "{}_{}".format(PROJECT_NAME, volume)
-                mountpoint_path = get_docker_volume_path(volume_name)
-                if mountpoint_path is not None and not os.path.lexists(symlink_path):
-                    os.symlink(mountpoint_path, symlink_path)
-                    print("For convenience, symlinking {} to {}".format(mountpoint_path, symlink_path))
+def get_services_status(services, host='127.0.0.1', timeout=STATUS_TIMEOUT):
+    specs = [spec for spec in get_status_specs() if spec[0] in services]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(specs), 1)) as executor:
+        statuses = list(executor.map(lambda spec: probe_service_status(*spec, host=host, timeout=timeout), specs))
 
-        # launch
-        run_compose_cmd("up -d")
-    elif args.command == 'uninstall':
-        run_compose_cmd("down")
-        os.remove(FEDNODE_CONFIG_PATH)
-    elif args.command == 'start':
-        run_compose_cmd("start {}".format(' '.join(args.services)))
-    elif args.command == 'stop':
-        run_compose_cmd("stop {}".format(' '.join(args.services)))
-    elif args.command == 'restart':
-        run_compose_cmd("restart {}".format(' '.join(args.services)))
-    elif args.command == 'reparse':
-        run_compose_cmd("stop {}".format(args.service))
-        run_compose_cmd("run -e COMMAND=reparse {}".format(args.service))
-    elif args.command == 'rollback':
-        run_compose_cmd("stop {}".format(args.service))
-        run_compose_cmd("run -e COMMAND='rollback {}' {}".format(args.block_index, args.service))
-    elif args.command == 'validate':
-        run_compose_cmd("stop {}".format(args.service))
-        run_compose_cmd("run -e COMMAND=checkdb {}".format(args.service))
+    # lag is measured against our bitcoind on the same network if there's one, else against what the service itself reports
+    for network_suffix in ('', '-testnet'):
+        bitcoind_status = [s for s in statuses if s['service'] == 'bitcoin' + network_suffix]
+        tip = bitcoind_status[0]['height'] if bitcoind_status else None
+        for status in statuses:
+            if ('-testnet' in status['service']) != bool(network_suffix) or status['height'] is None:
+                continue
+            reference = status['backend_height'] if status['service'].startswith('bitcoin') else (tip or status['backend_height'])
+            if reference is not None:
+                status['lag'] = reference - status['height']
+    return statuses
+
+
+def print_services_status(statuses):
+    print("{:<22} {:<6} {:>9} {:>7} {:>10}  {}".format("SERVICE", "STATE", "HEIGHT", "LAG", "LATENCY", ""))
+    for s in statuses:
+        print("{:<22} {:<6} {:>9} {:>7} {:>8}ms  {}".format(s['service'], "up" if s['up'] else "DOWN",
+            s['height'] if s['height'] is not None else '-', s['lag'] if s['lag'] is not None else '-',
+            s['latency_ms'], s['error'] or ''))
+
+
+def parse_size(size):
+    # docker style sizes, e.g. 30m
+    match = re.match(r'^(\d+(?:\.\d+)?)\s*([kmgt]?)b?$', str(size).strip().lower())
+    if not match:
+        return None
+    return int(float(match.group(1)) * 1024 ** ' kmgt'.index(match.group(2) or ' '))
+
+
+def get_container_metrics(service, log_options, timeout=DOCKER_API_TIMEOUT):
+    # one docker connection per call, so the containers can be queried concurrently
+    client = DockerClient(DOCKER_SOCKET_PATH, timeout=timeout)
+    try:
+        container_name = "federatednode_{}_1".format(service)
+        container_info = client.inspect_container(container_name)
+        if container_info is None:
+            return None
+        metrics = {'running': int(container_info['State']['Running'])}
+        if container_info['State']['Running']:
+            stats = client.request('GET', '/containers/{}/stats'.format(container_name), {'stream': 0, 'one-shot': 1})
+            metrics['cpu_seconds'] = stats['cpu_stats']['cpu_usage']['total_usage'] / 1e9
+            metrics['memory_bytes'] = stats['memory_stats'].get('usage')
+            metrics['memory_limit_bytes'] = stats['memory_stats'].get('limit')
+            for entry in (stats.get('blkio_stats') or {}).get('io_service_bytes_recursive') or []:
+                if entry['op'].lower() in ('read', 'write'):
+                    key = 'io_{}_bytes'.format(entry['op'].lower())
+                    metrics[key] = metrics.get(key, 0) + entry['value']
+            for network in (stats.get('networks') or {}).values():
+                metrics['network_rx_bytes'] = metrics.get('network_rx_bytes', 0) + network['rx_bytes']
+                metrics['network_tx_bytes'] = metrics.get('network_tx_bytes', 0) + network['tx_bytes']
+    finally:
+        client.close()
+
+    # log rotation pressure: how much of the space json-file may keep is used up (needs read access to the logs)
+    try:
+        log_files = get_log_files(container_info['LogPath']) if container_info.get('LogPath') else []
+        metrics['log_bytes'] = sum(os.path.getsize(path) for path in log_files)
+        metrics['log_files'] = len(log_files)
+        max_size, max_file = parse_size(log_options.get('max-size', '')), int(log_options.get('max-file', 1))
+        if max_size:
+            metrics['log_pressure'] = metrics['log_bytes'] / float(max_size * max_file)
+    except OSError:
+        pass
+    return metrics
+
+
+def get_volume_usage(path):
+    stat = os.statvfs(path)
+    return {'size_bytes': stat.f_blocks * stat.f_frsize, 'free_bytes': stat.f_bavail * stat.f_frsize}
+
+
+def format_metric_labels(labels):
+    return "{{{}}}".format(",".join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for key, value in sorted(labels.items()))) if labels else ""
+
+
+class MetricsExporter(object):
+    """Collects the fednode metrics concurrently on a schedule, and renders the last collection in the Prometheus text format"""
+
+    CONTAINER_METRICS = [
+        ('cpu_seconds', 'counter', "Total CPU time used by the container"),
+        ('memory_bytes', 'gauge', "Memory used by the container"),
+        ('memory_limit_bytes', 'gauge', "Memory limit of the container"),
+        ('io_read_bytes', 'counter', "Bytes read from block devices by the container"),
+        ('io_write_bytes', 'counter', "Bytes written to block devices by the container"),
+        ('network_rx_bytes', 'counter', "Bytes received by the container"),
+        ('network_tx_bytes', 'counter', "Bytes sent by the container"),
+        ('log_bytes', 'gauge', "Size of the container's json-file logs, rotations included"),
+        ('log_files', 'gauge', "Number of the container's json-file logs, rotations included"),
+        ('log_pressure', 'gauge', "Share of the json-file log space (max-size x max-file) in use"),
+    ]
+
+    def __init__(self, compose_path, timeout=STATUS_TIMEOUT):
+        model = get_compose_model(compose_path)
+        self.services = list(model['services'].keys())
+        self.log_options = dict((name, ((service.get('logging') or {}).get('options') or {}))
+            for name, service in model['services'].items())
+        self.volumes = ["{}_{}".format(PROJECT_NAME, volume) for volume in model['volumes'] or {}]
+        self.volume_paths = {}
+        self.timeout = timeout
+        self.latency = {}  # service -> [bucket counts..., count, sum], accumulated over the collections
+        self.collections = 0
+        self.errors = 0
+        self.text = ""
+
+    def collect(self):
+        start = time.time()
+        errors = 0
+        if not self.volume_paths and get_docker_client():
+            self.volume_paths = dict((name, path) for name, path in get_docker_volume_paths(self.volumes).items() if path)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.services) + 2) as executor:
+            status_future = executor.submit(get_services_status, self.services, timeout=self.timeout)
+            container_futures = dict((service, executor.submit(get_container_metrics, service, self.log_options[service], self.timeout))
+                for service in self.services) if get_docker_client() else {}
+            volume_futures = dict((volume, executor.submit(get_volume_usage, path)) for volume, path in self.volume_paths.items())
+            statuses = status_future.result()
+            containers, volumes = {}, {}
+            for service, future in container_futures.items():
+                try:
+                    containers[service] = future.result()
+                except (OSError, ValueError, KeyError, http.client.HTTPException, DockerAPIError):
+                    errors += 1
+            for volume, future in volume_futures.items():
+                try:
+                    volumes[volume] = future.result()
+                except OSError:
+                    errors += 1
+
+        for status in statuses:
+            if not status['up']:
+                continue
+            buckets = self.latency.setdefault(status['service'], [0] * (len(EXPORTER_LATENCY_BUCKETS) + 2))
+            latency = status['latency_ms'] / 1000.0
+            for i, bound in enumerate(EXPORTER_LATENCY_BUCKETS):
+                if latency <= bound:
+                    buckets[i] += 1
+            buckets[-2] += 1
+            buckets[-1] += latency
+        self.collections += 1
+        self.errors += errors
+        self.text = self.render(statuses, containers, volumes, time.time() - start)
+
+    def render(self, statuses, containers, volumes, duration):
+        lines = []
+
+        def family(name, metric_type, help_text, samples):
+            lines.append("# HELP fednode_{} {}".format(name, help_text))
+            lines.append("# TYPE fednode_{} {}".format(name, metric_type))
+            for labels, value, suffix in samples:
+                if value is not None:
+                    lines.append("fednode_{}{}{} {}".format(name, suffix, format_metric_labels(labels), value))
+
+        family('service_up', 'gauge', "Whether the service answers its API", [({'service': s['service']}, int(s['up']), '') for s in statuses])
+        family('service_block_height', 'gauge', "Block height the service is at", [({'service': s['service']}, s['height'], '') for s in statuses])
+        family('service_block_lag', 'gauge', "Blocks the service is behind the bitcoind tip", [({'service': s['service']}, s['lag'], '') for s in statuses])
+        samples = []
+        for service, buckets in sorted(self.latency.items()):
+            for bound, count in zip(EXPORTER_LATENCY_BUCKETS, buckets):
+                samples.append(({'service': service, 'le': bound}, count, '_bucket'))
+            samples.append(({'service': service, 'le': '+Inf'}, buckets[-2], '_bucket'))
+            samples.append(({'service': service}, buckets[-2], '_count'))
+            samples.append(({'service': service}, round(buckets[-1], 6), '_sum'))
+        family('service_probe_latency_seconds', 'histogram', "Latency of the periodic service API probes", samples)
+        family('container_running', 'gauge', "Whether the service's container is running",
+            [({'service': service}, metrics['running'], '') for service, metrics in sorted(containers.items()) if metrics])
+        for key, metric_type, help_text in self.CONTAINER_METRICS:
+            name = 'container_{}{}'.format(key, '_total' if metric_type == 'counter' else '')
+            family(name, metric_type, help_text,
+                [({'service': service}, metrics.get(key), '') for service, metrics in sorted(containers.items()) if metrics])
+        family('volume_filesystem_size_bytes', 'gauge', "Size of the filesystem holding the docker volume",
+            [({'volume': volume}, usage['size_bytes'], '') for volume, usage in sorted(volumes.items())])
+        family('volume_filesystem_free_bytes', 'gauge', "Free space on the filesystem holding the docker volume",
+            [({'volume': volume}, usage['free_bytes'], '') for volume, usage in sorted(volumes.items())])
+        family('exporter_collect_duration_seconds', 'gauge', "Time the last collection took", [({}, round(duration, 4), '')])
+        family('exporter_collections_total', 'counter', "Collections made", [({}, self.collections, '')])
+        family('exporter_errors_total', 'counter', "Containers or volumes that couldn't be collected", [({}, self.errors, '')])
+        return "\n".join(lines) + "\n"
+
+    def run(self, interval):
+        # collects on a schedule (so the scrapes cost nothing, however often they come)
+        next_run = time.time() + interval
+        while True:
+            time.sleep(max(0, next_run - time.time()))
+            next_run = time.time() + interval
+            try:
+                self.collect()
+            except Exception as e:
+                self.errors += 1
+                print("Collection failed: {}".format(str(e) or e.__class__.__name__))
+
+
+class ExporterHandler(http.server.BaseHTTPRequestHandler):
+    exporter = None
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.exporter.text.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run_exporter(compose_path, listen, port, interval, timeout=STATUS_TIMEOUT):
+    exporter = MetricsExporter(compose_path, timeout=timeout)
+    if get_docker_client() is None:
+        print("WARNING: can't access the docker daemon socket, so there won't be any container or volume metrics")
+    exporter.collect()
+    collector = threading.Thread(target=exporter.run, args=(interval,), daemon=True)
+    collector.start()
+    handler = type('Handler', (ExporterHandler,), {'exporter': exporter})
+    server = http.server.ThreadingHTTPServer((listen, port), handler)
+    print("Serving metrics on http://{}:{}/metrics (collecting every {}s)".format(listen, port, interval))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def get_startup_stages(services, links):
+    # the services grouped by their depth in the links graph: each stage only links to services of earlier stages
+    depths = {}
+    def depth(service, seen=()):
+        if service not in depths:
+            deps = [dep for dep in links.get(service, []) if dep in services and dep not in seen]
+            depths[service] = 1 + max([depth(dep, seen + (service,)) for dep in deps]) if deps else 0
+        return depths[service]
+    for service in services:
+        depth(service)
+    return [[service for service in services if depths[service] == stage] for stage in range(max(depths.values()) + 1)] if depths else []
+
+
+def set_container_weights(services, weights):
+    # relative CPU and block IO priority (the block IO weight isn't supported everywhere, e.g. without the cfq/bfq scheduler)
+    containers = ' '.join("federatednode_{}_1".format(service) for service in services)
+    if os.system("{} docker update --cpu-shares {} --blkio-weight {} {} > /dev/null 2>&1".format(SUDO_CMD, weights[0], weights[1], containers)):
+        os.system("{} docker update --cpu-shares {} {} > /dev/null".format(SUDO_CMD, weights[0], containers))
+
+
+def staged_start(services, timeout=STARTUP_STAGE_TIMEOUT):
+    # starts the services stage by stage along their links, waiting for each stage's backends to be answering and
+    # synced (with a higher CPU/IO priority while they catch up), so the services downstream don't start before them
+    links = get_compose_links(DOCKER_CONFIG_PATH)
+    for service, dependencies in STARTUP_DEPENDENCIES.items():
+        links[service] = links.get(service, []) + dependencies
+    for service, replicas in get_replica_groups().items():
+        links.update((name, links.get(service, [])) for name in replicas)
+    probed = set(spec[0] for spec in get_status_specs())
+    syncing = set(spec[0] for spec in get_status_specs() if spec[1] != 'http')  # the heavy ones, that catch up with the chain
+    timings = []
+    start = time.time()
+    for stage, stage_services in enumerate(get_startup_stages(services, links)):
+        stage_start = time.time()
+        run_compose_cmd("up -d --no-deps {}".format(' '.join(stage_services)))
+        started = time.time()
+        waiting = [service for service in stage_services if service in probed]
+        ready = True
+        if waiting:
+            print("Stage {}: waiting for {} to be ready...".format(stage + 1, ', '.join(waiting)))
+            catching_up = [service for service in waiting if service in syncing]
+            if catching_up:
+                set_container_weights(catching_up, STARTUP_CATCHUP_WEIGHTS)
+            # the lag is measured against bitcoind, if it's one of ours
+            reference = [service for service in services if service.startswith('bitcoin') and service in probed]
+            while True:
+                statuses = get_services_status(waiting + reference)
+                pending = [s['service'] for s in statuses if s['service'] in waiting and
+                    (not s['up'] or s['lag'] is not None and s['lag'] > STARTUP_MAX_LAG)]
+                if not pending:
+                    break
+                if time.time() - started > timeout:
+                    print("Stage {}: {} not ready after {}s, moving on".format(stage + 1, ', '.join(pending), timeout))
+                    ready = False
+                    break
+                time.sleep(STARTUP_POLL_INTERVAL)
+            if catching_up:
+                set_container_weights(catching_up, STARTUP_DEFAULT_WEIGHTS)
+        timings.append((stage + 1, stage_services, started - stage_start, time.time() - started, ready))
+
+    print("\n{:<6} {:>9} {:>9}  {:<8} {}".format("STAGE", "START", "READY", "", "SERVICES"))
+    for stage, stage_services, start_time, ready_time, ready in timings:
+        print("{:<6} {:>8.1f}s {:>8.1f}s  {:<8} {}".format(stage, start_time, ready_time, "ready" if ready else "TIMEOUT",
+            ', '.join(stage_services)))
+    print("Started in {:.1f}s".format(time.time() - start))
+
+
+class BlockTracer(object):
+    """Times, for each block bitcoind announces, when each stage of the pipeline downstream reports its height"""
+
+    def __init__(self, stage_specs, bitcoind_spec, timeout=TRACE_TIMEOUT):
+        self.stage_specs = stage_specs  # STATUS_SERVICES entries, in pipeline order
+        self.bitcoind_spec = bitcoind_spec
+        self.timeout = timeout
+        self.pending = []  # [block height, block hash, notification time, {stage: time reached}]
+        self.latencies = dict((spec[0], collections.deque(maxlen=TRACE_WINDOW)) for spec in stage_specs)
+        self.totals = collections.deque(maxlen=TRACE_WINDOW)
+        self.traced = 0
+
+    def get_block_height(self, block_hash):
+        service, _, port, config_file = self.bitcoind_spec
+        service_config = read_service_config(*config_file)
+        header = json_rpc_call("http://127.0.0.1:{}/".format(port), 'getblockheader', [block_hash],
+            user=service_config.get('rpcuser'), password=service_config.get('rpcpassword'))
+        return header['height']
+
+    def add_block(self, block_hash, notified):
+        self.pending.append([self.get_block_height(block_hash), block_hash, notified, {}])
+
+    def poll(self):
+        # probes the stages some pending block still has to reach, all at once; returns the blocks done with
+        stages = [spec for spec in self.stage_specs if any(spec[0] not in block[3] for block in self.pending)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(stages), 1)) as executor:
+            heights = dict((status['service'], status['height']) for status in executor.map(
+                lambda spec: probe_service_status(*spec, timeout=STATUS_TIMEOUT), stages))
+        now = time.time()
+        done = []
+        for block in self.pending:
+            for spec in self.stage_specs:
+                if spec[0] not in block[3] and heights.get(spec[0]) is not None and heights[spec[0]] >= block[0]:
+                    block[3][spec[0]] = now
+            if len(block[3]) == len(self.stage_specs) or now - block[2] > self.timeout:
+                done.append(block)
+        for block in done:
+            self.pending.remove(block)
+            self.record(block)
+        return done
+
+    def stage_times(self, block):
+        # the time each stage took, after the one before it (None if it never got there)
+        times, previous = [], block[2]
+        for spec in self.stage_specs:
+            reached = block[3].get(spec[0])
+            times.append(reached - previous if reached is not None and previous is not None else None)
+            previous = reached
+        return times
+
+    def record(self, block):
+        self.traced += 1
+        for spec, seconds in zip(self.stage_specs, self.stage_times(block)):
+            if seconds is not None:
+                self.latencies[spec[0]].append(seconds)
+        if len(block[3]) == len(self.stage_specs):
+            self.totals.append(max(block[3].values()) - block[2])
+
+    def print_block(self, block):
+        times = self.stage_times(block)
+        slowest = max(range(len(times)), key=lambda i: times[i] if times[i] is not None else float('inf')) if times else None
+        print("block {} ({}...): {}".format(block[0], block[1][:16], ', '.join("{} {}{}".format(spec[0],
+            "{:.2f}s".format(seconds) if seconds is not None else "TIMEOUT", " <- slowest" if i == slowest else "")
+            for i, (spec, seconds) in enumerate(zip(self.stage_specs, times)))))
+
+    def print_summary(self):
+        print("\nOver the last {} block(s):".format(min(self.traced, TRACE_WINDOW)))
+        print("{:<24} {:>8} {:>8} {:>8}  {}".format("STAGE", "P50", "P95", "MAX",
+            "HISTOGRAM (<= {}s, more)".format(', '.join(str(bound) for bound in TRACE_BUCKETS))))
+        medians = {}
+        for spec in self.stage_specs:
+            values = sorted(self.latencies[spec[0]])
+            if not values:
+                print("{:<24} {:>8}".format(spec[0], '-'))
+                continue
+            medians[spec[0]] = percentile(values, 50)
+            counts = [0] * (len(TRACE_BUCKETS) + 1)
+            for value in values:
+                counts[bisect.bisect_left(TRACE_BUCKETS, value)] += 1
+            print("{:<24} {:>7.2f}s {:>7.2f}s {:>7.2f}s  {}".format(spec[0], medians[spec[0]], percentile(values, 95), values[-1],
+                ' '.join(str(count) for count in counts)))
+        if self.totals:
+            totals = sorted(self.totals)
+            print("{:<24} {:>7.2f}s {:>7.2f}s {:>7.2f}s".format("end to end", percentile(totals, 50), percentile(totals, 95), totals[-1]))
+        if medians:
+            print("Slowest stage: {}".format(max(medians, key=medians.get)))
+
+
+def trace_blocks(network, zmq_url=None, count=None, timeout=TRACE_TIMEOUT, services=None):
+    if zmq is None:
+        print("trace-blocks needs the pyzmq module (pip3 install pyzmq)")
+        return False
+    suffix = '-testnet' if network == 'testnet' else ''
+    specs = dict((spec[0], spec) for spec in STATUS_SERVICES)
+    stage_specs = [specs[stage + suffix] for stage in TRACE_STAGES if services is None or stage + suffix in services]
+    tracer = BlockTracer(stage_specs, specs['bitcoin' + suffix], timeout)
+
+    context = zmq.Context()
+    socket_ = context.socket(zmq.SUB)
+    socket_.setsockopt(zmq.SUBSCRIBE, b'hashblock')
+    socket_.connect(zmq_url or TRACE_ZMQ_URLS[network])
+    poller = zmq.Poller()
+    poller.register(socket_, zmq.POLLIN)
+    print("Tracing the new {} blocks through {} (Ctrl-C to stop)...".format(network, ' -> '.join(spec[0] for spec in stage_specs)))
+    try:
+        while count is None or tracer.traced < count:
+            # wait for a notification, but no longer than until the next poll of the stages if blocks are pending
+            events = dict(poller.poll(TRACE_POLL_INTERVAL * 1000 if tracer.pending else 1000))
+            while events.get(socket_):
+                topic, body = socket_.recv_multipart()[:2]
+                try:
+                    tracer.add_block(body.hex(), time.time())
+                except Exception as e:
+                    print("Couldn't get the height of block {}: {}".format(body.hex(), str(e) or e.__class__.__name__))
+                events = dict(poller.poll(0))
+            if tracer.pending:
+                for block in tracer.poll():
+                    tracer.print_block(block)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        socket_.close(linger=0)
+        context.term()
+    tracer.print_summary()
+    return True
+
+
+class BenchStubHandler(http.server.BaseHTTPRequestHandler):
+    # answers any JSON-RPC call or GET with a canned reply, after an optional delay
+    delay = 0.0
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, body):
+        time.sleep(self.delay)
+        body = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+        self._reply({'result': [], 'error': None, 'id': request.get('id')})
+
+    def do_GET(self):
+        self._reply([])
+
+
+def start_bench_stub(delay=0.0):
+    handler = type('BenchStubHandler', (BenchStubHandler,), {'delay': delay})
+    server_class = type('BenchStubServer', (http.server.ThreadingHTTPServer,), {'daemon_threads': True, 'request_queue_size': 128})
+    server = server_class(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def parse_bench_mix(mix):
+    weights = []
+    for entry in mix.split(','):
+        name, _, weight = entry.strip().partition('=')
+        if name not in BENCH_CALLS:
+            raise ValueError("Unknown bench call: {}".format(name))
+        weights.append((name, int(weight or 1)))
+    return weights
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, max(0, int(round(pct / 100.0 * len(sorted_values))) - 1))]
+
+
+def latency_summary(latencies):
+    latencies = sorted(latencies)
+    return dict(('p{}'.format(pct), round(percentile(latencies, pct) * 1000, 2) if latencies else None) for pct in (50, 95, 99))
+
+
+def make_bench_call(name, targets, address, timeout):
+    backend, method, params = BENCH_CALLS[name]
+    url, user, password = targets[backend]
+    if backend == 'http-addrindexrs':
+        with urllib.request.urlopen(url + method.format(address=address), timeout=timeout) as response:
+            response.read()
+    else:
+        params = json.loads(json.dumps(params).replace('{address}', address))
+        json_rpc_call(url, method, params, user=user, password=password, timeout=timeout)
+
+
+def run_bench(mix, concurrency_levels, num_requests, targets, address, timeout=30.0, seed=0):
+    names = [name for name, weight in mix for i in range(weight)]
+    rng = random.Random(seed)
+    calls = [rng.choice(names) for i in range(num_requests)]
+
+    def timed_call(name):
+        start = time.perf_counter()
+        try:
+            make_bench_call(name, targets, address, timeout)
+            error = None
+        except Exception as e:
+            error = str(e) or e.__class__.__name__
+        return name, time.perf_counter() - start, error
+
+    levels = []
+    for concurrency in concurrency_levels:
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(timed_call, calls))
+        duration = time.perf_counter() - start
+
+        level = {'concurrency': concurrency, 'requests': len(results), 'duration': round(duration, 3),
+            'throughput': round(len(results) / duration, 2) if duration else None,
+            'errors': sum(1 for r in results if r[2]), 'calls': {}}
+        level['error_rate'] = round(level['errors'] / float(len(results)), 4) if results else 0.0
+        level.update(latency_summary([r[1] for r in results if not r[2]]))
+        for name in sorted(set(calls)):
+            call_results = [r for r in results if r[0] == name]
+            level['calls'][name] = {'requests': len(call_results), 'errors': sum(1 for r in call_results if r[2])}
+            level['calls'][name].update(latency_summary([r[1] for r in call_results if not r[2]]))
+            call_errors = [r[2] for r in call_results if r[2]]
+            if call_errors:
+                level['calls'][name]['last_error'] = call_errors[-1]
+        levels.append(level)
+    return levels
+
+
+def save_bench_results(path, levels, **info):
+    results = {'timestamp': datetime.now(timezone.utc).isoformat(), 'hostname': socket.gethostname()}
+    results.update(info)
+    results['levels'] = levels
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+def load_bench_results(path):
+    with open(path) as f:
+        return json.load(f)['levels']
+
+
+def print_bench_results(levels, previous_levels=None):
+    previous = dict((l['concurrency'], l) for l in previous_levels or [])
+    for level in levels:
+        print("\nconcurrency {concurrency}: {requests} requests in {duration}s, {throughput} req/s, {errors} errors ({error_rate:.2%})".format(**level))
+        print("  {:<34} {:>8} {:>7} {:>10} {:>10} {:>10}".format("CALL", "REQS", "ERRORS", "P50 (ms)", "P95 (ms)", "P99 (ms)"))
+        for name, c in sorted(level['calls'].items()):
+            print("  {:<34} {:>8} {:>7} {:>10} {:>10} {:>10}".format(name, c['requests'], c['errors'], c['p50'], c['p95'], c['p99']))
+        print("  {:<34} {:>8} {:>7} {:>10} {:>10} {:>10}".format("all", level['requests'], level['errors'], level['p50'], level['p95'], level['p99']))
+        if level['concurrency'] in previous:
+            before = previous[level['concurrency']]
+            print("  compared to previous run: throughput {} -> {} req/s, p95 {} -> {} ms, errors {} -> {}".format(
+                before['throughput'], level['throughput'], before['p95'], level['p95'], before['errors'], level['errors']))
+
+
+def get_container_log_path(service):
+    container_name = "federatednode_{}_1".format(service)
+    client = get_docker_client()
+    if client:
+        container_info = client.inspect_container(container_name)
+        return (container_info.get('LogPath') or None) if container_info else None
+    try:
+        return subprocess.check_output('{} docker inspect --format="{{{{ .LogPath }}}}" {}'.format(SUDO_CMD, container_name),
+            shell=True, stderr=subprocess.DEVNULL).decode("utf-8").strip() or None
+    except subprocess.CalledProcessError:
+        return None
+
+
+def get_log_files(log_path):
+    # the json-file log and its rotations, oldest first
+    rotated = [p for p in glob.glob(log_path + '.*') if p.rsplit('.', 1)[1].isdigit()]
+    rotated.sort(key=lambda p: int(p.rsplit('.', 1)[1]), reverse=True)
+    return rotated + ([log_path] if os.path.exists(log_path) else [])
+
+
+def format_size(size):
+    for unit in ['B', 'K', 'M', 'G', 'T']:
+        if abs(size) < 1024 or unit == 'T':
+            return "{:.1f}{}".format(size, unit) if unit != 'B' else "{}B".format(int(size))
+        size /= 1024.0
+
+
+def scan_directory(path):
+    # one directory's files (in allocated bytes, like du) and its subdirectories, without following symlinks
+    size, files, subdirs, inodes = os.lstat(path).st_blocks * 512, 0, [], []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                    continue
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            if st.st_nlink > 1:
+                inodes.append(((st.st_dev, st.st_ino), st.st_blocks * 512))
+            else:
+                size += st.st_blocks * 512
+            files += 1
+    return size, files, subdirs, inodes
+
+
+def scan_disk_usage(paths, jobs=DU_JOBS):
+    # walks all the trees at once on one thread pool, one directory per task, so a big volume doesn't hold up the
+    # others and the disk always has requests queued; sizes are broken down by the first level subdirectories
+    usage = dict((name, {'bytes': 0, 'files': 0, 'errors': 0, 'subdirs': {}}) for name in paths)
+    seen_inodes = set()  # hard links are counted once
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        pending = dict((executor.submit(scan_directory, path), (name, None)) for name, path in paths.items())
+        while pending:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name, subdir = pending.pop(future)
+                try:
+                    size, files, subdirs, inodes = future.result()
+                except OSError:
+                    usage[name]['errors'] += 1
+                    continue
+                for inode, inode_size in inodes:
+                    if inode not in seen_inodes:
+                        seen_inodes.add(inode)
+                        size += inode_size
+                usage[name]['bytes'] += size
+                usage[name]['files'] += files
+                key = subdir if subdir is not None else '.'
+                usage[name]['subdirs'][key] = usage[name]['subdirs'].get(key, 0) + size
+                for path in subdirs:
+                    pending[executor.submit(scan_directory, path)] = (name, subdir if subdir is not None else os.path.basename(path))
+    return usage
+
+
+def get_filesystem_usage(paths):
+    # the filesystems the paths are on, by device
+    filesystems = {}
+    for name, path in paths.items():
+        try:
+            st, stat = os.stat(path), os.statvfs(path)
+        except OSError:
+            continue
+        filesystem = filesystems.setdefault(str(st.st_dev), {'size_bytes': stat.f_blocks * stat.f_frsize,
+            'used_bytes': (stat.f_blocks - stat.f_bfree) * stat.f_frsize, 'free_bytes': stat.f_bavail * stat.f_frsize,
+            'mount': get_mount_point(path), 'names': []})
+        filesystem['names'].append(name)
+    return filesystems
+
+
+def get_mount_point(path):
+    path = os.path.realpath(path)
+    while not os.path.ismount(path):
+        path = os.path.dirname(path)
+    return path
+
+
+def get_disk_usage(volume_paths, log_paths, jobs=DU_JOBS):
+    # the volume trees, the json-file logs (and their rotations) and the filesystems they are on
+    start = time.time()
+    usage = {'volumes': scan_disk_usage(volume_paths, jobs), 'logs': {}}
+    for service, log_path in log_paths.items():
+        log_files = get_log_files(log_path)
+        usage['logs'][service] = {'bytes': sum(os.stat(path).st_blocks * 512 for path in log_files), 'files': len(log_files)}
+    usage['filesystems'] = get_filesystem_usage(dict(list(volume_paths.items()) +
+        [('logs:' + service, os.path.dirname(path)) for service, path in log_paths.items()]))
+    usage['elapsed'] = time.time() - start
+    return usage
+
+
+def save_disk_usage(volume_paths, log_paths, jobs, output_path):
+    # for run_privileged, as the volumes and logs are only readable by root
+    with open(output_path, 'w') as f:
+        json.dump(get_disk_usage(volume_paths, log_paths, jobs), f)
+
+
+def update_du_history(usage, history_path=DU_HISTORY_PATH):
+    # appends this scan to the history, and returns the growth (bytes per second) of each volume, the logs and
+    # each filesystem over the last DU_GROWTH_WINDOW, compared to the oldest scan in that window
+    try:
+        with open(history_path) as f:
+            history = json.load(f)
+    except (OSError, ValueError):
+        history = []
+    now = time.time()
+    entry = {'time': now, 'volumes': dict((name, volume['bytes']) for name, volume in usage['volumes'].items()),
+        'logs': sum(log['bytes'] for log in usage['logs'].values()),
+        'filesystems': dict((dev, fs['used_bytes']) for dev, fs in usage['filesystems'].items())}
+    window = [e for e in history if now - e['time'] <= DU_GROWTH_WINDOW and now - e['time'] >= DU_GROWTH_MIN_SPAN]
+    growth = None
+    if window:
+        oldest = window[0]
+        span = now - oldest['time']
+        growth = {'span': span, 'logs': (entry['logs'] - oldest['logs']) / span,
+            'volumes': dict((name, (size - oldest['volumes'][name]) / span) for name, size in entry['volumes'].items()
+                if name in oldest['volumes']),
+            'filesystems': dict((dev, (used - oldest['filesystems'][dev]) / span) for dev, used in entry['filesystems'].items()
+                if dev in oldest['filesystems'])}
+    history = (history + [entry])[-DU_HISTORY_MAX:]
+    with open(history_path + '.tmp', 'w') as f:
+        json.dump(history, f)
+    os.rename(history_path + '.tmp', history_path)
+    return growth
+
+
+def print_disk_usage(usage, growth, log_options):
+    def per_day(rate):
+        return "{}{}/day".format('+' if rate >= 0 else '-', format_size(abs(rate) * 86400)) if rate is not None else '-'
+    volume_growth = (growth or {}).get('volumes', {})
+    print("{:<40} {:>9} {:>10} {:>14}".format("VOLUME", "SIZE", "FILES", "GROWTH"))
+    for name, volume in sorted(usage['volumes'].items(), key=lambda item: -item[1]['bytes']):
+        print("{:<40} {:>9} {:>10} {:>14}{}".format(name, format_size(volume['bytes']), volume['files'],
+            per_day(volume_growth.get(name)), "  ({} unreadable directories)".format(volume['errors']) if volume['errors'] else ""))
+        for subdir, size in sorted(volume['subdirs'].items(), key=lambda item: -item[1]):
+            if size * 100 >= volume['bytes'] and size:  # leave out the ones under 1%
+                print("  {:<38} {:>9}".format(subdir if subdir != '.' else '(files)', format_size(size)))
+    if usage['logs']:
+        print("{:<40} {:>9} {:>10} {:>14}".format("LOGS", format_size(sum(log['bytes'] for log in usage['logs'].values())),
+            sum(log['files'] for log in usage['logs'].values()), per_day((growth or {}).get('logs'))))
+        for service, log in sorted(usage['logs'].items(), key=lambda item: -item[1]['bytes']):
+            options = log_options.get(service) or {}
+            max_size = parse_size(options['max-size']) * int(options.get('max-file', 1)) if options.get('max-size') else None
+            print("  {:<38} {:>9}{}".format(service, format_size(log['bytes']),
+                " of {} max".format(format_size(max_size)) if max_size else " (unbounded)"))
+    print("")
+    for dev, filesystem in usage['filesystems'].items():
+        rate = (growth or {}).get('filesystems', {}).get(dev)
+        if rate is None:
+            forecast = "no growth rate yet (run du again in an hour or more)"
+        elif rate <= 0:
+            forecast = "not growing"
+        else:
+            forecast = "full in ~{:.1f} days at {}".format(filesystem['free_bytes'] / rate / 86400, per_day(rate))
+        print("Filesystem {}: {} of {} used, {} free; {}".format(filesystem['mount'], format_size(filesystem['used_bytes']),
+            format_size(filesystem['size_bytes']), format_size(filesystem['free_bytes']), forecast))
+    print("Scanned {} files in {:.1f}s".format(sum(volume['files'] for volume in usage['volumes'].values()), usage['elapsed']))
+
+
+def show_disk_usage(compose_path, jobs=DU_JOBS, as_json=False, keep_history=True):
+    model = get_compose_model(compose_path)
+    volume_names = ["{}_{}".format(PROJECT_NAME, volume) for volume in model['volumes'] or {}]
+    volume_paths = dict((name[len(PROJECT_NAME) + 1:], path) for name, path in get_docker_volume_paths(volume_names).items() if path)
+    if not volume_paths:
+        print("None of the fednode docker volumes seem to exist")
+        sys.exit(1)
+    services = expand_replica_groups(list(model['services'].keys()))
+    log_paths = dict((service, path) for service, path in zip(services, map(get_container_log_path, services)) if path)
+    log_options = dict((name, (service.get('logging') or {}).get('options') or {}) for name, service in model['services'].items())
+
+    readable = all(os.access(path, os.R_OK | os.X_OK) for path in list(volume_paths.values()) +
+        [os.path.dirname(path) for path in log_paths.values()])
+    if readable:
+        usage = get_disk_usage(volume_paths, log_paths, jobs)
+    else:
+        # the volumes and logs belong to root: scan them as root, into a file of ours
+        fd, output_path = tempfile.mkstemp(prefix='.fednode-du.', dir=SCRIPTDIR)
+        os.close(fd)
+        try:
+            if not run_privileged('save_disk_usage', volume_paths, log_paths, jobs, output_path):
+                print("Couldn't scan the docker volumes")
+                sys.exit(1)
+            with open(output_path) as f:
+                usage = json.load(f)
+        finally:
+            os.remove(output_path)
+
+    growth = update_du_history(usage) if keep_history else None
+    if as_json:
+        print(json.dumps(dict(usage, growth=growth), indent=2))
+    else:
+        print_disk_usage(usage, growth, log_options)
+
+
+def parse_docker_time(timestamp):
+    # RFC 3339 with up to nanoseconds, always UTC
+    seconds = datetime.fromisoformat(timestamp[:19]).replace(tzinfo=timezone.utc).timestamp()
+    fraction = timestamp[19:].rstrip('Z').split('+')[0]
+    return seconds + float('0' + fraction) if fraction.startswith('.') else seconds
+
+
+def parse_log_time_arg(value):
+    match = re.match(r'^(\d+(?:\.\d+)?)([smhd])$', value.strip())
+    if match:
+        return time.time() - float(match.group(1)) * {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[match.group(2)]
+    t = datetime.fromisoformat(value.strip().replace('Z', '+00:00'))
+    return (t if t.tzinfo else t.astimezone()).timestamp()
+
+
+def parse_log_line(raw_line):
+    # a json-file log line, as (time, text), or None if it's garbled (e.g. partially written)
+    try:
+        entry = json.loads(raw_line)
+        return parse_docker_time(entry['time']), entry['log'].rstrip('\n')
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def make_log_matcher(pattern=None, level=None):
+    regex = re.compile(pattern) if pattern else None
+    min_level = LOG_LEVELS.index(level) if level else None
+
+    def matches(text):
+        if regex and not regex.search(text):
+            return False
+        if min_level is not None:
+            level_match = LOG_LEVEL_RE.search(text)
+            if not level_match:
+                return False
+            line_level = 'WARNING' if level_match.group(1) == 'WARN' else level_match.group(1)
+            return LOG_LEVELS.index(line_level) >= min_level
+        return True
+    return matches
+
+
+def read_lines_backwards(path, end_offset=None):
+    # yields the lines of the file (up to end_offset, which must be at a line start) from last to first,
+    # memory mapping it so only the pages we touch get read in
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return
+        with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mm:
+            # end is the position of the newline ending the next line to yield (skipping a partially written last line)
+            if end_offset is not None and end_offset < size:
+                end = end_offset - 1
+            else:
+                end = size - 1 if mm[size - 1:size] == b'\n' else mm.rfind(b'\n')
+            while end >= 0:
+                start = mm.rfind(b'\n', 0, end) + 1
+                yield mm[start:end]
+                end = start - 1
+
+
+def log_file_identity(path, st):
+    # survives the renames of log rotation, but not the file being replaced or truncated
+    with open(path, 'rb') as f:
+        first_line = f.readline(4096)
+    return [st.st_dev, st.st_ino, hashlib.sha1(first_line).hexdigest() if first_line.endswith(b'\n') else None]
+
+
+def index_log_file(path, file_index):
+    # extends the sparse (time, offset) index of a log file, by sampling a line every LOG_INDEX_INTERVAL bytes
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        points = file_index['points']
+        offset = points[-1][1] + LOG_INDEX_INTERVAL if points else 0
+        while offset < size:
+            f.seek(offset)
+            if offset:
+                f.readline()  # skip to the start of the next line
+            line_offset = f.tell()
+            entry = parse_log_line(f.readline())
+            if entry is not None and (not points or line_offset > points[-1][1]):
+                points.append([entry[0], line_offset])
+            offset += LOG_INDEX_INTERVAL
+    last_entry = None
+    for raw_line in read_lines_backwards(path):
+        last_entry = parse_log_line(raw_line)
+        if last_entry is not None:
+            break
+    file_index['size'] = size
+    file_index['first_time'] = points[0][0] if points else None
+    file_index['last_time'] = last_entry[0] if last_entry else file_index['first_time']
+
+
+def get_log_index(service, log_path):
+    # maps each of the log files of a service to its sparse time index, kept up to date incrementally and persisted
+    index_path = os.path.join(LOG_INDEX_DIR, "{}.json".format(service))
+    try:
+        with open(index_path) as f:
+            index = json.load(f)
+        if index.get('version') != LOG_INDEX_VERSION or index.get('log_path') != log_path:
+            index = None
+    except (OSError, ValueError):
+        index = None
+    index = index or {'version': LOG_INDEX_VERSION, 'log_path': log_path, 'files': []}
+
+    files, changed = [], False
+    for path in get_log_files(log_path):
+        try:
+            st = os.stat(path)
+            identity = log_file_identity(path, st)
+        except FileNotFoundError:
+            continue
+        file_index = [fi for fi in index['files'] if fi['identity'] == identity and identity[2] is not None]
+        file_index = file_index[0] if file_index else None
+        if file_index is None or file_index['size'] > st.st_size:
+            # new file, or rotated/truncated in a way we can't follow: (re)build its index
+            file_index = {'identity': identity, 'size': 0, 'points': [], 'first_time': None, 'last_time': None}
+        if file_index['size'] != st.st_size:
+            index_log_file(path, file_index)
+            changed = True
+        changed = changed or file_index.get('path') != path
+        file_index['path'] = path
+        files.append(file_index)
+    changed = changed or len(files) != len(index['files'])
+    index['files'] = files
+
+    if changed:
+        try:
+            if not os.path.exists(LOG_INDEX_DIR):
+                os.makedirs(LOG_INDEX_DIR)
+            with open(index_path + '.tmp', 'w') as f:
+                json.dump(index, f)
+            os.replace(index_path + '.tmp', index_path)
+        except OSError:
+            pass  # the index is just an optimization
+    return dict((fi['path'], fi) for fi in files)
+
+
+def log_index_start_offset(file_index, since):
+    # offset of an indexed line no later than since
+    times = [p[0] for p in file_index['points']]
+    i = bisect.bisect_left(times, since) - 1
+    return file_index['points'][i][1] if i >= 0 else 0
+
+
+def log_index_end_offset(file_index, until):
+    # offset of an indexed line later than until (or None)
+    times = [p[0] for p in file_index['points']]
+    i = bisect.bisect_right(times, until)
+    return file_index['points'][i][1] if i < len(times) else None
+
+
+def read_log_entries(log_path, since=None, until=None, matcher=None, index=None):
+    # all the (time, text) entries of a container log, oldest first
+    for path in get_log_files(log_path):
+        file_index = (index or {}).get(path)
+        offset = 0
+        if file_index and file_index['last_time'] is not None:
+            if since is not None and file_index['last_time'] < since:
+                continue  # the whole file is too old
+            if until is not None and file_index['first_time'] is not None and file_index['first_time'] > until:
+                return
+            if since is not None:
+                offset = log_index_start_offset(file_index, since)
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            continue  # rotated away under us
+        with f:
+            f.seek(offset)
+            for raw_line in f:
+                entry = parse_log_line(raw_line)
+                if entry is None or (since is not None and entry[0] < since):
+                    continue
+                if until is not None and entry[0] > until:
+                    return
+                if matcher is None or matcher(entry[1]):
+                    yield entry
+
+
+def tail_log_entries(log_path, num_lines, since=None, until=None, matcher=None, index=None):
+    # the last num_lines (time, text) entries of a container log, oldest first
+    entries = collections.deque(maxlen=num_lines)
+    if num_lines <= 0:
+        return entries
+    for path in reversed(get_log_files(log_path)):
+        file_index = (index or {}).get(path)
+        end_offset = None
+        if file_index and file_index['last_time'] is not None:
+            if since is not None and file_index['last_time'] < since:
+                return entries  # this and all the older files are too old
+            if until is not None and file_index['first_time'] is not None and file_index['first_time'] > until:
+                continue
+            if until is not None:
+                end_offset = log_index_end_offset(file_index, until)
+        try:
+            lines = read_lines_backwards(path, end_offset)
+            for raw_line in lines:
+                entry = parse_log_line(raw_line)
+                if entry is None or (until is not None and entry[0] > until):
+                    continue
+                if since is not None and entry[0] < since:
+                    return entries
+                if matcher is None or matcher(entry[1]):
+                    entries.appendleft(entry)
+                    if len(entries) == num_lines:
+                        return entries
+        except FileNotFoundError:
+            continue
+    return entries
+
+
+def follow_log_entries(log_paths, until=None, matcher=None, interval=LOG_FOLLOW_INTERVAL):
+    # yields (time, service, text) as lines get appended to the services' current logs, following rotations
+    positions = {}
+    for service, log_path in log_paths.items():
+        try:
+            st = os.stat(log_path)
+            positions[service] = (st.st_ino, st.st_size)
+        except FileNotFoundError:
+            positions[service] = (None, 0)
+    partial = dict((service, b'') for service in log_paths)
+    while True:
+        batch = []
+        for service, log_path in log_paths.items():
+            inode, offset = positions[service]
+            try:
+                f = open(log_path, 'rb')
+            except FileNotFoundError:
+                continue
+            with f:
+                st = os.fstat(f.fileno())
+                if st.st_ino != inode or st.st_size < offset:
+                    # rotated: whatever was left in the old file is in <log>.1 now
+                    if inode is not None and os.path.exists(log_path + '.1'):
+                        with open(log_path + '.1', 'rb') as old:
+                            old.seek(offset)
+                            partial[service] += old.read()
+                    inode, offset = st.st_ino, 0
+                f.seek(offset)
+                data = partial[service] + f.read()
+                offset = f.tell()
+            positions[service] = (inode, offset)
+            lines = data.split(b'\n')
+            partial[service] = lines.pop()
+            for raw_line in lines:
+                entry = parse_log_line(raw_line)
+                if entry and (matcher is None or matcher(entry[1])):
+                    batch.append((entry[0], service, entry[1]))
+        for entry in sorted(batch):
+            if until is not None and entry[0] > until:
+                return
+            yield entry
+        time.sleep(interval)
+
+
+def merge_log_entries(service_entries):
+    # merges per service (time, text) streams into one (time, service, text) stream, by time
+    def label(service, entries):
+        for t, text in entries:
+            yield t, service, text
+    return heapq.merge(*[label(service, entries) for service, entries in service_entries.items()], key=lambda entry: entry[0])
+
+
+def print_log_entry(entry, service_width, timestamps=False):
+    t, service, text = entry
+    prefix = "{:<{}} | ".format(service, service_width)
+    if timestamps:
+        prefix += datetime.fromtimestamp(t, timezone.utc).isoformat(timespec='microseconds') + ' '
+    print(prefix + text)
+
+
+def show_logs(services, num_lines=None, follow=False, since=None, until=None, matcher=None, timestamps=False):
+    # returns False if the logs of the services can't be read directly (so the caller should fall back to docker-compose)
+    log_paths = {}
+    for service in services:
+        log_path = get_container_log_path(service)
+        if log_path is None or not os.access(os.path.dirname(log_path), os.R_OK | os.X_OK) or \
+                not all(os.access(p, os.R_OK) for p in get_log_files(log_path)):
+            return False
+        log_paths[service] = log_path
+    service_width = max([len(s) for s in services] + [1])
+
+    # a time window can be seeked to through the services' (incrementally updated) log indexes
+    indexes = dict((s, get_log_index(s, p) if since or until else None) for s, p in log_paths.items())
+    if num_lines is not None:
+        service_entries = dict((s, tail_log_entries(p, num_lines, since, until, matcher, indexes[s])) for s, p in log_paths.items())
+    else:
+        service_entries = dict((s, read_log_entries(p, since, until, matcher, indexes[s])) for s, p in log_paths.items())
+    try:
+        for entry in merge_log_entries(service_entries):
+            print_log_entry(entry, service_width, timestamps)
+        sys.stdout.flush()
+        if follow:
+            for entry in follow_log_entries(log_paths, until, matcher):
+                print_log_entry(entry, service_width, timestamps)
+                sys.stdout.flush()
+    except (KeyboardInterrupt, BrokenPipeError):
+        pass
+    return True
+
+
+def http_range_request(url, start=None, end=None, etag=None, timeout=60):
+    request = urllib.request.Request(url)
+    if start is not None:
+        request.add_header('Range', "bytes={}-{}".format(start, end if end is not None else ''))
+        if etag:
+            request.add_header('If-Range', etag)  # so we never splice ranges of two different versions of the file
+    return urllib.request.urlopen(request, timeout=timeout)
+
+
+def fetch_range(url, start, end, etag=None, retries=BOOTSTRAP_RETRIES):
+    # the bytes start..end (inclusive) of url, picking up where it left off if the connection breaks
+    data = bytearray()
+    for attempt in range(retries + 1):
+        try:
+            with http_range_request(url, start + len(data), end, etag) as response:
+                if response.status != 206:
+                    raise RuntimeError("Server ignored the range request (the file may have changed)")
+                while True:
+                    block = response.read(65536)
+                    if not block:
+                        break
+                    data += block
+            if len(data) == end - start + 1:
+                return bytes(data)
+            raise IOError("Short read")
+        except (OSError, http.client.HTTPException):
+            if attempt == retries:
+                raise
+            time.sleep(min(2 ** attempt, 30))
+
+
+def iter_download(url, jobs=BOOTSTRAP_JOBS, chunk_size=BOOTSTRAP_CHUNK_SIZE * 1024 ** 2):
+    # yields the file in order, while fetching up to 2 * jobs chunks of it ahead concurrently (so memory use stays bounded)
+    with http_range_request(url, 0, 0) as response:
+        ranged = response.status == 206
+        content_range = response.headers.get('Content-Range', '')
+        size = int(content_range.rsplit('/', 1)[1]) if ranged and '/' in content_range else int(response.headers.get('Content-Length') or 0)
+        etag = response.headers.get('ETag')
+        if not ranged:
+            # no range support, so just stream it
+            yield size, None
+            while True:
+                block = response.read(chunk_size)
+                if not block:
+                    return
+                yield size, block
+    yield size, None
+
+    ranges = [(start, min(start + chunk_size, size) - 1) for start in range(0, size, chunk_size)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        pending = collections.deque()
+        for start, end in ranges:
+            pending.append(executor.submit(fetch_range, url, start, end, etag))
+            if len(pending) >= 2 * jobs:
+                yield size, pending.popleft().result()
+        while pending:
+            yield size, pending.popleft().result()
+
+
+def get_checksum_algorithm(digest):
+    return {32: 'md5', 40: 'sha1', 64: 'sha256'}.get(len(digest))
+
+
+def bootstrap(url, volume_path, expected_digest=None, jobs=BOOTSTRAP_JOBS, chunk_size=BOOTSTRAP_CHUNK_SIZE, force=False):
+    # streams the archive through the checksum and straight into tar, extracting into a staging dir in the volume
+    # that's only moved into place once the checksum has been verified
+    tar_flag = {'.gz': 'z', '.tgz': 'z', '.bz2': 'j', '.xz': 'J'}.get(os.path.splitext(urllib.parse.urlparse(url).path)[1], '')
+    staging_path = os.path.join(volume_path, BOOTSTRAP_STAGING_DIR)
+    hasher = hashlib.new(get_checksum_algorithm(expected_digest) if expected_digest else 'sha256')
+    os.system("{} bash -c \"rm -rf {} && mkdir -p {}\"".format(SUDO_CMD, staging_path, staging_path))
+    tar = subprocess.Popen("{} tar -x{}f - -C {}".format(SUDO_CMD, tar_flag, staging_path), shell=True, stdin=subprocess.PIPE)
+
+    start, done, ok = time.time(), 0, False
+    try:
+        for size, block in iter_download(url, jobs=jobs, chunk_size=chunk_size * 1024 ** 2):
+            if block is None:
+                print("Downloading {} ({:.1f} GB) with {} concurrent ranges...".format(url, size / 1024.0 ** 3, jobs))
+                continue
+            hasher.update(block)
+            tar.stdin.write(block)
+            done += len(block)
+            elapsed = max(time.time() - start, 0.001)
+            eta = (size - done) / (done / elapsed) if size else 0
+            sys.stdout.write("\r  {:.1f}/{:.1f} GB  {:.1f} MB/s  ETA {:d}:{:02d}   ".format(done / 1024.0 ** 3,
+                size / 1024.0 ** 3, done / elapsed / 1024 ** 2, int(eta // 60), int(eta % 60)))
+            sys.stdout.flush()
+        tar.stdin.close()
+        ok = tar.wait() == 0
+        print("")
+        if not ok:
+            print("Extracting the bootstrap archive failed")
+        elif expected_digest and hasher.hexdigest() != expected_digest.lower():
+            print("Checksum mismatch: expected {} {}, got {}".format(hasher.name, expected_digest, hasher.hexdigest()))
+            ok = False
+        else:
+            print("Downloaded and extracted in {:.0f}s, {} {}".format(time.time() - start, hasher.name, hasher.hexdigest()))
+    except (KeyboardInterrupt, Exception) as e:
+        # (there's no resuming: tar's and the checksum's state can't be saved, and we keep no copy of the archive)
+        print("\nBootstrap failed: {} (run it again to start over)".format(str(e) or e.__class__.__name__))
+        tar.kill()
+    finally:
+        if not ok:
+            os.system("{} rm -rf {}".format(SUDO_CMD, staging_path))
+    if not ok:
+        return False
+
+    # move the extracted files into place
+    staged = subprocess.check_output("{} ls -A {}".format(SUDO_CMD, staging_path), shell=True).decode("utf-8").split()
+    existing = [name for name in staged if os.path.lexists(os.path.join(volume_path, name))]
+    if existing and not force:
+        print("Not replacing the existing {} (use --force)".format(', '.join(existing)))
+        os.system("{} rm -rf {}".format(SUDO_CMD, staging_path))
+        return False
+    for name in staged:
+        os.system("{} bash -c \"rm -rf {} && mv {} {}\"".format(SUDO_CMD, os.path.join(volume_path, name),
+            os.path.join(staging_path, name), volume_path))
+    os.system("{} rm -rf {}".format(SUDO_CMD, staging_path))
+    print("Installed {} into {}".format(', '.join(staged), volume_path))
+    return True
+
+
+def run_privileged(func_name, *args):
+    # runs one of the functions of this script as root (for the files in the docker volumes); returns False if it failed
+    if IS_WINDOWS or os.geteuid() == 0:
+        return globals()[func_name](*args) is not False
+    code = "import sys, json; sys.path.insert(0, {!r}); import fednode; " \
+        "sys.exit(0 if fednode.{}(*json.loads(sys.argv[1])) is not False else 1)".format(SCRIPTDIR, func_name)
+    return subprocess.call(SUDO_CMD.split() + [sys.executable, '-c', code, json.dumps(args)]) == 0
+
+
+def get_counterparty_db_path(service):
+    volume_path = get_docker_volume_path("{}_{}".format(PROJECT_NAME, BOOTSTRAP_VOLUME))
+    if volume_path is None:
+        print("Docker volume {}_{} doesn't seem to exist".format(PROJECT_NAME, BOOTSTRAP_VOLUME))
+        sys.exit(1)
+    return os.path.join(volume_path, COUNTERPARTY_DB_FILES[service])
+
+
+def get_db_block_index(db_path):
+    try:
+        db = sqlite3.connect("file:{}?mode=ro".format(urllib.parse.quote(db_path)), uri=True)
+        try:
+            return db.execute("SELECT MAX(block_index) FROM blocks").fetchone()[0]
+        finally:
+            db.close()
+    except sqlite3.Error:
+        return None
+
+
+def snapshot_object_path(store, digest):
+    return os.path.join(store, 'objects', digest[:2], digest)
+
+
+def load_snapshots(store, service=None):
+    snapshots = []
+    for path in glob.glob(os.path.join(store, 'snapshots', '*.json')):
+        with open(path) as f:
+            snapshot = json.load(f)
+        if service is None or snapshot['service'] == service:
+            snapshots.append(snapshot)
+    return sorted(snapshots, key=lambda snapshot: snapshot['created'])
+
+
+class DbSnapshotReader(object):
+    """A consistent view of a live SQLite database, read page by page straight from its file (and WAL), so taking it
+    needs neither a copy of the database nor the write lock for longer than it takes to start a read transaction"""
+
+    def __init__(self, db_path, timeout=60):
+        self.db_path = db_path
+        self.frames = {}  # page number -> offset in the WAL of the latest frame of it that's part of the view
+        self.db = self.db_file = self.wal_file = None
+        writer = sqlite3.connect(db_path, timeout=timeout, isolation_level=None)
+        try:
+            wal = writer.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+            # with the write lock held, the read transaction sees exactly the frames committed to the WAL so far
+            writer.execute("BEGIN IMMEDIATE")
+            self.db = sqlite3.connect("file:{}?mode=ro".format(urllib.parse.quote(db_path)), uri=True, timeout=timeout,
+                isolation_level=None)
+            self.db.execute("BEGIN")
+            self.db.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+            self.page_size = self.db.execute("PRAGMA page_size").fetchone()[0]
+            self.page_count = self.db.execute("PRAGMA page_count").fetchone()[0]
+            self.db_file = open(db_path, 'rb', buffering=0)
+            if wal:
+                self._index_wal()
+        except Exception:
+            self.close()
+            raise
+        finally:
+            writer.close()
+        # from here on, in WAL mode the server keeps on writing (and checkpointing, but never past our read mark);
+        # otherwise our read lock holds its commits back until we're done
+
+    def _index_wal(self):
+        # the number of committed frames and the salt of the WAL are in the header of the wal-index (see walformat.html)
+        with open(self.db_path + '-shm', 'rb') as f:
+            header = f.read(96)
+        if len(header) < 96 or header[:48] != header[48:96]:
+            raise IOError("Can't read the WAL index of {}".format(self.db_path))
+        max_frame = struct.unpack('=I', header[16:20])[0]
+        self.salt = header[32:40]
+        self.wal_file = open(self.db_path + '-wal', 'rb', buffering=0)
+        for frame in range(max_frame):
+            offset = 32 + frame * (24 + self.page_size)
+            self.wal_file.seek(offset)
+            frame_header = self.wal_file.read(24)
+            if frame_header[8:16] != self.salt:
+                raise IOError("Unexpected WAL frame in {}".format(self.db_path))
+            self.frames[struct.unpack('>I', frame_header[:4])[0]] = offset
+
+    def _read_wal_page(self, offset):
+        self.wal_file.seek(offset)
+        frame = self.wal_file.read(24 + self.page_size)
+        self.wal_file.seek(offset + 8)
+        if frame[8:16] != self.salt or self.wal_file.read(8) != self.salt:
+            # the WAL was checkpointed in full and restarted since, so the database file has the page
+            return None
+        return frame[24:]
+
+    def read_pages(self, first, count):
+        # count pages (or up to the last one) from page number first (numbered from 1), as they are in the view
+        count = max(min(count, self.page_count - first + 1), 0)
+        self.db_file.seek((first - 1) * self.page_size)
+        data = bytearray(self.db_file.read(count * self.page_size))
+        file_pages = len(data) // self.page_size
+        data.extend(bytes(count * self.page_size - len(data)))
+        for pgno in range(first, first + count):
+            page = self._read_wal_page(self.frames[pgno]) if pgno in self.frames else None
+            if page is not None:
+                data[(pgno - first) * self.page_size:(pgno - first + 1) * self.page_size] = page
+            elif pgno - first >= file_pages:
+                raise IOError("Page {} of {} is missing".format(pgno, self.db_path))
+        return bytes(data)
+
+    def close(self):
+        for f in (self.wal_file, self.db_file, self.db):
+            if f is not None:
+                f.close()
+
+
+def snapshot_create(db_path, store, service):
+    # reads a consistent view of the live database page by page (while the server keeps on writing), and stores it
+    # as compressed, content-addressed chunks of pages: unchanged chunks are already in the store from earlier
+    # snapshots, so only the changed ones get written
+    if not os.path.exists(db_path):
+        print("Database not found at {}".format(db_path))
+        return False
+    for dirname in ('objects', 'snapshots'):
+        os.makedirs(os.path.join(store, dirname), exist_ok=True)
+    start = time.time()
+    try:
+        reader = DbSnapshotReader(db_path)
+    except (sqlite3.Error, OSError) as e:
+        print("Couldn't read {}: {}".format(db_path, e))
+        return False
+    try:
+        block_index = reader.db.execute("SELECT MAX(block_index) FROM blocks").fetchone()[0]
+        page_size, size = reader.page_size, reader.page_count * reader.page_size
+        chunks, new_chunks, new_bytes = [], 0, 0
+        db_hasher = hashlib.sha256()
+        for first in range(1, reader.page_count + 1, SNAPSHOT_CHUNK_PAGES):
+            chunk = reader.read_pages(first, SNAPSHOT_CHUNK_PAGES)
+            db_hasher.update(chunk)
+            digest = hashlib.sha256(chunk).hexdigest()
+            chunks.append(digest)
+            object_path = snapshot_object_path(store, digest)
+            if not os.path.exists(object_path):
+                os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                compressed = zlib.compress(chunk, 6)
+                with open(object_path + '.tmp', 'wb') as o:
+                    o.write(compressed)
+                os.replace(object_path + '.tmp', object_path)
+                new_chunks += 1
+                new_bytes += len(compressed)
+    except (sqlite3.Error, OSError) as e:
+        print("Snapshot failed: {}".format(e))
+        return False
+    finally:
+        reader.close()
+
+    created = datetime.now(timezone.utc)
+    snapshot = {
+        'id': "{}-{}".format(created.strftime('%Y%m%dT%H%M%S%fZ'), service), 'service': service,
+        'created': created.isoformat(), 'db_file': os.path.basename(db_path), 'block_index': block_index,
+        'page_size': page_size, 'chunk_pages': SNAPSHOT_CHUNK_PAGES, 'size': size, 'sha256': db_hasher.hexdigest(),
+        'chunks': chunks, 'new_chunks': new_chunks, 'new_bytes': new_bytes,
+    }
+    try:
+        # never replace an existing manifest, even if the ids were to collide
+        with open(os.path.join(store, 'snapshots', snapshot['id'] + '.json'), 'x') as f:
+            json.dump(snapshot, f)
+    except FileExistsError:
+        print("Snapshot {} already exists".format(snapshot['id']))
+        return False
+    print("Created snapshot {} at block {} ({:.1f} MB db, {} of {} chunks new, {:.1f} MB written) in {:.1f}s".format(
+        snapshot['id'], block_index, size / 1024.0 ** 2, new_chunks, len(chunks), new_bytes / 1024.0 ** 2,
+        time.time() - start))
+    return True
+
+
+def snapshot_list(store, service):
+    snapshots = load_snapshots(store, service)
+    if not snapshots:
+        print("No snapshots of {} in {}".format(service, store))
+        return
+    print("{:<44} {:>10} {:>12} {:>12}".format("SNAPSHOT", "BLOCK", "DB SIZE (MB)", "STORED (MB)"))
+    for snapshot in snapshots:
+        print("{:<44} {:>10} {:>12.1f} {:>12.1f}".format(snapshot['id'], snapshot['block_index'] or '-',
+            snapshot['size'] / 1024.0 ** 2, snapshot['new_bytes'] / 1024.0 ** 2))
+
+
+def snapshot_restore(db_path, store, snapshot_id):
+    # reassembles the snapshot next to the database, verifies it, then swaps it in (the service must be stopped)
+    snapshot_path = os.path.join(store, 'snapshots', snapshot_id + '.json')
+    if not os.path.exists(snapshot_path):
+        print("Snapshot {} not found in {}".format(snapshot_id, store))
+        return False
+    with open(snapshot_path) as f:
+        snapshot = json.load(f)
+    start = time.time()
+    restore_path = db_path + '.restore'
+    db_hasher = hashlib.sha256()
+    try:
+        with open(restore_path, 'wb') as out:
+            for digest in snapshot['chunks']:
+                with open(snapshot_object_path(store, digest), 'rb') as o:
+                    chunk = zlib.decompress(o.read())
+                if hashlib.sha256(chunk).hexdigest() != digest:
+                    raise IOError("Corrupted snapshot chunk {}".format(digest))
+                db_hasher.update(chunk)
+                out.write(chunk)
+            out.flush()
+            os.fsync(out.fileno())
+        if db_hasher.hexdigest() != snapshot['sha256']:
+            raise IOError("Restored database doesn't match the snapshot checksum")
+    except (OSError, zlib.error) as e:
+        print("Restore failed: {}".format(e))
+        if os.path.exists(restore_path):
+            os.remove(restore_path)
+        return False
+    st = os.stat(db_path) if os.path.exists(db_path) else None
+    if st:
+        os.chown(restore_path, st.st_uid, st.st_gid)
+    for suffix in ('-wal', '-shm', '-journal'):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    os.replace(restore_path, db_path)
+    print("Restored snapshot {} (block {}) to {} in {:.1f}s".format(snapshot['id'], snapshot['block_index'], db_path, time.time() - start))
+    return True
+
+
+def get_block_index_tables(db):
+    # the tables that can be checked by block range cheaply: those with an index on block_index
+    tables = []
+    for (table,) in db.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name != 'blocks'"):
+        for index in db.execute("PRAGMA index_list({})".format(table)):
+            columns = db.execute("PRAGMA index_info({})".format(index[1])).fetchall()
+            if columns and columns[0][2] == 'block_index':
+                tables.append(table)
+                break
+    return tables
+
+
+def validate_block_range(db_path, first, last):
+    # checks blocks first..last (in one read transaction, so a consistent view in WAL mode); returns the
+    # list of problems found and the consensus hashes of the blocks to record as checkpoints
+    errors, checkpoints = [], {}
+    db = sqlite3.connect("file:{}?mode=ro".format(urllib.parse.quote(db_path)), uri=True, timeout=60)
+    db.isolation_level = None
+    try:
+        db.execute("BEGIN")
+        previous = db.execute("SELECT block_index, block_hash, ledger_hash, txlist_hash, messages_hash FROM blocks WHERE block_index = ?",
+            (first - 1,)).fetchone()
+        for block in db.execute("""SELECT block_index, block_hash, ledger_hash, txlist_hash, messages_hash, previous_block_hash
+                FROM blocks WHERE block_index BETWEEN ? AND ? ORDER BY block_index""", (first, last)):
+            block_index, block_hash, ledger_hash, txlist_hash, messages_hash, previous_block_hash = block
+            if previous is not None and block_index != previous[0] + 1:
+                errors.append("blocks {} to {} are missing".format(previous[0] + 1, block_index - 1))
+            if previous is not None and block_index == previous[0] + 1 and previous_block_hash and previous_block_hash != previous[1]:
+                errors.append("block {}: previous_block_hash doesn't match block {}".format(block_index, previous[0]))
+            for field, value, last_value in (('ledger_hash', ledger_hash, previous and previous[2]),
+                    ('txlist_hash', txlist_hash, previous and previous[3]), ('messages_hash', messages_hash, previous and previous[4])):
+                if not value:
+                    if field != 'messages_hash':  # (the messages hash isn't enforced by counterparty-server either)
+                        errors.append("block {}: no {}".format(block_index, field))
+                elif not re.match(r'^[0-9a-f]{64}$', value):
+                    errors.append("block {}: malformed {}".format(block_index, field))
+                elif value == last_value:  # each hash chains the previous one, so it changes on every block
+                    errors.append("block {}: same {} as the block before".format(block_index, field))
+            if block_index % VALIDATE_CHECKPOINT_INTERVAL == 0 or block_index == last:
+                checkpoints[block_index] = [ledger_hash, txlist_hash, messages_hash]
+            previous = block
+        if previous is None or previous[0] != last:
+            errors.append("blocks {} to {} are missing".format(previous[0] + 1 if previous else first, last))
+
+        (count,) = db.execute("""SELECT COUNT(*) FROM transactions t LEFT JOIN blocks b ON b.block_index = t.block_index
+            WHERE t.block_index BETWEEN ? AND ? AND (b.block_hash IS NULL OR b.block_hash != t.block_hash)""", (first, last)).fetchone()
+        if count:
+            errors.append("{} transactions in blocks {}-{} don't match their block".format(count, first, last))
+        count, min_index, max_index = db.execute("""SELECT COUNT(*), MIN(message_index), MAX(message_index) FROM messages
+            WHERE block_index BETWEEN ? AND ?""", (first, last)).fetchone()
+        if count and count != max_index - min_index + 1:
+            errors.append("{} messages missing in blocks {}-{}".format(max_index - min_index + 1 - count, first, last))
+        for table in get_block_index_tables(db):
+            (count,) = db.execute("""SELECT COUNT(*) FROM {} WHERE block_index BETWEEN ? AND ?
+                AND block_index NOT IN (SELECT block_index FROM blocks WHERE block_index BETWEEN ? AND ?)""".format(table),
+                (first, last, first, last)).fetchone()
+            if count:
+                errors.append("{} rows of {} in blocks {}-{} reference missing blocks".format(count, table, first, last))
+    finally:
+        db.close()
+    return errors, checkpoints
+
+
+def validate_incremental(db_path, service, state_path, jobs=None, reset=False):
+    # checks the recorded checkpoints are unchanged, then the blocks added since the validated high-water mark,
+    # split by block range over worker processes; the server keeps running, as only blocks deep enough to be
+    # past any reorg are checked, each range in a consistent read transaction
+    if not os.path.exists(db_path):
+        print("Database not found at {}".format(db_path))
+        return False
+    start = time.time()
+    state = {}
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            state = json.load(f)
+    service_state = {} if reset else state.get(service, {})
+    recorded = service_state.get('checkpoints', {})
+    high_water = service_state.get('high_water')
+
+    db = sqlite3.connect("file:{}?mode=ro".format(urllib.parse.quote(db_path)), uri=True, timeout=60)
+    try:
+        first_block, tip = db.execute("SELECT MIN(block_index), MAX(block_index) FROM blocks").fetchone()
+        changed = []
+        for block_index, hashes in sorted(recorded.items(), key=lambda item: int(item[0])):
+            row = db.execute("SELECT ledger_hash, txlist_hash, messages_hash FROM blocks WHERE block_index = ?", (int(block_index),)).fetchone()
+            if row is None or list(row) != hashes:
+                changed.append(int(block_index))
+    finally:
+        db.close()
+    if changed:
+        print("The consensus hashes of {} recorded checkpoint(s) changed since they were validated (first at block {})".format(
+            len(changed), changed[0]))
+        print("If that's expected (e.g. after a reparse into a new consensus version), run a full 'validate' and then 'validate --incremental --reset'")
+        return False
+    if tip is None:
+        print("No blocks in {}".format(db_path))
+        return False
+
+    first = high_water + 1 if high_water is not None else first_block
+    last = tip - VALIDATE_CONFIRMATIONS
+    if first > last:
+        print("Nothing to validate: blocks up to {} already are (tip at {})".format(high_water, tip))
+        return True
+    jobs = jobs or os.cpu_count() or 1
+    size = max(1, min(VALIDATE_RANGE_BLOCKS, (last - first + jobs) // jobs))
+    ranges = [(range_start, min(range_start + size - 1, last)) for range_start in range(first, last + 1, size)]
+    print("Validating blocks {} to {} ({} ranges, {} workers) of {}...".format(first, last, len(ranges), jobs, db_path))
+
+    errors, checkpoints = [], {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(validate_block_range, db_path, range_first, range_last) for range_first, range_last in ranges]
+        for future in futures:  # (in block order, to print the problems in order)
+            range_errors, range_checkpoints = future.result()
+            errors.extend(range_errors)
+            checkpoints.update(range_checkpoints)
+    for error in errors[:50]:
+        print("  " + error)
+    if errors:
+        print("FAILED: {} problem(s) found in blocks {} to {} ({:.1f}s); the high-water mark stays at {}".format(
+            len(errors), first, last, time.time() - start, high_water))
+        return False
+
+    # keep the checkpoints at the intervals, plus the new high-water block
+    recorded = {block_index: hashes for block_index, hashes in recorded.items() if int(block_index) % VALIDATE_CHECKPOINT_INTERVAL == 0}
+    recorded.update({str(block_index): hashes for block_index, hashes in checkpoints.items()
+        if block_index % VALIDATE_CHECKPOINT_INTERVAL == 0 or block_index == last})
+    state[service] = {'high_water': last, 'checkpoints': recorded, 'validated': datetime.now(timezone.utc).isoformat()}
+    with open(state_path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    script_dir_stat = os.stat(os.path.dirname(os.path.abspath(state_path)))
+    os.chown(state_path + '.tmp', script_dir_stat.st_uid, script_dir_stat.st_gid)
+    os.replace(state_path + '.tmp', state_path)
+    print("OK: blocks {} to {} validated in {:.1f}s ({} checkpoints recorded)".format(first, last, time.time() - start, len(recorded)))
+    return True
+
+
+def seed_replica_db(source_path, target_path):
+    # copies the live primary database into a replica's volume with SQLite's online backup API
+    if not os.path.exists(source_path):
+        print("Database not found at {}".format(source_path))
+        return False
+    start = time.time()
+    for suffix in ('-wal', '-shm', '.seed'):
+        if os.path.exists(target_path + suffix):
+            os.remove(target_path + suffix)
+    source = sqlite3.connect("file:{}?mode=ro".format(urllib.parse.quote(source_path)), uri=True)
+    target = sqlite3.connect(target_path + '.seed')
+    try:
+        source.backup(target, pages=SNAPSHOT_BACKUP_STEP_PAGES, sleep=0.01)
+    finally:
+        target.close()
+        source.close()
+    st = os.stat(source_path)
+    os.chown(target_path + '.seed', st.st_uid, st.st_gid)
+    os.replace(target_path + '.seed', target_path)
+    print("Seeded {} from {} in {:.1f}s".format(target_path, source_path, time.time() - start))
+    return True
+
+
+def set_replicas(service, count, seed=True):
+    groups = get_replica_groups()
+    names = ["{}-replica{}".format(service, n) for n in range(1, count + 1)]
+    removed = [name for name in groups.get(service, []) if name not in names]
+    added = [name for name in names if name not in groups.get(service, [])]
+    if removed:  # while they're still in the compose files
+        run_compose_cmd("rm -s -f {}".format(' '.join(removed)))
+        print("Removed {} (their volumes are kept; remove them with 'docker volume rm')".format(', '.join(removed)))
+
+    replica_counts = dict((name, len(replicas)) for name, replicas in groups.items())
+    replica_counts[service] = count
+    replica_counts = dict((name, n) for name, n in replica_counts.items() if n)
+    replicas_compose_path = os.path.join(SCRIPTDIR, REPLICAS_COMPOSE_FILE)
+    if replica_counts:
+        with open(replicas_compose_path, 'w') as f:
+            f.write(render_replicas_compose(replica_counts, get_compose_links(DOCKER_CONFIG_PATH)))
+    elif os.path.exists(replicas_compose_path):
+        os.remove(replicas_compose_path)
+    if (added or removed) and os.path.exists(os.path.join(SCRIPTDIR, TUNE_COMPOSE_FILE)):
+        # the replicas share the memory budget, and a removed one must not be left in the tune compose file
+        print("Re-tuning the resource limits for the replicas (rerun 'fednode tune' if you tuned with --cores, --memory or --disk)")
+        tune(DOCKER_CONFIG_PATH, *get_host_resources())
+    if not added:
+        return True
+
+    # create the new replicas (and their volumes), seed their databases from the primary's, then start them
+    run_compose_cmd("up --no-start --no-deps {}".format(' '.join(added)))
+    if seed:
+        source_path = get_counterparty_db_path(service)
+        volume_paths = get_docker_volume_paths(["{}_{}-data".format(PROJECT_NAME, name) for name in added])
+        for name in added:
+            volume_path = volume_paths["{}_{}-data".format(PROJECT_NAME, name)]
+            if volume_path is None or not run_privileged('seed_replica_db', source_path,
+                    os.path.join(volume_path, COUNTERPARTY_DB_FILES[service])):
+                print("Couldn't seed {}, so it will parse the blockchain from scratch".format(name))
+    run_compose_cmd("up -d --no-deps {}".format(' '.join(added)))
+    return True
+
+
+class CounterpartyBalancer(object):
+    """Routes counterparty-server API requests to the least busy of the primary and its replicas that are up and
+    within BALANCER_MAX_LAG blocks of the most advanced of them"""
+
+    def __init__(self, service, timeout=STATUS_TIMEOUT):
+        _, config_file, rpc_port, _, first_port = REPLICA_NETWORKS[service]
+        self.config_file = ('counterparty', config_file)
+        self.backends = [(service, rpc_port)] + [(name, first_port + int(REPLICA_NAME_RE.match(name).group(2)) - 1)
+            for name in get_replica_groups().get(service, [])]
+        self.state = dict((name, {'up': False, 'height': None, 'latency_ms': None, 'in_flight': 0}) for name, _ in self.backends)
+        self.timeout = timeout
+        self.lock = threading.Lock()
+
+    def check(self):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.backends)) as executor:
+            statuses = list(executor.map(lambda backend: probe_service_status(backend[0], 'counterparty', backend[1],
+                self.config_file, timeout=self.timeout), self.backends))
+        with self.lock:
+            for status in statuses:
+                self.state[status['service']].update(up=status['up'] and status['height'] is not None,
+                    height=status['height'], latency_ms=status['latency_ms'])
+
+    def run_checks(self, interval):
+        while True:
+            time.sleep(interval)
+            self.check()
+
+    def acquire(self, exclude=()):
+        # returns the backend to send a request to (or None), counting it in flight until released
+        with self.lock:
+            healthy = [(name, port) for name, port in self.backends if self.state[name]['up'] and name not in exclude]
+            if not healthy:
+                return None
+            best_height = max(self.state[name]['height'] for name, _ in healthy)
+            healthy = [(name, port) for name, port in healthy if best_height - self.state[name]['height'] <= BALANCER_MAX_LAG]
+            name, port = min(healthy, key=lambda backend: (self.state[backend[0]]['in_flight'], self.state[backend[0]]['latency_ms']))
+            self.state[name]['in_flight'] += 1
+            return name, port
+
+    def release(self, name, failed=False):
+        with self.lock:
+            self.state[name]['in_flight'] -= 1
+            if failed:
+                self.state[name]['up'] = False  # until the next check says otherwise
+
+
+class BalancerHandler(http.server.BaseHTTPRequestHandler):
+    balancer = None
+    protocol_version = 'HTTP/1.1'
+
+    def proxy(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        headers = dict((key, value) for key, value in self.headers.items() if key.lower() not in ('host', 'connection', 'content-length'))
+        tried = []
+        while True:
+            backend = self.balancer.acquire(exclude=tried)
+            if backend is None:
+                self.send_error(503, "No healthy counterparty-server backend")
+                return
+            name, port = backend
+            tried.append(name)
+            try:
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=self.balancer.timeout * 12)
+                conn.request(self.command, self.path, body=body or None, headers=headers)
+                response = conn.getresponse()
+                response_body = response.read()
+                conn.close()
+            except (OSError, http.client.HTTPException):
+                self.balancer.release(name, failed=True)
+                continue  # on to the next backend
+            self.balancer.release(name)
+            self.send_response(response.status)
+            for key, value in response.getheaders():
+                if key.lower() not in ('connection', 'transfer-encoding', 'content-length', 'server', 'date'):
+                    self.send_header(key, value)
+            self.send_header('Content-Length', str(len(response_body)))
+            self.send_header('X-Fednode-Backend', name)
+            self.end_headers()
+            self.wfile.write(response_body)
+            return
+
+    do_GET = proxy
+    do_POST = proxy
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run_balancer(service, listen, port, interval=BALANCER_CHECK_INTERVAL):
+    balancer = CounterpartyBalancer(service)
+    balancer.check()
+    threading.Thread(target=balancer.run_checks, args=(interval,), daemon=True).start()
+    handler = type('Handler', (BalancerHandler,), {'balancer': balancer})
+    server = http.server.ThreadingHTTPServer((listen, port), handler)
+    server.daemon_threads = True
+    print("Balancing {} on http://{}:{}/ over {}".format(service, listen, port, ', '.join(name for name, _ in balancer.backends)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+class MemoryCacheBackend(object):
+    """LRU cache of the responses, bounded by the total size of the cached responses"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key))
+            self.entries[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes and self.entries:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        return {'entries': len(self.entries), 'bytes': self.size, 'evictions': self.evictions}
+
+
+class RedisError(Exception):
+    pass
+
+
+class RedisClient(object):
+    """Minimal redis client (just the commands the response cache needs), over a single connection"""
+
+    def __init__(self, url, timeout=STATUS_TIMEOUT):
+        url = urllib.parse.urlparse(url)
+        self.address = (url.hostname or '127.0.0.1', url.port or 6379)
+        self.db = int(url.path.strip('/') or 0)
+        self.timeout = timeout
+        self.sock = None
+        self.lock = threading.Lock()
+
+    def _read_reply(self, f):
+        line = f.readline()
+        if not line:
+            raise RedisError("Connection closed")
+        kind, data = line[:1], line[1:-2]
+        if kind == b'-':
+            raise RedisError(data.decode('utf-8'))
+        if kind == b'$':
+            return None if int(data) < 0 else f.read(int(data) + 2)[:-2]
+        if kind == b'*':
+            return [self._read_reply(f) for _ in range(int(data))]
+        return int(data) if kind == b':' else data
+
+    def execute(self, *args):
+        command = b''.join(b'$%d\r\n%s\r\n' % (len(arg), arg) for arg in
+            (arg if isinstance(arg, bytes) else str(arg).encode('utf-8') for arg in args))
+        with self.lock:
+            for attempt in range(2):
+                try:
+                    if self.sock is None:
+                        self.sock = socket.create_connection(self.address, timeout=self.timeout)
+                        self.file = self.sock.makefile('rb')
+                        if self.db:
+                            self.sock.sendall(b'*2\r\n$6\r\nSELECT\r\n$%d\r\n%d\r\n' % (len(str(self.db)), self.db))
+                            self._read_reply(self.file)
+                    self.sock.sendall(b'*%d\r\n' % len(args) + command)
+                    return self._read_reply(self.file)
+                except (OSError, RedisError) as e:
+                    if self.sock is not None:
+                        self.sock.close()
+                    self.sock = None
+                    if attempt or isinstance(e, RedisError) and str(e) != "Connection closed":
+                        raise
+
+
+class RedisCacheBackend(object):
+    """Keeps the responses in a redis database of their own, flushed on each new block"""
+
+    def __init__(self, url, ttl=CACHE_REDIS_TTL):
+        self.client = RedisClient(url)
+        self.ttl = ttl
+        self.client.execute('PING')
+
+    def get(self, key):
+        return self.client.execute('GET', key)
+
+    def set(self, key, value):
+        self.client.execute('SET', key, value, 'EX', self.ttl)
+
+    def clear(self):
+        self.client.execute('FLUSHDB')
+
+    def stats(self):
+        return {'entries': self.client.execute('DBSIZE'), 'bytes': None, 'evictions': None}
+
+
+class ResponseCache(object):
+    """Caches the answers of counterparty-server's read methods, keyed on the method, params and (the credentials and)
+    block height they were answered at, and flushes them all when counterparty-server parses a new block"""
+
+    def __init__(self, backend, upstream_port, config_file, timeout=STATUS_TIMEOUT):
+        self.backend = backend
+        self.upstream_port = upstream_port
+        self.config_file = config_file
+        self.timeout = timeout
+        self.height = None
+        self.counters = collections.Counter()
+        self.lock = threading.Lock()
+
+    def get_upstream_height(self):
+        service_config = read_service_config(*self.config_file)
+        info = json_rpc_call("http://127.0.0.1:{}/api/".format(self.upstream_port), 'get_running_info',
+            user=service_config.get('rpc-user'), password=service_config.get('rpc-password'), timeout=self.timeout)
+        return info['last_block']['block_index'] if info.get('last_block') else None
+
+    def update_height(self):
+        # returns whether the height changed (flushing the cache if so)
+        try:
+            height = self.get_upstream_height()
+        except Exception:
+            return False
+        with self.lock:
+            if height == self.height:
+                return False
+            self.height = height
+            self.backend.clear()
+            self.counters['invalidations'] += 1
+        return True
+
+    def watch_height(self, zmq_url=None):
+        # a new block on the ZMQ feed means counterparty-server is about to parse it: check its height often until it
+        # has, and otherwise every CACHE_HEIGHT_POLL_INTERVAL (also in case there's no ZMQ feed, or we missed one)
+        subscriber = None
+        if zmq is not None and zmq_url:
+            subscriber = zmq.Context.instance().socket(zmq.SUB)
+            subscriber.setsockopt(zmq.SUBSCRIBE, b'hashblock')
+            subscriber.connect(zmq_url)
+        while True:
+            if subscriber is not None and subscriber.poll(CACHE_HEIGHT_POLL_INTERVAL * 1000):
+                while subscriber.poll(0):
+                    subscriber.recv_multipart()
+                deadline = time.time() + TRACE_TIMEOUT
+                while not self.update_height() and time.time() < deadline:
+                    time.sleep(TRACE_POLL_INTERVAL)
+            else:
+                if subscriber is None:
+                    time.sleep(CACHE_HEIGHT_POLL_INTERVAL)
+                self.update_height()
+
+    def count(self, name):
+        # (from the handler threads)
+        with self.lock:
+            self.counters[name] += 1
+
+    def make_key(self, method, params, authorization):
+        payload = json.dumps([method, params, authorization], sort_keys=True, separators=(',', ':'))
+        return "fednode:{}:{}".format(self.height, hashlib.sha256(payload.encode('utf-8')).hexdigest())
+
+    def metrics(self):
+        stats = self.backend.stats()
+        with self.lock:
+            counters, height = collections.Counter(self.counters), self.height
+        lookups = counters['hits'] + counters['misses']
+        lines = []
+        for name, metric_type, value in (
+                ('hits_total', 'counter', counters['hits']), ('misses_total', 'counter', counters['misses']),
+                ('uncacheable_total', 'counter', counters['uncacheable']),
+                ('hit_ratio', 'gauge', round(counters['hits'] / float(lookups), 4) if lookups else None),
+                ('invalidations_total', 'counter', counters['invalidations']), ('block_height', 'gauge', height),
+                ('entries', 'gauge', stats['entries']), ('bytes', 'gauge', stats['bytes']), ('evictions_total', 'counter', stats['evictions'])):
+            if value is not None:
+                lines += ["# TYPE fednode_cache_{} {}".format(name, metric_type), "fednode_cache_{} {}".format(name, value)]
+        return "\n".join(lines) + "\n"
+
+
+class CacheHandler(http.server.BaseHTTPRequestHandler):
+    cache = None
+    protocol_version = 'HTTP/1.1'
+
+    def respond(self, status, body, content_type='application/json', cache_status=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if cache_status:
+            self.send_header('X-Fednode-Cache', cache_status)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def forward(self, body):
+        headers = dict((key, value) for key, value in self.headers.items() if key.lower() not in ('host', 'connection', 'content-length'))
+        conn = http.client.HTTPConnection('127.0.0.1', self.cache.upstream_port, timeout=self.cache.timeout * 12)
+        try:
+            conn.request(self.command, self.path, body=body or None, headers=headers)
+            response = conn.getresponse()
+            return response.status, response.getheader('Content-Type', 'application/json'), response.read()
+        finally:
+            conn.close()
+
+    def do_GET(self):
+        if self.path.split('?')[0] == '/metrics':
+            self.respond(200, self.cache.metrics().encode('utf-8'), 'text/plain; version=0.0.4; charset=utf-8')
+            return
+        self.do_POST()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            request = json.loads(body.decode('utf-8')) if body else None
+        except ValueError:
+            request = None
+        method = request.get('method') if isinstance(request, dict) else None  # (batches go straight through)
+        height = self.cache.height
+        if not method or not method.startswith('get_') or method in CACHE_UNCACHEABLE_METHODS or height is None:
+            self.cache.count('uncacheable')
+            try:
+                status, content_type, response_body = self.forward(body)
+            except (OSError, http.client.HTTPException) as e:
+                self.respond(502, json.dumps({'error': str(e) or e.__class__.__name__}).encode('utf-8'))
+                return
+            self.respond(status, response_body, content_type)
+            return
+
+        # only the result is cached, as the response has to carry the id of each request
+        key = self.cache.make_key(method, request.get('params'), self.headers.get('Authorization'))
+        request_id = json.dumps(request.get('id')).encode('utf-8')
+        result = self.cache.backend.get(key)
+        if result is not None:
+            self.cache.count('hits')
+            cache_status = 'hit'
+        else:
+            self.cache.count('misses')
+            cache_status = 'miss'
+            try:
+                status, content_type, response_body = self.forward(body)
+                reply = json.loads(response_body.decode('utf-8')) if status == 200 else None
+            except (OSError, http.client.HTTPException) as e:
+                self.respond(502, json.dumps({'error': str(e) or e.__class__.__name__}).encode('utf-8'))
+                return
+            except ValueError:
+                reply = None
+            if not isinstance(reply, dict) or reply.get('error') is not None or 'result' not in reply:
+                self.respond(status, response_body, content_type, cache_status)
+                return
+            result = json.dumps(reply['result']).encode('utf-8')
+            if self.cache.height == height:  # (else the block changed meanwhile, and the answer may be of either)
+                self.cache.backend.set(key, result)
+        self.respond(200, b'{"jsonrpc": "2.0", "id": ' + request_id + b', "result": ' + result + b'}', cache_status=cache_status)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def get_container_ip(service):
+    container_name = "federatednode_{}_1".format(service)
+    client = get_docker_client()
+    if client:
+        info = client.inspect_container(container_name)
+        networks = info['NetworkSettings']['Networks'] if info else {}
+        return next((network['IPAddress'] for network in networks.values() if network.get('IPAddress')), None)
+    try:
+        return subprocess.check_output('{} docker inspect --format="{{{{range .NetworkSettings.Networks}}}}{{{{.IPAddress}}}} {{{{end}}}}" {}'.format(
+            SUDO_CMD, container_name), shell=True, stderr=subprocess.DEVNULL).decode("utf-8").split()[0]
+    except (subprocess.CalledProcessError, IndexError):
+        return None
+
+
+def run_cache(service, listen, port, upstream_port, backend, zmq_url=None):
+    _, config_file, _, _, _ = REPLICA_NETWORKS[service]
+    cache = ResponseCache(backend, upstream_port, ('counterparty', config_file))
+    cache.update_height()
+    threading.Thread(target=cache.watch_height, args=(zmq_url,), daemon=True).start()
+    handler = type('Handler', (CacheHandler,), {'cache': cache})
+    server = http.server.ThreadingHTTPServer((listen, port), handler)
+    server.daemon_threads = True
+    print("Caching {} (port {}) on http://{}:{}/, metrics on /metrics, at block {}{}".format(service, upstream_port, listen, port,
+        cache.height, "" if zmq is not None and zmq_url else " (without pyzmq, new blocks are checked for every {}s)".format(
+        CACHE_HEIGHT_POLL_INTERVAL)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+class BlockProgress(object):
+    """Tracks the progress of a (re)parse from the block indexes in its log output"""
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.start_block = None
+        self.block = None
+        self.tip = None
+        self.peak_memory = None
+        self.samples = collections.deque()  # (time, block), for the last PROGRESS_AVERAGE_WINDOW seconds
+        self.profile_samples = []  # (seconds since start, block), every PROGRESS_SAMPLE_INTERVAL seconds
+
+    def feed(self, line):
+        match = PROGRESS_BLOCK_RE.search(line)
+        if not match:
+            return False
+        now = time.time()
+        self.block = int(match.group(1))
+        if self.start_block is None:
+            self.start_block = self.block
+        self.samples.append((now, self.block))
+        while self.samples and self.samples[0][0] < now - PROGRESS_AVERAGE_WINDOW:
+            self.samples.popleft()
+        if not self.profile_samples or now - self.start_time - self.profile_samples[-1][0] >= PROGRESS_SAMPLE_INTERVAL:
+            self.profile_samples.append((round(now - self.start_time, 1), self.block))
+        return True
+
+    def rate(self, window):
+        now = time.time()
+        recent = [sample for sample in self.samples if sample[0] >= now - window]
+        if len(recent) < 2 or recent[-1][0] == recent[0][0]:
+            return None
+        return (recent[-1][1] - recent[0][1]) / (recent[-1][0] - recent[0][0])
+
+    def render(self):
+        if self.block is None:
+            return "waiting for block progress..."
+        rate, average = self.rate(PROGRESS_RATE_WINDOW), self.rate(PROGRESS_AVERAGE_WINDOW)
+        parts = ["block {}".format(self.block)]
+        if self.tip:
+            parts[0] += "/{} ({:.1%})".format(self.tip, self.block / float(self.tip))
+        parts.append("{:.1f} blk/s".format(rate) if rate is not None else "- blk/s")
+        parts.append("avg {:.1f} blk/s".format(average) if average is not None else "avg - blk/s")
+        if self.tip and average:
+            eta = max(self.tip - self.block, 0) / average
+            parts.append("ETA {:d}:{:02d}:{:02d}".format(int(eta // 3600), int(eta % 3600 // 60), int(eta % 60)))
+        if self.peak_memory:
+            parts.append("peak mem {:.0f} MB".format(self.peak_memory / 1024.0 ** 2))
+        return " | ".join(parts)
+
+    def profile(self):
+        duration = time.time() - self.start_time
+        blocks = (self.block - self.start_block) if self.block is not None else 0
+        return {
+            'duration': round(duration, 1), 'start_block': self.start_block, 'end_block': self.block, 'blocks': blocks,
+            'blocks_per_sec': round(blocks / duration, 2) if duration else None, 'tip': self.tip,
+            'peak_memory': self.peak_memory, 'samples': self.profile_samples,
+        }
+
+
+def get_oneoff_container_memory(service):
+    # current and max memory usage of the 'docker-compose run' container of the service, if we can get at them
+    client = get_docker_client()
+    if not client:
+        return None
+    filters = json.dumps({'label': ['com.docker.compose.project={}'.format(PROJECT_NAME),
+        'com.docker.compose.service={}'.format(service), 'com.docker.compose.oneoff=True']})
+    containers = client.request('GET', '/containers/json', {'filters': filters})
+    if not containers:
+        return None
+    stats = client.request('GET', '/containers/{}/stats'.format(containers[0]['Id']), {'stream': 0})
+    memory_stats = (stats or {}).get('memory_stats') or {}
+    return memory_stats.get('max_usage') or memory_stats.get('usage')
+
+
+def get_bitcoind_tip(service):
+    bitcoind = 'bitcoin-testnet' if service.endswith('-testnet') else 'bitcoin'
+    for spec in STATUS_SERVICES:
+        if spec[0] == bitcoind:
+            return probe_service_status(*spec)['backend_height']
+    return None
+
+
+def get_src_version(repo):
+    try:
+        return subprocess.check_output("git -C {} describe --tags --always --dirty".format(os.path.join(SCRIPTDIR, "src", repo)),
+            shell=True, stderr=subprocess.DEVNULL).decode("utf-8").strip() or None
+    except subprocess.CalledProcessError:
+        return None
+
+
+def run_with_progress(service, command, compose_cmd, profile_path=None):
+    # runs the one-off compose command, passing its output through while keeping a progress line below it,
+    # and writes a JSON timing profile of the run at the end
+    progress = BlockProgress()
+    done = threading.Event()
+
+    def sample():
+        # the tip and the container memory are polled off the output path, so a slow probe never stalls it
+        while not done.is_set():
+            try:
+                progress.tip = get_bitcoind_tip(service) or progress.tip
+                memory = get_oneoff_container_memory(service)
+                if memory:
+                    progress.peak_memory = max(progress.peak_memory or 0, memory)
+            except Exception:
+                pass
+            done.wait(PROGRESS_SAMPLE_INTERVAL)
+    threading.Thread(target=sample, daemon=True).start()
+
+    started = datetime.now(timezone.utc)
+    proc = subprocess.Popen(get_compose_cmd(compose_cmd.replace('run ', 'run -T ', 1)), shell=True,
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    is_tty = sys.stdout.isatty()
+    try:
+        for raw_line in proc.stdout:
+            line = raw_line.decode("utf-8", errors="replace")
+            progress.feed(line)
+            if is_tty:
+                sys.stdout.write("\r\033[K{}\033[1m{}\033[0m".format(line, progress.render()))
+            else:
+                sys.stdout.write(line)
+            sys.stdout.flush()
+        returncode = proc.wait()
+    except KeyboardInterrupt:
+        proc.terminate()
+        returncode = proc.wait()
+    done.set()
+    print("")
+
+    profile = dict(progress.profile(), command=command, service=service, returncode=returncode,
+        started=started.isoformat(), counterparty_lib=get_src_version('counterparty-lib'),
+        counterblock=get_src_version('counterblock') if service.startswith('counterblock') else None)
+    if not profile_path:
+        profile_path = os.path.join(PROFILES_PATH, "{}-{}-{}.json".format(command, service, started.strftime('%Y%m%dT%H%M%SZ')))
+    os.makedirs(os.path.dirname(os.path.abspath(profile_path)), exist_ok=True)
+    with open(profile_path, 'w') as f:
+        json.dump(profile, f, indent=2)
+    print("{} of {} finished with code {} in {:.0f}s ({} blocks, {} blk/s); timing profile written to {}".format(command, service,
+        returncode, profile['duration'], profile['blocks'], profile['blocks_per_sec'], profile_path))
+    return returncode
+
+
+def open_counterparty_db(db_path, read_only=False):
+    mode = "?mode=ro" if read_only else ""
+    db = sqlite3.connect("file:{}{}".format(urllib.parse.quote(db_path), mode), uri=True, timeout=60)
+    db.execute("PRAGMA busy_timeout = 60000")  # wait for the server's write transactions, rather than fail
+    return db
+
+
+def vacuum_analyze(db_path):
+    if not os.path.exists(db_path):
+        print("Database not found at {}".format(db_path))
+        return False
+    db = open_counterparty_db(db_path, read_only=True)
+    try:
+        page_size = db.execute("PRAGMA page_size").fetchone()[0]
+        page_count = db.execute("PRAGMA page_count").fetchone()[0]
+        freelist_count = db.execute("PRAGMA freelist_count").fetchone()[0]
+        auto_vacuum = {0: 'none', 1: 'full', 2: 'incremental'}.get(db.execute("PRAGMA auto_vacuum").fetchone()[0])
+
+        # one pass over the pages, collecting each table/index's page numbers: dbstat lists them in b-tree order, so they
+        # are sorted afterwards and the gaps between them give the fragmentation (the share of pages not right after
+        # the previous one of the same table/index on disk)
+        objects = collections.OrderedDict()
+        try:
+            for name, pageno, unused in db.execute("SELECT name, pageno, unused FROM dbstat"):
+                stats = objects.setdefault(name, {'pages': 0, 'unused': 0, 'pagenos': []})
+                stats['pages'] += 1
+                stats['unused'] += unused
+                stats['pagenos'].append(pageno)
+            for stats in objects.values():
+                pagenos = sorted(stats.pop('pagenos'))
+                stats['gaps'] = sum(1 for previous, pageno in zip(pagenos, pagenos[1:]) if pageno != previous + 1)
+        except sqlite3.OperationalError:
+            print("(this SQLite build has no dbstat support, so there's no per table/index breakdown)")
+    finally:
+        db.close()
+
+    print("{}: {:.1f} MB ({} pages of {} bytes), auto_vacuum {}".format(db_path, page_count * page_size / 1024.0 ** 2,
+        page_count, page_size, auto_vacuum))
+    print("Free pages: {} ({:.1f} MB, {:.1%})".format(freelist_count, freelist_count * page_size / 1024.0 ** 2,
+        freelist_count / float(page_count or 1)))
+    if objects:
+        print("\n{:<40} {:>10} {:>12} {:>10} {:>14}".format("TABLE/INDEX", "PAGES", "SIZE (MB)", "UNUSED", "FRAGMENTATION"))
+        for name, stats in sorted(objects.items(), key=lambda item: -item[1]['pages']):
+            print("{:<40} {:>10} {:>12.1f} {:>10.1%} {:>14.1%}".format(name, stats['pages'], stats['pages'] * page_size / 1024.0 ** 2,
+                stats['unused'] / float(stats['pages'] * page_size), stats['gaps'] / float(max(stats['pages'] - 1, 1))))
+    unused = sum(stats['unused'] for stats in objects.values())
+    print("\nEstimated savings: {:.1f} MB from free pages (reclaimed by --incremental or a full vacuum)".format(
+        freelist_count * page_size / 1024.0 ** 2))
+    if objects:
+        print("                   up to {:.1f} MB more from unused space within pages (reclaimed by a full vacuum only)".format(
+            unused / 1024.0 ** 2))
+    if auto_vacuum != 'incremental':
+        print("NOTE: --incremental needs the database in incremental auto-vacuum mode (see --enable-incremental)")
+    return True
+
+
+def vacuum_incremental(db_path, budget=None):
+    # reclaims up to budget free pages a step at a time, each step in its own short write transaction so the
+    # server only ever waits for one of them, then refreshes the query planner statistics with a bounded ANALYZE
+    if not os.path.exists(db_path):
+        print("Database not found at {}".format(db_path))
+        return False
+    db = open_counterparty_db(db_path)
+    db.isolation_level = None  # we manage the transactions
+    try:
+        if db.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            print("The database isn't in incremental auto-vacuum mode; run 'vacuum --enable-incremental' once first")
+            return False
+        page_size = db.execute("PRAGMA page_size").fetchone()[0]
+        start = time.time()
+        reclaimed = 0
+        while budget is None or reclaimed < budget:
+            free_pages = db.execute("PRAGMA freelist_count").fetchone()[0]
+            if not free_pages:
+                break
+            step = min(VACUUM_INCREMENTAL_STEP, free_pages, budget - reclaimed if budget is not None else free_pages)
+            page_count = db.execute("PRAGMA page_count").fetchone()[0]
+            # executescript, as execute() only steps the pragma once (freeing a single page)
+            db.executescript("PRAGMA incremental_vacuum({})".format(step))
+            reclaimed += page_count - db.execute("PRAGMA page_count").fetchone()[0]
+            sys.stdout.write("\r  reclaimed {} pages ({:.1f} MB)   ".format(reclaimed, reclaimed * page_size / 1024.0 ** 2))
+            sys.stdout.flush()
+            time.sleep(VACUUM_INCREMENTAL_PAUSE)
+        print("\nReclaimed {} pages ({:.1f} MB) in {:.1f}s, {} free pages left".format(reclaimed, reclaimed * page_size / 1024.0 ** 2,
+            time.time() - start, db.execute("PRAGMA freelist_count").fetchone()[0]))
+        db.execute("PRAGMA analysis_limit = {}".format(VACUUM_ANALYSIS_LIMIT))
+        db.execute("ANALYZE")
+        print("Refreshed the query planner statistics")
+    finally:
+        db.close()
+    return True
+
+
+def vacuum_enable_incremental(db_path):
+    if not os.path.exists(db_path):
+        print("Database not found at {}".format(db_path))
+        return False
+    db = open_counterparty_db(db_path)
+    try:
+        db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        db.execute("VACUUM")  # needed for the auto_vacuum mode change to take effect
+    finally:
+        db.close()
+    print("Switched {} to incremental auto-vacuum".format(db_path))
+    return True
+
+
+def file_mtime(path):
+    t = datetime.fromtimestamp(os.stat(path).st_mtime, timezone.utc)
+    return t.astimezone().isoformat()
+
+def config_check(build_config):
+    for dirname, fromfile, tofile in CONFIGCHECK_FILES[build_config]:
+        # dirname, fromfile, tofile = config_spec
+
+        try:
+            fromfilepath = os.path.join(SCRIPTDIR, 'config', dirname, fromfile)
+            fromdate = file_mtime(fromfilepath)
+        except FileNotFoundError as e:
+            print("Config file not found at {}".format(fromfilepath))
+            continue
+
+        try:
+            tofilepath = os.path.join(SCRIPTDIR, 'config', dirname, tofile)
+            todate = file_mtime(tofilepath)
+        except FileNotFoundError as e:
+            print("Config file not found at {}".format(tofilepath))
+            continue
+
+
+        linejunk_filter = lambda x: len(x.strip()) > 0 and x.strip()[0:1] != '#'
+        with open(fromfilepath) as ff:
+            fromlines = list(filter(linejunk_filter, ff.readlines()))
+        with open(tofilepath) as tf:
+            tolines = list(filter(linejunk_filter, tf.readlines()))
+
+        diff = difflib.unified_diff(fromlines, tolines, fromfile, tofile, fromdate, todate, n=3)
+        diff_string = "".join(diff)
+        if len(diff_string):
+            print("Found these differences in the file {}:\n".format(tofilepath))
+            print("{}".format(diff_string))
+        else:
+            print("{}: OK".format(os.path.join(dirname, tofile)))
+
+    return
+
+
+def get_disk_type(path):
+    # 'ssd' or 'hdd' for the (Linux) block device holding path, or None if unknown
+    try:
+        st_dev = os.stat(path).st_dev
+        dev_path = os.path.realpath("/sys/dev/block/{}:{}".format(os.major(st_dev), os.minor(st_dev)))
+        for queue_dir in (os.path.join(dev_path, 'queue'), os.path.join(os.path.dirname(dev_path), 'queue')):  # partitions
+            if os.path.exists(os.path.join(queue_dir, 'rotational')):
+                with open(os.path.join(queue_dir, 'rotational')) as f:
+                    return 'hdd' if f.read().strip() == '1' else 'ssd'
+    except OSError:
+        pass
+    return None
+
+
+def get_host_resources():
+    cores = os.cpu_count() or 1
+    try:
+        with open('/proc/meminfo') as f:
+            memory = int(re.search(r'^MemTotal:\s+(\d+) kB', f.read(), re.MULTILINE).group(1)) * 1024
+    except (OSError, AttributeError):
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    docker_root = '/var/lib/docker' if os.path.exists('/var/lib/docker') else SCRIPTDIR
+    return cores, memory, get_disk_type(docker_root)
+
+
+def get_tune_weights(service):
+    # replicas weigh as much as their primary
+    match = REPLICA_NAME_RE.match(service)
+    return TUNE_SERVICE_WEIGHTS.get(match.group(1) if match else service)
+
+
+def compute_tune_profile(services, cores, memory, disk):
+    services = [s for s in services if get_tune_weights(s)]
+    available_memory = (memory - max(TUNE_HOST_RESERVED_MEMORY, memory // 10)) // 1024 ** 2  # MB
+    # every service gets its floor first, and only what's left is split by weight, so the limits add up to the budget
+    floor = min(TUNE_MIN_MEMORY, max(available_memory, 0) // max(len(services), 1))
+    spare_memory = max(available_memory - floor * len(services), 0)
+    total_mem_weight = float(sum(get_tune_weights(s)[0] for s in services)) or 1.0
+    profile = {'services': {}, 'bitcoin': {}, 'addrindexrs': {}, 'redis': {}}
+    for service in services:
+        mem_weight, cpu_weight = get_tune_weights(service)
+        mem_limit = floor + int(spare_memory * mem_weight / total_mem_weight)  # MB
+        profile['services'][service] = {'mem_limit': mem_limit, 'cpu_shares': int(1024 * cpu_weight)}
+
+        if service.startswith('bitcoin'):
+            # the UTXO cache gets a share of what's left of the limit once the mempool and the rest of bitcoind are
+            # accounted for: more on spinning disks, where every cache miss is a seek
+            maxmempool = max(5, min(TUNE_BITCOIN_MAX_MEMPOOL, mem_limit // 4))
+            dbcache = int(max(mem_limit - maxmempool - TUNE_BITCOIN_OVERHEAD, 0) * (0.6 if disk == 'hdd' else 0.5))
+            rpcthreads = max(4, min(cores * 2, 32))
+            profile['bitcoin'][service] = {
+                'dbcache': min(max(dbcache, 4), 16384),
+                'maxmempool': maxmempool,
+                'rpcthreads': rpcthreads,
+                'rpcworkqueue': max(16, rpcthreads * (2 if disk == 'hdd' else 4)),
+                'par': max(1, min(cores - 1, 16)),
+            }
+        elif service.startswith('addrindexrs'):
+            profile['addrindexrs'][service] = {'ADDRINDEXRS_TXID_LIMIT': min(max(mem_limit * 15000 // 2048, 5000), 100000)}
+        elif service == 'redis':
+            profile['redis'][service] = {'maxmemory': "{}mb".format(int(mem_limit * 0.75))}
+    return profile
+
+
+def set_config_values(content, values, separator='='):
+    # replaces (or appends) key<separator>value lines of a config file
+    for key, value in sorted(values.items()):
+        line = "{}{}{}".format(key, separator, value)
+        pattern = r'^{}\s*{}.*$'.format(re.escape(key), re.escape(separator.strip() or ' '))
+        if re.search(pattern, content, re.MULTILINE):
+            content = re.sub(pattern, line, content, flags=re.MULTILINE)
+        else:
+            content = content + ('' if not content or content.endswith('\n') else '\n') + line + '\n'
+    return content
+
+
+def render_tune_compose(profile):
+    lines = ["# generated by 'fednode tune' -- rerun it (or delete this file) rather than editing it", "version: '2'", "", "services:"]
+    for service, limits in sorted(profile['services'].items()):
+        lines += ["  {}:".format(service), "    mem_limit: {}m".format(limits['mem_limit']), "    cpu_shares: {}".format(limits['cpu_shares'])]
+        if service in profile['addrindexrs']:
+            lines += ["    environment:"] + ["      - {}={}".format(k, v) for k, v in sorted(profile['addrindexrs'][service].items())]
+        if service in profile['redis']:
+            lines.append("    command: redis-server /usr/local/etc/redis/redis.conf --maxmemory {}".format(profile['redis'][service]['maxmemory']))
+    return '\n'.join(lines) + '\n'
+
+
+def tune(compose_path, cores, memory, disk, dry_run=False):
+    services = expand_replica_groups(get_compose_services(compose_path))
+    print("Tuning for {} cores, {:.1f} GB RAM, {} disk".format(cores, memory / 1024.0 ** 3, disk or "unknown"))
+    profile = compute_tune_profile(services, cores, memory, disk)
+    if profile['services'] and min(limits['mem_limit'] for limits in profile['services'].values()) < TUNE_MIN_MEMORY:
+        print("WARNING: there isn't enough memory to give each of the {} services {} MB: expect the smallest containers "
+            "to be OOM-killed, or run fewer services".format(len(profile['services']), TUNE_MIN_MEMORY))
+
+    changes = []  # (path, old content, new content)
+    for service, values in sorted(profile['bitcoin'].items()):
+        path = os.path.join(SCRIPTDIR, 'config', 'bitcoin', 'bitcoin.testnet.conf' if service.endswith('-testnet') else 'bitcoin.conf')
+        if not os.path.exists(path):
+            path += '.default'  # not generated yet; show what we'd change in the defaults
+            if not dry_run:
+                print("Config file not found at {} (run 'install' first)".format(path[:-len('.default')]))
+                continue
+        with open(path) as f:
+            content = f.read()
+        changes.append((path, content, set_config_values(content, values)))
+    tune_compose_path = os.path.join(SCRIPTDIR, TUNE_COMPOSE_FILE)
+    old_tune_compose = open(tune_compose_path).read() if os.path.exists(tune_compose_path) else ''
+    changes.append((tune_compose_path, old_tune_compose, render_tune_compose(profile)))
+
+    for path, old_content, new_content in changes:
+        old_lines, new_lines = [[l if l.endswith('\n') else l + '\n' for l in c.splitlines(True)] for c in (old_content, new_content)]
+        diff = ''.join(difflib.unified_diff(old_lines, new_lines, path, path, n=1))
+        print("{}:\n{}".format(path, diff) if diff else "{}: unchanged".format(path))
+        if not dry_run and diff:
+            with open(path, 'w') as f:
+                f.write(new_content)
+    if not dry_run:
+        print("Done. Run 'fednode rebuild' for the resource limits, and 'fednode restart' for the config changes, to take effect")
+    return profile
+
+
+def main():
+    global DOCKER_CONFIG_PATH
+    setup_env()
+    args = parse_args()
+
+    use_docker_pulls = not args.no_pull
+
+    # run utility commands (docker_clean) if specified
+    if args.command == 'docker_clean':
+        client = get_docker_client()
+        if client:
+            docker_containers = [c['Id'] for c in client.list_containers(all=True)]
+            for container, error in client.remove_containers(docker_containers).items():
+                print("{}: {}".format(container[:12], error or "removed"))
+            docker_images = [i['Id'] for i in client.list_images()]
+            for image, error in client.remove_images(docker_images).items():
+                print("{}: {}".format(image.replace('sha256:', '')[:12], error or "removed"))
+            sys.exit(1)
+
+        docker_containers = subprocess.check_output("{} docker ps -a -q".format(SUDO_CMD), shell=True).decode("utf-8").split('\n')
+        docker_images = subprocess.check_output("{} docker images -q".format(SUDO_CMD), shell=True).decode("utf-8").split('\n')
+        docker_containers = [c for c in docker_containers if c]
+        docker_images = [i for i in docker_images if i]
+        # one docker invocation each for all the containers and all the images
+        if docker_containers:
+            os.system("{} docker rm {}".format(SUDO_CMD, ' '.join(docker_containers)))
+        if docker_images:
+            os.system("{} docker rmi {}".format(SUDO_CMD, ' '.join(docker_images)))
+        sys.exit(1)
+
+    # preflight may be run before install, so doesn't need a config
+    if args.command == 'preflight':
+        preflight_config = args.config
+        if not preflight_config:
+            if not os.path.exists(FEDNODE_CONFIG_PATH):
+                print("config file {} does not exist. Please specify the configuration to check for".format(FEDNODE_CONFIG_FILE))
+                sys.exit(1)
+            config = configparser.ConfigParser()
+            config.read(FEDNODE_CONFIG_PATH)
+            preflight_config = config.get('Default', 'config')
+        os.environ['MONGODB_HOST_INTERFACE'] = args.mongodb_interface
+        report = port_preflight(get_compose_host_ports(get_compose_config_path(preflight_config)), timeout=args.timeout)
+        print_preflight_report(report, as_json=args.json)
+        sys.exit(1 if any(entry['in_use'] for entry in report) else 0)
+
+    # for all other commands
+    # if config doesn't exist, only the 'install' command may be run
+    config_existed = os.path.exists(FEDNODE_CONFIG_PATH)
+    config = configparser.ConfigParser()
+    if not config_existed:
+        if args.command != 'install':
+            print("config file {} does not exist. Please run the 'install' command first".format(FEDNODE_CONFIG_FILE))
+            sys.exit(1)
+
+        # write default config
+        config.add_section('Default')
+        config.set('Default', 'branch', args.branch)
+        config.set('Default', 'config', args.config)
+        write_config(config)
+
+    # load and read config
+    assert os.path.exists(FEDNODE_CONFIG_PATH)
+    config.read(FEDNODE_CONFIG_PATH)
+    build_config = config.get('Default', 'config')
+    DOCKER_CONFIG_PATH = get_compose_config_path(build_config)
+    repo_branch = config.get('Default', 'branch')
+    os.environ['FEDNODE_RELEASE_TAG'] = 'latest' if repo_branch == 'master' else repo_branch
+    os.environ['HOSTNAME_BASE'] = socket.gethostname()
+    os.environ['MONGODB_HOST_INTERFACE'] = getattr(args, 'mongodb_interface', "127.0.0.1")
+    os.environ["NO_BOOTSTRAP"] = "true" if hasattr(args, "no_bootstrap") and args.no_bootstrap else "false"
+
+    if args.command in ('exec', 'shell') and args.service not in expand_replica_groups(get_compose_services(DOCKER_CONFIG_PATH)):
+        print("Invalid service: {} (choose from {})".format(args.service, ', '.join(expand_replica_groups(get_compose_services(DOCKER_CONFIG_PATH)))))
+        sys.exit(1)
+
+    # perform action for the specified command
+    if args.command == 'install':
+        if config_existed:
+            print("Cannot install, as it appears a configuration already exists. Please run the 'uninstall' command first")
+            sys.exit(1)
+
+        # check port usage
+        ports_in_use = [entry for entry in port_preflight(get_compose_host_ports(DOCKER_CONFIG_PATH)) if entry['in_use']]
+        if ports_in_use:
+            print_preflight_report(ports_in_use)
+            print("Cannot install, as it appears a process is already listening on the host port(s) above")
+            sys.exit(1)
+
+        # check out the necessary source trees (don't use submodules due to detached HEAD and other problems)
+        REPOS = REPOS_BASE if build_config == 'base' else (REPOS_COUNTERBLOCK if build_config == 'counterblock' else REPOS_FULL)
+        git_checkout_all(REPOS, repo_branch, use_ssh_uris=args.use_ssh_uris, shallow=args.shallow,
+            cache_dir=args.git_cache_dir, jobs=args.jobs)
+
+        # make sure we have the newest image for each service
+        if use_docker_pulls:
+            run_compose_cmd("pull --ignore-pull-failures")
+        else:
+            print("skipping docker pull command")
+
+
+        # copy over the configs from .default to active versions, if they don't already exist
+        for default_config in glob.iglob(os.path.join(SCRIPTDIR, 'config', '**/*.default'), recursive=True):
+            active_config = default_config.replace('.default', '')
+            if not os.path.exists(active_config):
+                print("Generating config from defaults at {} ...".format(active_config))
+                shutil.copy2(default_config, active_config)
+                default_config_stat = os.stat(default_config)
+                if not IS_WINDOWS:
+                    os.chown(active_config, default_config_stat.st_uid, default_config_stat.st_gid)
+
+        # create symlinks to the data volumes (for ease of use)
+        if not IS_WINDOWS:
+            data_dir = os.path.join(SCRIPTDIR, "data")
+            if not os.path.exists(data_dir):
+                os.mkdir(data_dir)
+
+            volumes = get_compose_volumes(DOCKER_CONFIG_PATH)
+            volume_names = ["{}_{}".format(PROJECT_NAME, volume) for volume in volumes]
+            mountpoint_paths = get_docker_volume_paths(volume_names)
+            for volume, volume_name in zip(volumes, volume_names):
+                symlink_path = os.path.join(data_dir, volume.replace('-data', ''))
+                mountpoint_path = mountpoint_paths[volume_name]
+                if mountpoint_path is not None and not os.path.lexists(symlink_path):
+                    os.symlink(mountpoint_path, symlink_path)
+                    print("For convenience, symlinking {} to {}".format(mountpoint_path, symlink_path))
+
+        if args.counterparty_replicas:
+            # (bootstrapped like the primaries, as there's no database to seed them from yet)
+            replica_counts = dict((service, args.counterparty_replicas) for service in REPLICA_CHOICES
+                if service in get_compose_services(DOCKER_CONFIG_PATH))
+            with open(os.path.join(SCRIPTDIR, REPLICAS_COMPOSE_FILE), 'w') as f:
+                f.write(render_replicas_compose(replica_counts, get_compose_links(DOCKER_CONFIG_PATH)))
+
+        # launch
+        if args.staged:
+            staged_start(expand_replica_groups(get_compose_services(DOCKER_CONFIG_PATH)), args.stage_timeout)
+        else:
+            run_compose_cmd("up -d")
+    elif args.command == 'uninstall':
+        run_compose_cmd("down")
+        os.remove(FEDNODE_CONFIG_PATH)
+        if os.path.exists(os.path.join(SCRIPTDIR, REPLICAS_COMPOSE_FILE)):
+            os.remove(os.path.join(SCRIPTDIR, REPLICAS_COMPOSE_FILE))
+    elif args.command == 'start':
+        if args.staged:
+            staged_start(expand_replica_groups(args.services or get_compose_services(DOCKER_CONFIG_PATH)), args.stage_timeout)
+        else:
+            run_compose_cmd("start {}".format(' '.join(expand_replica_groups(args.services))))
+    elif args.command == 'stop':
+        run_compose_cmd("stop {}".format(' '.join(expand_replica_groups(args.services))))
+    elif args.command == 'restart':
+        run_compose_cmd("restart {}".format(' '.join(expand_replica_groups(args.services))))
+    elif args.command == 'replicas':
+        if args.service not in get_compose_services(DOCKER_CONFIG_PATH):
+            print("{} isn't part of the '{}' configuration".format(args.service, build_config))
+            sys.exit(1)
+        set_replicas(args.service, args.count, seed=not args.no_seed)
+    elif args.command == 'cache':
+        if args.backend == 'redis':
+            redis_url = args.redis_url
+            if redis_url is None:
+                redis_ip = get_container_ip('redis')
+                if redis_ip is None:
+                    print("The redis container doesn't seem to be running (or use --redis-url)")
+                    sys.exit(1)
+                redis_url = "redis://{}:6379/{}".format(redis_ip, CACHE_REDIS_DBS[args.service])
+            backend = RedisCacheBackend(redis_url)
+        else:
+            backend = MemoryCacheBackend(args.max_memory * 1024 ** 2)
+        network = 'testnet' if args.service.endswith('-testnet') else 'mainnet'
+        run_cache(args.service, args.listen, args.port or CACHE_PORTS[args.service],
+            args.upstream_port or REPLICA_NETWORKS[args.service][2], backend, TRACE_ZMQ_URLS[network])
+    elif args.command == 'balancer':
+        run_balancer(args.service, args.listen, args.port or REPLICA_NETWORKS[args.service][3])
+    elif args.command == 'validate' and args.incremental:
+        ok = run_privileged('validate_incremental', get_counterparty_db_path(args.service), args.service, VALIDATE_STATE_PATH,
+            args.jobs, args.reset)
+        sys.exit(0 if ok else 1)
+    elif args.command in ('reparse', 'rollback', 'validate'):
+        compose_cmd = {
+            'reparse': "run -e COMMAND=reparse {}",
+            'rollback': "run -e COMMAND='rollback {}' {{}}".format(getattr(args, 'block_index', None)),
+            'validate': "run -e COMMAND=checkdb {}",
+        }[args.command].format(args.service)
+        run_compose_cmd("stop {}".format(args.service))
+        if args.no_progress:
+            run_compose_cmd(compose_cmd)
+        else:
+            run_with_progress(args.service, args.command, compose_cmd, args.profile)
     elif args.command == 'vacuum':
+        if args.analyze or args.incremental:
+            # online: the service keeps on running
+            db_path = get_counterparty_db_path(args.service)
+            if args.analyze:
+                ok = run_privileged('vacuum_analyze', db_path)
+            else:
+                ok = run_privileged('vacuum_incremental', db_path, args.budget)
+            sys.exit(0 if ok else 1)
         run_compose_cmd("stop {}".format(args.service))
+        if args.enable_incremental:
+            ok = run_privileged('vacuum_enable_incremental', get_counterparty_db_path(args.service))
+            run_compose_cmd("start {}".format(args.service))
+            sys.exit(0 if ok else 1)
         run_compose_cmd("run -e COMMAND=vacuum {}".format(args.service))
-    elif args.command == 'tail':
-        run_compose_cmd("logs -f --tail={} {}".format(args.num_lines, ' '.join(args.services)))
-    elif args.command == 'logs':
-        run_compose_cmd("logs {}".format(' '.join(args.services)))
+    elif args.command == 'bootstrap':
+        if IS_WINDOWS:
+            print("The bootstrap command isn't supported on Windows, as the docker volumes live inside the docker VM")
+            sys.exit(1)
+        url = args.url or BOOTSTRAP_URLS[args.service]
+        expected_digest = args.checksum
+        if not expected_digest and args.checksum_url:
+            with urllib.request.urlopen(args.checksum_url, timeout=60) as response:
+                expected_digest = response.read().decode('utf-8').split()[0]
+        if expected_digest and not get_checksum_algorithm(expected_digest):
+            print("Unrecognized checksum: {}".format(expected_digest))
+            sys.exit(1)
+        volume_path = get_docker_volume_path("{}_{}".format(PROJECT_NAME, BOOTSTRAP_VOLUME))
+        if volume_path is None:
+            print("Docker volume {}_{} doesn't seem to exist".format(PROJECT_NAME, BOOTSTRAP_VOLUME))
+            sys.exit(1)
+        was_running = is_container_running(args.service, abort_on_not_exist=False)
+        if was_running:
+            run_compose_cmd("stop {}".format(args.service))
+        ok = bootstrap(url, volume_path, expected_digest, jobs=args.jobs, chunk_size=args.chunk_size, force=args.force)
+        if was_running:
+            run_compose_cmd("start {}".format(args.service))
+        sys.exit(0 if ok else 1)
+    elif args.command == 'snapshot':
+        store = os.path.abspath(args.store)
+        if args.action == 'list':
+            snapshot_list(store, args.service)
+            sys.exit(0)
+        db_path = get_counterparty_db_path(args.service)
+        if args.action == 'create':
+            # the server keeps on running
+            sys.exit(0 if run_privileged('snapshot_create', db_path, store, args.service) else 1)
+        snapshots = load_snapshots(store, args.service)
+        snapshot_id = args.snapshot_id or (snapshots[-1]['id'] if snapshots else None)
+        if not snapshot_id:
+            print("No snapshots of {} in {}".format(args.service, store))
+            sys.exit(1)
+        was_running = is_container_running(args.service, abort_on_not_exist=False)
+        if was_running:
+            run_compose_cmd("stop {}".format(args.service))
+        ok = run_privileged('snapshot_restore', db_path, store, snapshot_id)
+        if was_running:
+            run_compose_cmd("start {}".format(args.service))
+        sys.exit(0 if ok else 1)
+    elif args.command == 'bench':
+        try:
+            mix = parse_bench_mix(args.mix)
+            concurrency_levels = [int(c) for c in args.concurrency.split(',')]
+        except ValueError as e:
+            print("Invalid bench parameters: {}".format(e))
+            sys.exit(1)
+        address = args.address or (BENCH_ADDRESS_TESTNET if args.testnet else BENCH_ADDRESS)
+        targets = {}
+        stub = start_bench_stub() if args.stub else None
+        for backend, (port, testnet_port, config_file, user_key, password_key) in BENCH_BACKENDS.items():
+            service_config = read_service_config(config_file[0], config_file[1].format('.testnet' if args.testnet else '')) if config_file else {}
+            port = stub.server_address[1] if stub else (testnet_port if args.testnet else port)
+            url = "http://127.0.0.1:{}{}".format(port, '/api/' if backend == 'counterparty' else ('/' if backend == 'bitcoind' else ''))
+            targets[backend] = (url, service_config.get(user_key), service_config.get(password_key))
+
+        levels = run_bench(mix, concurrency_levels, args.requests, targets, address, timeout=args.timeout)
+        print_bench_results(levels, load_bench_results(args.compare) if args.compare else None)
+        if args.output:
+            save_bench_results(args.output, levels, config=build_config, testnet=args.testnet, mix=args.mix)
+            print("\nResults saved to {}".format(args.output))
+        if stub:
+            stub.shutdown()
+    elif args.command in ('tail', 'logs'):
+        try:
+            since = parse_log_time_arg(args.since) if args.since else None
+            until = parse_log_time_arg(args.until) if args.until else None
+            matcher = make_log_matcher(args.grep, args.level) if args.grep or args.level else None
+        except (ValueError, re.error) as e:
+            print("Invalid log filter: {}".format(e))
+            sys.exit(1)
+        services = args.services or get_compose_services(DOCKER_CONFIG_PATH)
+        num_lines = args.num_lines if args.command == 'tail' else None
+        # read the json-file logs straight from disk if we can, rather than having docker-compose replay them all
+        if not show_logs(services, num_lines=num_lines, follow=args.command == 'tail', since=since, until=until,
+                matcher=matcher, timestamps=args.timestamps):
+            if matcher or since or until:
+                print("Cannot read the docker log files directly, so can't filter them (try again with sudo rights to them)")
+                sys.exit(1)
+            if args.command == 'tail':
+                run_compose_cmd("logs -f --tail={} {}".format(args.num_lines, ' '.join(args.services)))
+            else:
+                run_compose_cmd("logs {}".format(' '.join(args.services)))
     elif args.command == 'ps':
         run_compose_cmd("ps")
+    elif args.command == 'du':
+        show_disk_usage(DOCKER_CONFIG_PATH, jobs=args.jobs, as_json=args.json, keep_history=not args.no_history)
+    elif args.command == 'trace-blocks':
+        ok = trace_blocks(args.network, args.zmq_url, args.count, args.timeout, get_compose_services(DOCKER_CONFIG_PATH))
+        sys.exit(0 if ok else 1)
+    elif args.command == 'exporter':
+        run_exporter(DOCKER_CONFIG_PATH, args.listen, args.port, args.interval, args.timeout)
+    elif args.command == 'status':
+        services = expand_replica_groups(args.services or list(get_compose_links(DOCKER_CONFIG_PATH).keys()))
+        while True:
+            statuses = get_services_status(services, timeout=args.timeout)
+            if args.watch:
+                print("\033[2J\033[H{}".format(datetime.now().isoformat(' ', 'seconds')))
+            if args.json:
+                print(json.dumps(statuses, indent=2))
+            else:
+                print_services_status(statuses)
+            if not args.watch:
+                break
+            time.sleep(args.watch)
     elif args.command == 'exec':
         if len(args.cmd) == 1 and re.match("['\"].*?['\"]", args.cmd[0]):
             cmd = args.cmd
@@ -422,62 +4061,80 @@ def main():
                     sys.exit(1)
 
         services_to_update = copy.copy(UPDATE_CHOICES) if not len(args.services) else args.services
-        git_has_updated = []
-        while services_to_update:
-            # update source code
-            service = services_to_update.pop(0)
+        service_bases = []
+        for service in services_to_update:
             service_base = service.replace('-testnet', '')
-            if service_base not in git_has_updated:
-                git_has_updated.append(service_base)
-                if service_base == 'counterparty':  # special case
-                    service_dirs = [os.path.join(SCRIPTDIR, "src", "counterparty-lib"), os.path.join(SCRIPTDIR, "src", "counterparty-cli")]
-                else:
-                    service_dirs = [service_base,]
-                for service_dir in service_dirs:
-                    service_dir_path = os.path.join(SCRIPTDIR, "src", service_dir)
-                    if not os.path.exists(service_dir_path):
-                        continue
-                    service_branch = subprocess.check_output("cd {};git symbolic-ref --short -q HEAD;cd {}".format(service_dir_path, CURDIR), shell=True).decode("utf-8").strip()
-                    if not service_branch:
-                        print("Unknown service git branch name, or repo in detached state")
-                        sys.exit(1)
-                    git_cmd = "cd {}; git pull origin {}; cd {}".format(service_dir_path, service_branch, CURDIR)
-                    if not IS_WINDOWS:  # make sure to update the code as the original user, so the permissions are right
-                        os.system("{} -u {} bash -c \"{}\"".format(SUDO_CMD, SESSION_USER, git_cmd))
-                    else:
-                        os.system(git_cmd)
-
-                    # delete installed egg (to force egg recreate and deps re-check on next start)
-                    if service_base in ('counterparty', 'counterblock', 'armory-utxsvr'):
-                        for path in glob.glob(os.path.join(service_dir_path, "*.egg-info")):
-                            print("Removing egg path {}".format(path))
-                            if not IS_WINDOWS:  # have to use root
-                                os.system("{} bash -c \"rm -rf {}\"".format(SUDO_CMD, path))
-                            else:
-                                shutil.rmtree(path)
-
-                if service_base == 'counterwallet' and os.path.exists(os.path.join(SCRIPTDIR, "src", "counterwallet")):  # special case
-                    transifex_cfg_path = os.path.join(os.path.expanduser("~"), ".transifex")
-                    if os.path.exists(transifex_cfg_path):
-                        os.system("{} docker cp {} federatednode_counterwallet_1:/root/.transifex".format(SUDO_CMD, transifex_cfg_path))
-                    os.system("{} docker exec -i -t federatednode_counterwallet_1 bash -c \"cd /counterwallet/src ".format(SUDO_CMD) +
-                              "&& bower --allow-root update && cd /counterwallet && npm update && grunt build\"")
-                    if not os.path.exists(transifex_cfg_path):
-                        print("NOTE: Did not update locales because there is no .transifex file in your home directory")
-                        print("If you want locales compiled, sign up for transifex and create this file to" +
-                              " contain 'your_transifex_username:your_transifex_password'")
-
-            # and restart container
-            if not args.no_restart:
-                run_compose_cmd("restart {}".format(service))
+            if service_base not in service_bases:
+                service_bases.append(service_base)
+
+        # update source code: pull all the distinct repos at once
+        repo_dirs = [d for service_base in service_bases for d in get_update_service_dirs(service_base)]
+        changed_repo_dirs, failed = [], []
+        start = time.time()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(min(args.jobs, len(repo_dirs)), 1)) as executor:
+            for repo_dir, changed, elapsed, output in executor.map(git_update, repo_dirs):
+                status = "FAILED" if changed is None else ("updated" if changed else "up to date")
+                print("  {:<20} {:>7.1f}s  {}".format(os.path.basename(repo_dir), elapsed, status))
+                if changed is None:
+                    failed.append((repo_dir, output))
+                elif changed:
+                    changed_repo_dirs.append(repo_dir)
+        print("Source update finished in {:.1f}s".format(time.time() - start))
+        if failed:
+            for repo_dir, output in failed:
+                print("\nUpdate of {} failed:\n{}".format(repo_dir, output.strip()))
+            sys.exit(1)
+
+        changed_bases = [b for b in service_bases if any(d in changed_repo_dirs for d in get_update_service_dirs(b))]
+        affected_bases = service_bases if args.force_restart else changed_bases
+        for service_base in affected_bases:
+            # delete installed egg (to force egg recreate and deps re-check on next start)
+            if service_base in ('counterparty', 'counterblock', 'armory-utxsvr'):
+                for service_dir_path in get_update_service_dirs(service_base):
+                    for path in glob.glob(os.path.join(service_dir_path, "*.egg-info")):
+                        print("Removing egg path {}".format(path))
+                        if not IS_WINDOWS:  # have to use root
+                            os.system("{} bash -c \"rm -rf {}\"".format(SUDO_CMD, path))
+                        else:
+                            shutil.rmtree(path)
+
+            if service_base == 'counterwallet' and os.path.exists(os.path.join(SCRIPTDIR, "src", "counterwallet")):  # special case
+                transifex_cfg_path = os.path.join(os.path.expanduser("~"), ".transifex")
+                if os.path.exists(transifex_cfg_path):
+                    os.system("{} docker cp {} federatednode_counterwallet_1:/root/.transifex".format(SUDO_CMD, transifex_cfg_path))
+                os.system("{} docker exec -i -t federatednode_counterwallet_1 bash -c \"cd /counterwallet/src ".format(SUDO_CMD) +
+                          "&& bower --allow-root update && cd /counterwallet && npm update && grunt build\"")
+                if not os.path.exists(transifex_cfg_path):
+                    print("NOTE: Did not update locales because there is no .transifex file in your home directory")
+                    print("If you want locales compiled, sign up for transifex and create this file to" +
+                          " contain 'your_transifex_username:your_transifex_password'")
+
+        # and restart all the affected containers with a single compose call
+        if not args.no_restart:
+            links = get_compose_links(DOCKER_CONFIG_PATH)
+            services_to_restart = [s for s in services_to_update if s.replace('-testnet', '') in affected_bases and s in links]
+            if services_to_restart:
+                run_compose_cmd("restart {}".format(' '.join(sort_services_by_dependency(services_to_restart, links))))
+            else:
+                print("No source code changes, so no services to restart")
     elif args.command == 'configcheck':
         config_check(build_config)
+    elif args.command == 'tune':
+        cores, memory, disk = get_host_resources()
+        tune(DOCKER_CONFIG_PATH, args.cores or cores, int(args.memory * 1024 ** 3) if args.memory else memory,
+            args.disk or disk, dry_run=args.dry_run)
     elif args.command == 'rebuild':
+        args.services = expand_replica_groups(args.services)
         if use_docker_pulls:
             run_compose_cmd("pull --ignore-pull-failures {}".format(' '.join(args.services)))
         else:
             print("skipping docker pull command")
         
+        if args.parallel:
+            ok = parallel_rebuild(args.services or expand_replica_groups(get_compose_services(DOCKER_CONFIG_PATH)),
+                args.jobs, args.cache_dir, args.no_cache)
+            sys.exit(0 if ok else 1)
+
         if args.no_cache:
             run_compose_cmd("build --no-cache {}".format(' '.join(args.services)))
             
@@ -0,0 +1,87 @@
+import socket
+
+import fednode
+
+
+def closed_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def stub_targets(stub, broken=()):
+    port = stub.server_address[1]
+    targets = {}
+    for backend in fednode.BENCH_BACKENDS:
+        url = "http://127.0.0.1:{}{}".format(closed_port() if backend in broken else port,
+            '/api/' if backend == 'counterparty' else ('/' if backend == 'bitcoind' else ''))
+        targets[backend] = (url, 'rpc', 'secret')
+    return targets
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert fednode.percentile(values, 50) == 50
+    assert fednode.percentile(values, 95) == 95
+    assert fednode.percentile(values, 99) == 99
+    assert fednode.percentile([7], 99) == 7
+    assert fednode.percentile([], 50) is None
+    assert fednode.latency_summary([0.003, 0.001, 0.002]) == {'p50': 2.0, 'p95': 3.0, 'p99': 3.0}
+
+
+def test_run_bench_against_stub():
+    stub = fednode.start_bench_stub(delay=0.02)
+    try:
+        mix = fednode.parse_bench_mix("counterparty.get_running_info=2,http-addrindexrs.utxos=1,bitcoind.getblockcount=1")
+        levels = fednode.run_bench(mix, [1, 4], 40, stub_targets(stub), fednode.BENCH_ADDRESS, timeout=5)
+    finally:
+        stub.shutdown()
+
+    assert [l['concurrency'] for l in levels] == [1, 4]
+    for level in levels:
+        assert level['requests'] == 40
+        assert level['errors'] == 0 and level['error_rate'] == 0.0
+        assert 20 <= level['p50'] <= level['p95'] <= level['p99'] < 1000
+        assert sum(c['requests'] for c in level['calls'].values()) == 40
+        assert set(level['calls']) == {'counterparty.get_running_info', 'http-addrindexrs.utxos', 'bitcoind.getblockcount'}
+    # four requests at a time get through the 20ms stub faster than one at a time
+    assert levels[1]['throughput'] > levels[0]['throughput']
+
+
+def test_run_bench_counts_errors():
+    stub = fednode.start_bench_stub()
+    try:
+        mix = fednode.parse_bench_mix("counterparty.get_running_info,bitcoind.getblockcount")
+        level, = fednode.run_bench(mix, [2], 30, stub_targets(stub, broken=('bitcoind',)), fednode.BENCH_ADDRESS, timeout=5)
+    finally:
+        stub.shutdown()
+
+    failing = level['calls']['bitcoind.getblockcount']
+    working = level['calls']['counterparty.get_running_info']
+    assert failing['requests'] > 0 and working['requests'] > 0
+    assert failing['errors'] == failing['requests'] and failing['p50'] is None and failing['last_error']
+    assert working['errors'] == 0 and 'last_error' not in working
+    assert level['errors'] == failing['requests']
+    assert level['error_rate'] == round(failing['requests'] / 30.0, 4)
+    # the overall percentiles only cover the calls that worked
+    assert level['p50'] is not None
+
+
+def test_bench_results_compare(tmp_path, capsys):
+    stub = fednode.start_bench_stub()
+    try:
+        mix = fednode.parse_bench_mix("counterparty.get_running_info")
+        levels = fednode.run_bench(mix, [1, 2], 10, stub_targets(stub), fednode.BENCH_ADDRESS, timeout=5)
+    finally:
+        stub.shutdown()
+
+    path = str(tmp_path / 'bench.json')
+    fednode.save_bench_results(path, levels, config='base', testnet=False, mix="counterparty.get_running_info")
+    previous = fednode.load_bench_results(path)
+    assert previous == levels
+
+    fednode.print_bench_results(levels, previous)
+    output = capsys.readouterr().out
+    for level in levels:
+        assert "concurrency {}: 10 requests".format(level['concurrency']) in output
+        assert "throughput {0} -> {0} req/s, p95 {1} -> {1} ms, errors 0 -> 0".format(level['throughput'], level['p95']) in output
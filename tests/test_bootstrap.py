@@ -0,0 +1,153 @@
+import hashlib
+import http.client
+import http.server
+import io
+import os
+import re
+import tarfile
+import threading
+import time
+
+import pytest
+
+import fednode
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the server's payload at any path, with Range/If-Range support (unless disabled), and can cut the
+    first range responses short"""
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        payload = server.payload
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        with server.lock:
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            if not match or not server.ranges or self.headers.get('If-Range', server.etag) != server.etag:
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(payload)))
+                self.send_header('ETag', server.etag)
+                self.end_headers()
+                self.wfile.write(payload)
+                return
+            start = int(match.group(1))
+            end = min(int(match.group(2)) if match.group(2) else len(payload) - 1, len(payload) - 1)
+            with server.lock:
+                server.requested.append((start, end))
+                cut = server.cuts > 0
+                server.cuts -= int(cut)
+            body = payload[start:end + 1]
+            self.send_response(206)
+            self.send_header('Content-Range', "bytes {}-{}/{}".format(start, end, len(payload)))
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('ETag', server.etag)
+            self.end_headers()
+            time.sleep(0.01)  # so the ranges overlap in time
+            if cut:
+                # half the body, then the connection breaks
+                self.wfile.write(body[:len(body) // 2])
+                self.wfile.flush()
+                self.close_connection = True
+                self.connection.shutdown(2)
+            else:
+                self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+
+@pytest.fixture
+def http_file(monkeypatch):
+    monkeypatch.setattr(fednode.time, 'sleep', lambda seconds: None)  # no backoff between retries
+    monkeypatch.setattr(fednode, 'SUDO_CMD', '')
+    servers = []
+
+    def serve(payload, ranges=True, cuts=0):
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+        server.daemon_threads = True
+        server.payload, server.ranges, server.cuts = payload, ranges, cuts
+        server.etag = '"{}"'.format(hashlib.md5(payload).hexdigest())
+        server.lock = threading.Lock()
+        server.in_flight, server.max_in_flight, server.requested = 0, 0, []
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server, "http://127.0.0.1:{}/counterparty.latest.tar.gz".format(server.server_address[1])
+
+    yield serve
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def make_archive(files):
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode='w:gz') as tar:
+        for name, content in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return data.getvalue()
+
+
+def test_parallel_chunks(http_file):
+    payload = os.urandom(1024 * 1024 + 123)
+    server, url = http_file(payload)
+    chunk_size = 64 * 1024
+    blocks = list(fednode.iter_download(url, jobs=4, chunk_size=chunk_size))
+    assert blocks[0] == (len(payload), None)  # the size comes first
+    assert b''.join(block for _, block in blocks[1:]) == payload  # and then the chunks, in order
+    chunk_requests = sorted(r for r in server.requested if r != (0, 0))
+    assert chunk_requests == [(start, min(start + chunk_size, len(payload)) - 1) for start in range(0, len(payload), chunk_size)]
+    assert server.max_in_flight > 1
+
+
+def test_fetch_range_resumes_after_a_broken_connection(http_file):
+    payload = os.urandom(256 * 1024)
+    server, url = http_file(payload, cuts=2)  # the first two responses break halfway
+    assert fednode.fetch_range(url, 1000, 200999, etag=server.etag) == payload[1000:201000]
+    starts = [start for start, _ in server.requested]
+    assert starts[0] == 1000 and len(starts) == 3
+    assert starts[1] > 1000 and starts[2] > starts[1]  # picking up where it left off each time
+
+
+def test_fetch_range_gives_up_after_the_retries(http_file):
+    payload = os.urandom(64 * 1024)
+    _, url = http_file(payload, cuts=100)
+    with pytest.raises((OSError, http.client.HTTPException)):
+        fednode.fetch_range(url, 0, len(payload) - 1, retries=2)
+
+
+def test_fetch_range_refuses_a_changed_file(http_file):
+    _, url = http_file(os.urandom(64 * 1024))
+    with pytest.raises(RuntimeError):
+        fednode.fetch_range(url, 0, 1023, etag='"another version"', retries=0)
+
+
+def test_without_range_support(http_file):
+    payload = os.urandom(100 * 1024)
+    _, url = http_file(payload, ranges=False)
+    blocks = list(fednode.iter_download(url, jobs=4, chunk_size=16 * 1024))
+    assert blocks[0] == (len(payload), None)
+    assert b''.join(block for _, block in blocks[1:]) == payload
+
+
+def test_bootstrap_extracts_into_the_volume(http_file, tmp_path):
+    archive = make_archive({'counterparty.db': b'db' * 50000, 'counterparty.db.version': b'1'})
+    _, url = http_file(archive)
+    assert fednode.bootstrap(url, str(tmp_path), hashlib.sha256(archive).hexdigest(), jobs=2, chunk_size=1)
+    assert (tmp_path / 'counterparty.db').read_bytes() == b'db' * 50000
+    assert sorted(os.listdir(str(tmp_path))) == ['counterparty.db', 'counterparty.db.version']  # no staging dir left behind
+
+
+def test_bootstrap_checksum_mismatch_cleans_up(http_file, tmp_path):
+    (tmp_path / 'counterparty.db').write_bytes(b'the existing database')
+    archive = make_archive({'counterparty.db': b'a bad download'})
+    _, url = http_file(archive)
+    assert not fednode.bootstrap(url, str(tmp_path), 'ab' * 32, jobs=2, force=True)
+    assert os.listdir(str(tmp_path)) == ['counterparty.db']  # the staging dir is gone...
+    assert (tmp_path / 'counterparty.db').read_bytes() == b'the existing database'  # ...and the database untouched
@@ -0,0 +1,187 @@
+import http.client
+import http.server
+import json
+import re
+import threading
+import time
+
+import pytest
+
+import fednode
+
+
+class StubCounterpartyHandler(http.server.BaseHTTPRequestHandler):
+    """counterparty-server's JSON-RPC API, answering at the server's current block height"""
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        server = self.server
+        server.calls.append(request['method'])
+        if request['method'] == 'get_running_info':
+            reply = {'result': {'last_block': {'block_index': server.height}}}
+        elif request['method'] == 'get_broken':
+            reply = {'error': {'code': -32000, 'message': "Server error"}}
+        else:
+            reply = {'result': {'method': request['method'], 'params': request.get('params'), 'height': server.height}}
+        body = json.dumps(dict(reply, jsonrpc='2.0', id=request['id'])).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_server(handler):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    monkeypatch.setattr(fednode, 'read_service_config', lambda *args: {})
+    upstream = start_server(StubCounterpartyHandler)
+    upstream.height, upstream.calls = 800000, []
+    response_cache = fednode.ResponseCache(fednode.MemoryCacheBackend(1024 ** 2), upstream.server_address[1], ('counterparty', 'server.conf'))
+    assert response_cache.update_height()
+    proxy = start_server(type('Handler', (fednode.CacheHandler,), {'cache': response_cache}))
+
+    def call(method, params=None, request_id=1):
+        conn = http.client.HTTPConnection('127.0.0.1', proxy.server_address[1], timeout=5)
+        try:
+            conn.request('POST', '/api/', json.dumps({'jsonrpc': '2.0', 'id': request_id, 'method': method, 'params': params or {}}),
+                {'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            return json.loads(response.read()), response.getheader('X-Fednode-Cache')
+        finally:
+            conn.close()
+
+    def metrics():
+        conn = http.client.HTTPConnection('127.0.0.1', proxy.server_address[1], timeout=5)
+        try:
+            conn.request('GET', '/metrics')
+            text = conn.getresponse().read().decode()
+        finally:
+            conn.close()
+        return dict((name, float(value)) for name, value in re.findall(r'^fednode_cache_(\w+) (\S+)$', text, re.MULTILINE))
+
+    yield response_cache, upstream, call, metrics
+    for server in (proxy, upstream):
+        server.shutdown()
+        server.server_close()
+
+
+def test_miss_then_hit(cache):
+    _, upstream, call, _ = cache
+    params = {'filters': [{'field': 'address', 'op': '==', 'value': '1BoatSLRHtKNngkdXEeobR76b53LETtpyT'}]}
+    first, first_status = call('get_balances', params, request_id=1)
+    second, second_status = call('get_balances', params, request_id='two')
+    assert (first_status, second_status) == ('miss', 'hit')
+    assert upstream.calls.count('get_balances') == 1
+    assert first['result'] == second['result'] == {'method': 'get_balances', 'params': params, 'height': 800000}
+    assert (first['id'], second['id']) == (1, 'two')  # each answer carries its own request's id
+
+    _, other_status = call('get_balances', {'filters': []})
+    assert other_status == 'miss'  # other params, another entry
+
+
+def test_uncacheable_methods_pass_through(cache):
+    _, upstream, call, _ = cache
+    for method in ('get_mempool', 'get_mempool', 'create_send'):
+        reply, cache_status = call(method)
+        assert cache_status is None
+        assert reply['result']['method'] == method
+    assert upstream.calls.count('get_mempool') == 2
+    assert upstream.calls.count('create_send') == 1
+
+
+def test_errors_are_not_cached(cache):
+    _, upstream, call, _ = cache
+    for _ in range(2):
+        reply, cache_status = call('get_broken')
+        assert cache_status == 'miss'
+        assert reply['error']['message'] == "Server error"
+    assert upstream.calls.count('get_broken') == 2
+
+
+def test_new_block_invalidates(cache):
+    response_cache, upstream, call, _ = cache
+    call('get_asset_info', {'assets': ['XCP']})
+    assert call('get_asset_info', {'assets': ['XCP']})[1] == 'hit'
+    assert not response_cache.update_height()  # same block, nothing flushed
+
+    upstream.height += 1
+    assert response_cache.update_height()
+    assert response_cache.backend.stats()['entries'] == 0
+    reply, cache_status = call('get_asset_info', {'assets': ['XCP']})
+    assert cache_status == 'miss'
+    assert reply['result']['height'] == 800001
+
+
+def test_zmq_block_notification_invalidates(cache, monkeypatch):
+    zmq = pytest.importorskip('zmq')
+    response_cache, upstream, call, _ = cache
+    monkeypatch.setattr(fednode, 'CACHE_HEIGHT_POLL_INTERVAL', 60)  # so only the notification can flush it in time
+    monkeypatch.setattr(fednode, 'TRACE_POLL_INTERVAL', 0.02)
+    publisher = zmq.Context.instance().socket(zmq.XPUB)
+    try:
+        port = publisher.bind_to_random_port('tcp://127.0.0.1')
+        threading.Thread(target=response_cache.watch_height, args=('tcp://127.0.0.1:{}'.format(port),), daemon=True).start()
+        assert publisher.poll(5000) and publisher.recv() == b'\x01hashblock'
+        call('get_asset_info', {'assets': ['XCP']})
+
+        upstream.height += 1  # counterparty-server parses the block...
+        publisher.send_multipart([b'hashblock', b'\x00' * 32, b'\x00\x00\x00\x00'])  # ...bitcoind announced
+        deadline = time.time() + 5
+        while response_cache.height != 800001 and time.time() < deadline:
+            time.sleep(0.02)
+        assert response_cache.height == 800001
+        assert call('get_asset_info', {'assets': ['XCP']})[1] == 'miss'
+    finally:
+        publisher.close(linger=0)
+
+
+def test_metrics(cache):
+    response_cache, upstream, call, metrics = cache
+    before = metrics()
+    assert before['block_height'] == 800000
+    assert before['invalidations_total'] == 1  # the initial height
+    call('get_balances')
+    call('get_balances')
+    call('get_balances')
+    call('get_mempool')
+    after = metrics()
+    assert after['misses_total'] - before.get('misses_total', 0) == 1
+    assert after['hits_total'] - before.get('hits_total', 0) == 2
+    assert after['uncacheable_total'] - before.get('uncacheable_total', 0) == 1
+    assert after['hit_ratio'] == pytest.approx(2 / 3.0, abs=0.001)
+    assert after['entries'] == 1 and after['bytes'] > 0
+
+    upstream.height += 1
+    response_cache.update_height()
+    flushed = metrics()
+    assert flushed['invalidations_total'] == 2
+    assert flushed['entries'] == 0
+    assert flushed['block_height'] == 800001
+
+
+def test_concurrent_counts(cache):
+    _, _, call, metrics = cache
+    call('get_balances')
+
+    def worker():
+        for i in range(50):
+            call('get_balances' if i % 5 else 'get_mempool')
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    counts = metrics()
+    assert counts['misses_total'] == 1
+    assert counts['hits_total'] == 8 * 40
+    assert counts['uncacheable_total'] == 8 * 10
@@ -0,0 +1,145 @@
+import http.server
+import json
+import os
+import socketserver
+import tempfile
+import threading
+import urllib.parse
+
+import pytest
+
+import fednode
+
+
+class FakeDockerHandler(http.server.BaseHTTPRequestHandler):
+    """Answers the few Engine API calls fednode makes, from the server's in-memory state"""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        state = self.server.state
+        state['requests'].append(('GET', self.path))
+        parts = [urllib.parse.unquote(part) for part in url.path.strip('/').split('/')]
+        if url.path == '/containers/json':
+            all_containers = urllib.parse.parse_qs(url.query).get('all') == ['1']
+            self.send_json(200, [c for c in state['containers'].values() if all_containers or c['State']['Running']])
+        elif parts[0] == 'containers' and parts[-1] == 'json':
+            container = state['containers'].get(parts[1])
+            self.send_json(200, container) if container else self.send_json(404, {'message': "No such container: " + parts[1]})
+        elif url.path == '/images/json':
+            self.send_json(200, list(state['images'].values()))
+        elif url.path == '/broken':
+            self.send_json(500, {'message': "server error"})
+        else:
+            self.send_json(404, {'message': "page not found"})
+
+    def do_DELETE(self):
+        state = self.server.state
+        state['requests'].append(('DELETE', self.path))
+        parts = [urllib.parse.unquote(part) for part in urllib.parse.urlparse(self.path).path.strip('/').split('/')]
+        collection = state[parts[0]]
+        if parts[1] not in collection:
+            self.send_json(404, {'message': "No such {}: {}".format(parts[0][:-1], parts[1])})
+        elif parts[1] in state['in_use']:
+            self.send_json(409, {'message': "conflict: {} is in use".format(parts[1])})
+        else:
+            del collection[parts[1]]
+            self.send_response(204)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+
+class FakeDockerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ('local', 0)  # BaseHTTPRequestHandler expects a (host, port) address
+
+
+@pytest.fixture
+def docker():
+    socket_dir = tempfile.mkdtemp()
+    socket_path = os.path.join(socket_dir, 'docker.sock')
+    server = FakeDockerServer(socket_path, FakeDockerHandler)
+    server.state = {
+        'containers': {
+            'federatednode_bitcoin_1': {'Id': 'federatednode_bitcoin_1', 'State': {'Running': True}, 'LogPath': '/logs/bitcoin.log'},
+            'federatednode_redis_1': {'Id': 'federatednode_redis_1', 'State': {'Running': False}},
+        },
+        'images': {'sha256:aaa': {'Id': 'sha256:aaa'}, 'sha256:bbb': {'Id': 'sha256:bbb'}},
+        'in_use': {'sha256:bbb'},
+        'requests': [],
+    }
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    client = fednode.DockerClient(socket_path, timeout=5)
+    yield client, server.state
+    client.close()
+    server.shutdown()
+    server.server_close()
+    os.remove(socket_path)
+    os.rmdir(socket_dir)
+
+
+def test_list_containers(docker):
+    client, _ = docker
+    assert sorted(c['Id'] for c in client.list_containers(all=True)) == ['federatednode_bitcoin_1', 'federatednode_redis_1']
+    assert [c['Id'] for c in client.list_containers(all=False)] == ['federatednode_bitcoin_1']
+
+
+def test_inspect_container(docker):
+    client, _ = docker
+    assert client.inspect_container('federatednode_bitcoin_1')['LogPath'] == '/logs/bitcoin.log'
+    assert client.inspect_containers(['federatednode_redis_1', 'federatednode_nope_1']) == {
+        'federatednode_redis_1': {'Id': 'federatednode_redis_1', 'State': {'Running': False}},
+        'federatednode_nope_1': None,  # a 404 is "doesn't exist", not an error
+    }
+
+
+def test_requests_share_one_connection(docker):
+    client, state = docker
+    client.list_containers()
+    sock = client.conn.sock
+    client.list_images()
+    assert client.conn.sock is sock
+    assert len(state['requests']) == 2
+
+
+def test_remove_reports_errors_per_id(docker):
+    client, state = docker
+    errors = client.remove_images(['sha256:aaa', 'sha256:bbb', 'sha256:ccc'])
+    assert errors['sha256:aaa'] is None
+    assert 'in use' in errors['sha256:bbb']  # 409
+    assert 'No such image' in errors['sha256:ccc']  # 404
+    assert list(state['images']) == ['sha256:bbb']
+
+
+def test_remove_containers(docker):
+    client, state = docker
+    assert client.remove_containers(['federatednode_redis_1'], force=True) == {'federatednode_redis_1': None}
+    assert ('DELETE', '/containers/federatednode_redis_1?force=1') in state['requests']
+    assert list(state['containers']) == ['federatednode_bitcoin_1']
+
+
+def test_api_error(docker):
+    client, _ = docker
+    with pytest.raises(fednode.DockerAPIError) as error:
+        client.request('GET', '/broken')
+    assert error.value.status == 500
+    assert error.value.message == "server error"
+    with pytest.raises(fednode.DockerAPIError) as error:
+        client.request('GET', '/nowhere')
+    assert error.value.status == 404  # only an error when the caller didn't expect it
+    assert client.request('GET', '/nowhere', not_found_ok=True) is None
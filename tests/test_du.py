@@ -0,0 +1,100 @@
+import json
+import os
+import time
+
+import pytest
+
+import fednode
+
+GB = 1024 ** 3
+DAY = 86400
+
+
+def make_usage(volumes, logs, used, free=100 * GB):
+    return {'volumes': dict((name, {'bytes': size, 'files': 1, 'errors': 0, 'subdirs': {'.': size}}) for name, size in volumes.items()),
+        'logs': {'counterparty': {'bytes': logs, 'files': 2}},
+        'filesystems': {'2049': {'size_bytes': used + free, 'used_bytes': used, 'free_bytes': free, 'mount': '/', 'names': list(volumes)}},
+        'elapsed': 0.5}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1800000000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    return now
+
+
+def test_growth(tmp_path, clock):
+    history_path = str(tmp_path / 'du.json')
+    assert fednode.update_du_history(make_usage({'bitcoin-data': 100 * GB}, GB, 200 * GB), history_path) is None
+    # too soon after the first scan for a rate
+    clock[0] += 600
+    assert fednode.update_du_history(make_usage({'bitcoin-data': 100 * GB}, GB, 200 * GB), history_path) is None
+
+    clock[0] += DAY - 600
+    growth = fednode.update_du_history(make_usage({'bitcoin-data': 102 * GB, 'mongodb-data': GB}, 2 * GB, 203 * GB), history_path)
+    assert growth['span'] == DAY
+    assert growth['volumes'] == {'bitcoin-data': 2.0 * GB / DAY}  # (no rate for a volume that's new since)
+    assert growth['logs'] == 1.0 * GB / DAY
+    assert growth['filesystems'] == {'2049': 3.0 * GB / DAY}
+
+    # the rate is over the last DU_GROWTH_WINDOW, from the oldest scan in it
+    clock[0] += fednode.DU_GROWTH_WINDOW
+    growth = fednode.update_du_history(make_usage({'bitcoin-data': 116 * GB}, 2 * GB, 217 * GB), history_path)
+    assert growth['span'] == fednode.DU_GROWTH_WINDOW
+    assert growth['volumes']['bitcoin-data'] == pytest.approx(14.0 * GB / fednode.DU_GROWTH_WINDOW)
+    assert growth['logs'] == 0
+
+
+def test_history_is_bounded(tmp_path, clock, monkeypatch):
+    monkeypatch.setattr(fednode, 'DU_HISTORY_MAX', 5)
+    history_path = str(tmp_path / 'du.json')
+    for i in range(8):
+        fednode.update_du_history(make_usage({'bitcoin-data': i * GB}, 0, i * GB), history_path)
+        clock[0] += 3600
+    with open(history_path) as f:
+        history = json.load(f)
+    assert [entry['volumes']['bitcoin-data'] for entry in history] == [i * GB for i in range(3, 8)]
+
+
+def test_forecast(capsys):
+    usage = make_usage({'bitcoin-data': 100 * GB, 'counterparty-data': 10 * GB}, GB, 200 * GB, free=30 * GB)
+    growth = {'span': DAY, 'logs': 0.1 * GB / DAY, 'volumes': {'bitcoin-data': 2.0 * GB / DAY, 'counterparty-data': -0.5 * GB / DAY},
+        'filesystems': {'2049': 3.0 * GB / DAY}}
+    fednode.print_disk_usage(usage, growth, {'counterparty': {'max-size': '30m', 'max-file': '10'}})
+    output = capsys.readouterr().out
+    assert "Filesystem /: 200.0G of 230.0G used, 30.0G free; full in ~10.0 days at +3.0G/day" in output
+    lines = output.splitlines()
+    assert lines[1].split() == ['bitcoin-data', '100.0G', '1', '+2.0G/day']
+    assert [l for l in lines if l.startswith('counterparty-data')][0].split()[-1] == '-512.0M/day'
+    assert [l for l in lines if l.startswith('  counterparty ')][0].split() == ['counterparty', '1.0G', 'of', '300.0M', 'max']
+
+    growth['filesystems']['2049'] = 0.0
+    fednode.print_disk_usage(usage, growth, {})
+    assert "30.0G free; not growing" in capsys.readouterr().out
+    fednode.print_disk_usage(usage, None, {})
+    output = capsys.readouterr().out
+    assert "no growth rate yet" in output and "(unbounded)" in output
+
+
+def test_scan(tmp_path):
+    root = tmp_path / 'volume'
+    (root / 'chainstate').mkdir(parents=True)
+    (root / 'blocks' / 'index').mkdir(parents=True)
+    (root / 'chainstate' / 'a.ldb').write_bytes(b'x' * 100000)
+    (root / 'blocks' / 'blk00000.dat').write_bytes(b'y' * 300000)
+    (root / 'blocks' / 'index' / 'b.ldb').write_bytes(b'z' * 5000)
+    (root / 'settings.json').write_bytes(b'{}')
+    os.link(str(root / 'blocks' / 'blk00000.dat'), str(root / 'blocks' / 'link.dat'))
+
+    usage = fednode.scan_disk_usage({'bitcoin-data': str(root)}, jobs=4)['bitcoin-data']
+    blocks = lambda path: os.lstat(str(path)).st_blocks * 512
+    # like du: each file and directory's allocated blocks, the hard link counted once
+    assert usage['subdirs'] == {
+        '.': blocks(root) + blocks(root / 'settings.json'),
+        'chainstate': blocks(root / 'chainstate') + blocks(root / 'chainstate' / 'a.ldb'),
+        'blocks': blocks(root / 'blocks') + blocks(root / 'blocks' / 'index') + blocks(root / 'blocks' / 'blk00000.dat') +
+            blocks(root / 'blocks' / 'index' / 'b.ldb'),
+    }
+    assert usage['bytes'] == sum(usage['subdirs'].values())
+    assert usage['files'] == 5 and usage['errors'] == 0
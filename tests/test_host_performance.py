@@ -0,0 +1,172 @@
+import importlib.util
+import json
+import logging
+import os
+
+import pytest
+
+RUN_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'extras', 'host_security', 'run.py')
+
+
+@pytest.fixture
+def run(monkeypatch):
+    # extras/host_security/run.py is a script of its own, outside of the fednode module
+    spec = importlib.util.spec_from_file_location('host_security_run', RUN_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.commands = []
+    monkeypatch.setattr(module, 'runcmd', lambda command, abort_on_failure=True: module.commands.append(command))
+    monkeypatch.setattr(module, 'get_docker_storage_driver', lambda: 'overlay2')
+    return module
+
+
+def write(path, content):
+    os.makedirs(os.path.dirname(str(path)), exist_ok=True)
+    with open(str(path), 'w') as f:
+        f.write(content)
+
+
+def read(path):
+    with open(str(path)) as f:
+        return f.read()
+
+
+@pytest.fixture
+def host(tmp_path, run, monkeypatch):
+    """A /sys, /proc and /etc tree of a host whose docker root is on partition sdz1 of disk sdz"""
+    root = tmp_path / 'host'
+    docker_root = tmp_path / 'docker'
+    docker_root.mkdir()
+    disk = root / 'sys' / 'devices' / 'pci0000:00' / 'block' / 'sdz'
+    write(disk / 'queue' / 'scheduler', "[none] mq-deadline bfq\n")
+    write(disk / 'queue' / 'read_ahead_kb', "128\n")
+    write(disk / 'queue' / 'rotational', "1\n")
+    write(disk / 'sdz1' / 'partition', "1\n")
+    st = os.stat(str(docker_root))
+    for link, target in (('sys/dev/block/%d:%d' % (os.major(st.st_dev), os.minor(st.st_dev)), disk / 'sdz1'),
+            ('sys/block/sdz', disk), ('sys/class/block/sdz', disk)):
+        os.makedirs(os.path.dirname(str(root / link)), exist_ok=True)
+        os.symlink(str(target), str(root / link))
+    for key, value in (('vm/swappiness', 60), ('vm/dirty_background_ratio', 10), ('vm/dirty_ratio', 20),
+            ('vm/dirty_expire_centisecs', 3000), ('vm/dirty_writeback_centisecs', 500), ('vm/max_map_count', 65530),
+            ('fs/file-max', 9223372036854775807), ('net/core/somaxconn', 4096)):
+        write(root / 'proc' / 'sys' / key, "%d\n" % value)
+    write(root / 'sys' / 'kernel' / 'mm' / 'transparent_hugepage' / 'enabled', "always [madvise] never\n")
+    write(root / 'sys' / 'kernel' / 'mm' / 'transparent_hugepage' / 'defrag', "always defer [madvise] never\n")
+    write(root / 'etc' / 'docker' / 'daemon.json', json.dumps({'data-root': '/data/docker', 'dns': ['10.0.0.1'],
+        'log-opts': {'max-size': '100m'}}))
+    monkeypatch.setattr(run, 'HOST_ROOT', str(root))
+    return root, disk, str(docker_root)
+
+
+def plan_descriptions(run, docker_root):
+    return [description for description, _ in run.plan_performance_setup(docker_root)]
+
+
+def test_block_device(run, host):
+    root, disk, docker_root = host
+    assert run.get_block_device(docker_root) == ('sdz', True)
+    assert run.get_block_device(name='sdz') == ('sdz', True)
+
+
+def test_hdd_plan(run, host):
+    root, disk, docker_root = host
+    plan = plan_descriptions(run, docker_root)
+    assert "set the IO scheduler of sdz (HDD) from none to mq-deadline" in plan
+    assert "set the read-ahead of sdz from 128 to 1024 KB" in plan
+
+    # a larger read-ahead on an HDD is kept
+    write(disk / 'queue' / 'read_ahead_kb', "8192\n")
+    plan = plan_descriptions(run, docker_root)
+    assert not [p for p in plan if p.startswith("set the read-ahead")]
+    assert [p for p in plan if p.startswith("persist them") and p.endswith('ATTR{queue/read_ahead_kb}="8192", ATTR{queue/scheduler}="mq-deadline"')]
+
+
+def test_ssd_plan(run, host):
+    root, disk, docker_root = host
+    write(disk / 'queue' / 'rotational', "0\n")
+    write(disk / 'queue' / 'scheduler', "none [mq-deadline] kyber\n")
+    write(disk / 'queue' / 'read_ahead_kb', "4096\n")
+    plan = plan_descriptions(run, docker_root)
+    assert "set the IO scheduler of sdz (SSD) from mq-deadline to none" in plan
+    assert "set the read-ahead of sdz from 4096 to 128 KB" in plan
+
+
+def test_apply(run, host):
+    root, disk, docker_root = host
+    for description, apply in run.plan_performance_setup(docker_root):
+        apply()
+
+    assert read(disk / 'queue' / 'scheduler') == "mq-deadline"
+    assert read(disk / 'queue' / 'read_ahead_kb') == "1024"
+    assert read(root / 'etc' / 'udev' / 'rules.d' / '60-fednode-io.rules') == \
+        'ACTION=="add|change", KERNEL=="sdz", ATTR{queue/read_ahead_kb}="1024", ATTR{queue/scheduler}="mq-deadline"\n'
+
+    # the sysctls, but none the host already has higher
+    sysctl_conf_path = str(root / 'etc' / 'sysctl.d' / '61-fednode-performance.conf')
+    assert read(sysctl_conf_path) == ("vm.swappiness = 10\nvm.dirty_background_ratio = 5\nvm.dirty_ratio = 15\n"
+        "vm.dirty_expire_centisecs = 1500\nvm.dirty_writeback_centisecs = 500\nvm.max_map_count = 262144\n")
+    assert run.commands[0] == "sysctl -p %s > /dev/null" % sysctl_conf_path
+
+    assert read(root / 'sys' / 'kernel' / 'mm' / 'transparent_hugepage' / 'enabled') == "never"
+    assert read(root / 'sys' / 'kernel' / 'mm' / 'transparent_hugepage' / 'defrag') == "never"
+    assert len(run.commands) == 1  # (not booted with systemd, so no boot service)
+    assert read(root / 'etc' / 'security' / 'limits.d' / '90-fednode.conf') == read(os.path.join(run.DIST_PATH, 'limits_performance.conf'))
+
+    # the docker options are added to the existing ones, which are kept as they were
+    assert json.loads(read(root / 'etc' / 'docker' / 'daemon.json')) == {
+        'data-root': '/data/docker', 'dns': ['10.0.0.1'],
+        'log-driver': 'json-file', 'log-opts': {'max-size': '100m', 'max-file': '10'},
+        'default-ulimits': {'nofile': {'Name': 'nofile', 'Soft': 1048576, 'Hard': 1048576}},
+        'storage-driver': 'overlay2',
+    }
+
+    # and (with the kernel's view of what was written) nothing is left to do but the sysctls, which the fake /proc doesn't take
+    write(disk / 'queue' / 'scheduler', "none [mq-deadline] bfq\n")
+    write(root / 'sys' / 'kernel' / 'mm' / 'transparent_hugepage' / 'enabled', "always madvise [never]\n")
+    plan = plan_descriptions(run, docker_root)
+    assert len(plan) == 1 and plan[0].startswith("set sysctls")
+
+
+def test_unreadable_daemon_config(run, host, caplog):
+    root, disk, docker_root = host
+    write(root / 'etc' / 'docker' / 'daemon.json', "{not json")
+    with caplog.at_level(logging.WARNING):
+        plan = plan_descriptions(run, docker_root)
+    assert not [p for p in plan if "docker daemon" in p]
+    assert "isn't valid JSON" in caplog.text
+
+
+def test_other_log_driver(run, host):
+    root, disk, docker_root = host
+    write(root / 'etc' / 'docker' / 'daemon.json', json.dumps({'log-driver': 'journald'}))
+    description, = [p for p in plan_descriptions(run, docker_root) if "docker daemon" in p]
+    assert "log-opts" not in description and "default-ulimits" in description
+
+
+def test_merge_config(run):
+    current = {'log-opts': {'max-size': '100m'}, 'default-ulimits': {'nofile': {'Name': 'nofile', 'Soft': 1024, 'Hard': 4096}},
+        'debug': True}
+    merged, added, conflicts = run.merge_config(current, run.DOCKER_DAEMON_OPTIONS)
+    assert merged['debug'] is True
+    assert merged['log-opts'] == {'max-size': '100m', 'max-file': '10'}
+    # (only merged one level down, so an existing ulimit is kept whole)
+    assert merged['default-ulimits'] == current['default-ulimits']
+    assert added == [('log-driver', 'json-file'), ('log-opts.max-file', '10')]
+    assert conflicts == [('default-ulimits.nofile', current['default-ulimits']['nofile'], run.DOCKER_DAEMON_OPTIONS['default-ulimits']['nofile']),
+        ('log-opts.max-size', '100m', '30m')]
+    assert current == {'log-opts': {'max-size': '100m'}, 'default-ulimits': {'nofile': {'Name': 'nofile', 'Soft': 1024, 'Hard': 4096}},
+        'debug': True}
+
+
+def test_dry_run(run, host, caplog):
+    root, disk, docker_root = host
+    daemon_config = read(root / 'etc' / 'docker' / 'daemon.json')
+    with caplog.at_level(logging.INFO):
+        run.do_performance_setup(docker_root, dry_run=True, bench=False)
+    assert "Planned changes (dry run, nothing changed):" in caplog.text
+    assert "  - set the read-ahead of sdz from 128 to 1024 KB" in caplog.text
+    assert read(disk / 'queue' / 'read_ahead_kb') == "128\n"
+    assert read(root / 'etc' / 'docker' / 'daemon.json') == daemon_config
+    assert not os.path.exists(str(root / 'etc' / 'sysctl.d')) and not os.path.exists(str(root / 'etc' / 'udev'))
+    assert run.commands == []
@@ -0,0 +1,75 @@
+import json
+from datetime import datetime, timezone
+
+import pytest
+
+import fednode
+
+START = datetime(2026, 1, 1, tzinfo=timezone.utc).timestamp()
+
+
+def log_line(t, text):
+    timestamp = datetime.fromtimestamp(t, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+    return json.dumps({'log': text + '\n', 'stream': 'stdout', 'time': timestamp}) + '\n'
+
+
+@pytest.fixture
+def log_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(fednode, 'LOG_INDEX_DIR', str(tmp_path / 'logindex'))
+    path = tmp_path / 'container-json.log'
+    # the rotated file: entries 0-99, one a second
+    with open(str(path) + '.1', 'w') as f:
+        f.writelines(log_line(START + i, "line {}".format(i)) for i in range(100))
+    # the current one starts with the tail of a garbled line, so the index sample at its start doesn't parse
+    with open(str(path), 'w') as f:
+        f.write('ed", "stream": "stdout"}\n')
+        f.writelines(log_line(START + i, "line {}".format(i)) for i in range(100, 110))
+    return str(path)
+
+
+def texts(entries):
+    return [text for t, text in entries]
+
+
+def test_index_of_file_shorter_than_stride(log_path):
+    index = fednode.get_log_index('counterparty', log_path)
+    rotated, current = index[log_path + '.1'], index[log_path]
+    assert rotated['first_time'] == START and rotated['last_time'] == START + 99
+    assert len(rotated['points']) == 1
+    # entries but no index points
+    assert current['points'] == [] and current['first_time'] is None and current['last_time'] == START + 109
+    # and it's persisted, and reused as is
+    assert fednode.get_log_index('counterparty', log_path) == index
+
+
+def test_read_with_until_and_unindexed_start(log_path):
+    index = fednode.get_log_index('counterparty', log_path)
+    until = START + 104
+    entries = list(fednode.read_log_entries(log_path, since=START + 98, until=until, index=index))
+    assert texts(entries) == ["line {}".format(i) for i in range(98, 105)]
+    # everything in the rotated file is before the window
+    entries = list(fednode.read_log_entries(log_path, since=START + 102, until=until, index=index))
+    assert texts(entries) == ["line {}".format(i) for i in range(102, 105)]
+
+
+def test_tail_with_until_and_unindexed_start(log_path):
+    index = fednode.get_log_index('counterparty', log_path)
+    entries = fednode.tail_log_entries(log_path, 3, until=START + 104, index=index)
+    assert texts(entries) == ["line 102", "line 103", "line 104"]
+    entries = fednode.tail_log_entries(log_path, 4, since=START + 98, until=START + 101, index=index)
+    assert texts(entries) == ["line 98", "line 99", "line 100", "line 101"]
+    # a window entirely before the current file is answered from the rotated one
+    entries = fednode.tail_log_entries(log_path, 2, until=START + 50, index=index)
+    assert texts(entries) == ["line 49", "line 50"]
+
+
+def test_read_with_index_points(log_path, monkeypatch):
+    # a small stride, so the files get several index points to seek by
+    monkeypatch.setattr(fednode, 'LOG_INDEX_INTERVAL', 512)
+    index = fednode.get_log_index('counterparty', log_path)
+    assert len(index[log_path + '.1']['points']) > 5
+    entries = list(fednode.read_log_entries(log_path, since=START + 60, until=START + 62, index=index))
+    assert texts(entries) == ["line 60", "line 61", "line 62"]
+    assert list(fednode.read_log_entries(log_path, until=START - 1, index=index)) == []
+    entries = fednode.tail_log_entries(log_path, 2, since=START + 10, until=START + 70, index=index)
+    assert texts(entries) == ["line 69", "line 70"]
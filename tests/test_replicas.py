@@ -0,0 +1,137 @@
+import http.client
+import http.server
+import json
+import os
+import threading
+
+import pytest
+
+import fednode
+
+
+@pytest.fixture
+def replicas(tmp_path, monkeypatch):
+    # a replicas compose file with two mainnet replicas and one testnet one
+    monkeypatch.setattr(fednode, 'SCRIPTDIR', str(tmp_path))
+    rendered = fednode.render_replicas_compose({'counterparty': 2, 'counterparty-testnet': 1},
+        {'counterparty': ['bitcoin', 'addrindexrs'], 'counterparty-testnet': []})
+    with open(os.path.join(str(tmp_path), fednode.REPLICAS_COMPOSE_FILE), 'w') as f:
+        f.write(rendered)
+    return rendered
+
+
+def test_render_replicas_compose(replicas):
+    model = fednode.load_yaml_file(os.path.join(fednode.SCRIPTDIR, fednode.REPLICAS_COMPOSE_FILE))
+    services = model['services']
+    assert sorted(services) == ['counterparty-replica1', 'counterparty-replica2', 'counterparty-testnet-replica1']
+    assert sorted(model['volumes']) == ['counterparty-replica1-data', 'counterparty-replica2-data', 'counterparty-testnet-replica1-data']
+
+    replica = services['counterparty-replica2']
+    assert replica['extends'] == {'file': 'docker-compose.tmpl.yml', 'service': 'counterparty-base'}
+    assert replica['hostname'] == '${HOSTNAME_BASE}-cp-r2'
+    assert replica['ports'] == ['127.0.0.1:4003:4000']
+    assert 'BTC_NETWORK=mainnet' in replica['environment']
+    assert 'PARAMS=--config-file=/root/.config/counterparty/server.conf' in replica['environment']
+    assert replica['volumes'] == ['./config/counterparty:/root/.config/counterparty', 'counterparty-replica2-data:/root/.local/share/counterparty']
+    assert replica['links'] == ['bitcoin', 'addrindexrs']
+
+    testnet = services['counterparty-testnet-replica1']
+    assert testnet['ports'] == ['127.0.0.1:14002:14000']
+    assert testnet['hostname'] == '${HOSTNAME_BASE}-cp-t-r1'
+    assert 'BTC_NETWORK=testnet' in testnet['environment']
+    assert 'links' not in testnet
+
+
+def test_replica_groups(replicas):
+    assert fednode.get_replica_groups() == {'counterparty': ['counterparty-replica1', 'counterparty-replica2'],
+        'counterparty-testnet': ['counterparty-testnet-replica1']}
+    assert fednode.expand_replica_groups(['bitcoin', 'counterparty', 'counterparty-replica1']) == [
+        'bitcoin', 'counterparty', 'counterparty-replica1', 'counterparty-replica2']
+    assert fednode.expand_replica_groups([]) == []
+
+
+@pytest.fixture
+def balancer(replicas, monkeypatch):
+    statuses = {}
+
+    def probe_service_status(service, probe, port, config_file, timeout=None):
+        up, height, latency_ms = statuses[service]
+        return {'service': service, 'up': up, 'height': height, 'latency_ms': latency_ms}
+    monkeypatch.setattr(fednode, 'probe_service_status', probe_service_status)
+    balancer = fednode.CounterpartyBalancer('counterparty')
+    balancer.statuses = statuses
+    return balancer
+
+
+def test_balancer_backends(balancer):
+    assert balancer.backends == [('counterparty', 4000), ('counterparty-replica1', 4002), ('counterparty-replica2', 4003)]
+
+
+def test_balancer_choice(balancer):
+    balancer.statuses.update({'counterparty': (True, 800000, 30.0), 'counterparty-replica1': (True, 800000, 10.0),
+        'counterparty-replica2': (True, 800000, 20.0)})
+    balancer.check()
+    # the least busy, then the quickest to answer
+    assert balancer.acquire() == ('counterparty-replica1', 4002)
+    assert balancer.acquire() == ('counterparty-replica2', 4003)
+    assert balancer.acquire() == ('counterparty', 4000)
+    assert balancer.acquire() == ('counterparty-replica1', 4002)
+    for name in ('counterparty-replica1', 'counterparty-replica2', 'counterparty', 'counterparty-replica1'):
+        balancer.release(name)
+    assert all(state['in_flight'] == 0 for state in balancer.state.values())
+
+    # a backend more than BALANCER_MAX_LAG blocks behind the most advanced one, or down, gets nothing
+    balancer.statuses.update({'counterparty': (True, 800002, 30.0), 'counterparty-replica1': (True, 800000, 10.0),
+        'counterparty-replica2': (False, None, None)})
+    balancer.check()
+    assert balancer.acquire() == ('counterparty', 4000)
+    assert balancer.acquire() == ('counterparty', 4000)
+    balancer.release('counterparty')
+    balancer.release('counterparty')
+    balancer.statuses['counterparty-replica1'] = (True, 800001, 10.0)
+    balancer.check()
+    assert balancer.acquire() == ('counterparty-replica1', 4002)
+    assert balancer.acquire(exclude=['counterparty-replica1']) == ('counterparty', 4000)
+
+    # a failed request takes the backend out until the next check
+    balancer.release('counterparty', failed=True)
+    balancer.release('counterparty-replica1', failed=True)
+    assert balancer.acquire() is None
+    balancer.check()
+    assert balancer.acquire() == ('counterparty-replica1', 4002)
+
+
+def test_balancer_fails_over(balancer):
+    stub = fednode.start_bench_stub()
+    server = None
+    try:
+        # the preferred backend refuses connections, so the request goes on to the next one
+        balancer.backends = [('counterparty', stub.server_address[1]), ('counterparty-replica1', 1)]
+        balancer.statuses.update({'counterparty': (True, 800000, 30.0), 'counterparty-replica1': (True, 800000, 10.0)})
+        balancer.check()
+        handler = type('Handler', (fednode.BalancerHandler,), {'balancer': balancer})
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        conn = http.client.HTTPConnection('127.0.0.1', server.server_address[1], timeout=5)
+        conn.request('POST', '/api/', json.dumps({'jsonrpc': '2.0', 'id': 1, 'method': 'get_running_info'}),
+            {'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        assert response.status == 200
+        assert response.getheader('X-Fednode-Backend') == 'counterparty'
+        assert json.loads(response.read()) == {'result': [], 'error': None, 'id': 1}
+        assert balancer.state['counterparty-replica1']['up'] is False
+        assert all(state['in_flight'] == 0 for state in balancer.state.values())
+
+        # and with none left, the client gets a 503
+        balancer.release(balancer.acquire()[0], failed=True)
+        conn.request('POST', '/api/', '{}', {'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        response.read()
+        assert response.status == 503
+        conn.close()
+    finally:
+        stub.shutdown()
+        if server:
+            server.shutdown()
@@ -0,0 +1,99 @@
+import os
+import sqlite3
+
+import pytest
+
+import fednode
+
+
+def rows(db_path, table='balances'):
+    db = sqlite3.connect(db_path)
+    try:
+        return db.execute("SELECT * FROM {} ORDER BY rowid".format(table)).fetchall()
+    finally:
+        db.close()
+
+
+@pytest.fixture
+def live_db(tmp_path):
+    # a counterparty-like database in WAL mode, whose writes stay in the WAL (as between checkpoints of a running server)
+    db_path = str(tmp_path / 'counterparty.db')
+    db = sqlite3.connect(db_path)
+    db.execute("PRAGMA journal_mode = WAL")
+    db.execute("PRAGMA wal_autocheckpoint = 0")
+    db.execute("CREATE TABLE blocks (block_index INTEGER PRIMARY KEY, block_hash TEXT)")
+    db.execute("CREATE TABLE balances (address TEXT, asset TEXT, quantity INTEGER)")
+    db.executemany("INSERT INTO blocks VALUES (?, ?)", [(i, "{:064x}".format(i)) for i in range(300000, 300100)])
+    db.executemany("INSERT INTO balances VALUES (?, ?, ?)", [("address{}".format(i), "XCP", i) for i in range(20000)])
+    db.commit()
+    db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    yield db_path, db
+    db.close()
+
+
+def test_snapshots_store_only_the_changed_chunks(live_db, tmp_path, capsys, monkeypatch):
+    monkeypatch.setattr(fednode, 'SNAPSHOT_CHUNK_PAGES', 8)
+    db_path, db = live_db
+    store = str(tmp_path / 'store')
+    assert fednode.snapshot_create(db_path, store, 'counterparty')
+    first_rows = rows(db_path)
+
+    # a new block changes a few rows, which stays in the WAL
+    db.execute("INSERT INTO blocks VALUES (300100, 'ff')")
+    db.execute("UPDATE balances SET quantity = quantity + 1 WHERE address IN ('address10', 'address11')")
+    db.commit()
+    assert os.path.getsize(db_path + '-wal') > 0
+    assert fednode.snapshot_create(db_path, store, 'counterparty')
+    second_rows = rows(db_path)
+
+    first, second = fednode.load_snapshots(store, 'counterparty')
+    assert first['block_index'] == 300099 and second['block_index'] == 300100
+    assert len(first['chunks']) == len(second['chunks']) > 10
+    assert first['new_chunks'] == len(set(first['chunks']))
+    changed = [i for i, (a, b) in enumerate(zip(first['chunks'], second['chunks'])) if a != b]
+    assert 0 < second['new_chunks'] == len(changed) <= 3
+    assert len(os.listdir(os.path.join(store, 'snapshots'))) == 2
+    assert sum(len(files) for _, _, files in os.walk(os.path.join(store, 'objects'))) == len(set(first['chunks'] + second['chunks']))
+
+    fednode.snapshot_list(store, 'counterparty')
+    output = capsys.readouterr().out
+    assert first['id'] in output and second['id'] in output
+
+    # both restore to the database as it was when they were taken
+    db.close()
+    assert fednode.snapshot_restore(db_path, store, first['id'])
+    assert not os.path.exists(db_path + '-wal')
+    assert rows(db_path) == first_rows and rows(db_path, 'blocks')[-1][0] == 300099
+    assert fednode.snapshot_restore(db_path, store, second['id'])
+    assert rows(db_path) == second_rows and rows(db_path, 'blocks')[-1][0] == 300100
+    check = sqlite3.connect(db_path)
+    assert check.execute("PRAGMA integrity_check").fetchone()[0] == 'ok'
+    check.close()
+
+
+def test_reader_view_is_consistent(live_db, tmp_path):
+    db_path, db = live_db
+    db.execute("UPDATE balances SET quantity = -1 WHERE address = 'address5'")
+    db.commit()
+    expected = rows(db_path)
+    reader = fednode.DbSnapshotReader(db_path)
+    try:
+        assert reader.frames
+        # writes committed and checkpointed into the database file after the view was taken don't show in it
+        db.execute("UPDATE balances SET quantity = -2")
+        db.execute("DELETE FROM balances WHERE rowid > 10000")
+        db.commit()
+        db.execute("PRAGMA wal_checkpoint(PASSIVE)")
+        copy_path = str(tmp_path / 'copy.db')
+        with open(copy_path, 'wb') as f:
+            for first in range(1, reader.page_count + 1, 7):
+                f.write(reader.read_pages(first, 7))
+    finally:
+        reader.close()
+    assert rows(copy_path) == expected
+    assert rows(db_path) != expected
+
+
+def test_snapshot_of_missing_db(tmp_path, capsys):
+    assert not fednode.snapshot_create(str(tmp_path / 'missing.db'), str(tmp_path / 'store'), 'counterparty')
+    assert "Database not found" in capsys.readouterr().out
@@ -0,0 +1,172 @@
+import http.server
+import json
+import socket
+import socketserver
+import threading
+
+import pytest
+
+import fednode
+
+
+class StubRPCHandler(http.server.BaseHTTPRequestHandler):
+    """JSON-RPC over HTTP, answering from the server's method -> (HTTP status, reply) map"""
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        status, reply = self.server.replies.get(request['method'], (404, {'error': {'message': "Method not found"}}))
+        body = json.dumps(dict(reply, id=request['id'])).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StubElectrumHandler(socketserver.StreamRequestHandler):
+    """Newline delimited JSON-RPC over TCP, as addrindexrs speaks it"""
+
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        self.wfile.write((json.dumps({'id': request['id'], 'result': self.server.replies[request['method']]}) + '\n').encode())
+
+
+def serve(server_class, handler, replies):
+    server = server_class(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    server.replies = replies
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def stubs(monkeypatch):
+    servers = []
+
+    def rpc(replies):
+        servers.append(serve(http.server.ThreadingHTTPServer, StubRPCHandler, replies))
+        return servers[-1].server_address[1]
+
+    def electrum(height):
+        servers.append(serve(socketserver.ThreadingTCPServer, StubElectrumHandler,
+            {'blockchain.headers.subscribe': {'height': height, 'hex': '00' * 80}}))
+        return servers[-1].server_address[1]
+
+    def silent():
+        # accepts connections (through the listen backlog) but never answers
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(8)
+        servers.append(sock)
+        return sock.getsockname()[1]
+
+    def refused():
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+    def use_specs(specs):
+        monkeypatch.setattr(fednode, 'get_status_specs', lambda: specs)
+
+    yield rpc, electrum, silent, refused, use_specs
+    for server in servers:
+        if isinstance(server, socket.socket):
+            server.close()
+        else:
+            server.shutdown()
+            server.server_close()
+
+
+def bitcoind_replies(blocks, headers):
+    return {'getblockchaininfo': (200, {'result': {'blocks': blocks, 'headers': headers}, 'error': None})}
+
+
+def counterparty_replies(block_index, bitcoin_block_count):
+    return {'get_running_info': (200, {'jsonrpc': '2.0', 'result': {
+        'last_block': {'block_index': block_index}, 'bitcoin_block_count': bitcoin_block_count}})}
+
+
+def by_service(statuses):
+    return dict((status['service'], status) for status in statuses)
+
+
+def test_healthy_services(stubs):
+    rpc, electrum, _, _, use_specs = stubs
+    use_specs([
+        ('bitcoin', 'bitcoind', rpc(bitcoind_replies(800000, 800000)), None),
+        ('addrindexrs', 'addrindexrs', electrum(800000), None),
+        ('counterparty', 'counterparty', rpc(counterparty_replies(800000, 800000)), None),
+        ('xcp-proxy', 'http', rpc({}), None),  # any HTTP answer, even an error status, means it's up
+    ])
+    statuses = by_service(fednode.get_services_status(['bitcoin', 'addrindexrs', 'counterparty', 'xcp-proxy'], timeout=2))
+    assert all(status['up'] and status['error'] is None for status in statuses.values())
+    assert statuses['bitcoin']['height'] == statuses['addrindexrs']['height'] == statuses['counterparty']['height'] == 800000
+    assert statuses['bitcoin']['lag'] == statuses['addrindexrs']['lag'] == statuses['counterparty']['lag'] == 0
+    assert statuses['xcp-proxy']['lag'] is None
+    assert all(status['latency_ms'] is not None for status in statuses.values())
+
+
+def test_lagging_service(stubs):
+    rpc, electrum, _, _, use_specs = stubs
+    use_specs([
+        ('bitcoin', 'bitcoind', rpc(bitcoind_replies(800000, 800010)), None),  # itself still 10 headers behind
+        ('addrindexrs', 'addrindexrs', electrum(799990), None),
+        ('counterparty', 'counterparty', rpc(counterparty_replies(799995, 800000)), None),
+    ])
+    statuses = by_service(fednode.get_services_status(['bitcoin', 'addrindexrs', 'counterparty'], timeout=2))
+    assert statuses['bitcoin']['lag'] == 10
+    # the others lag behind our bitcoind, rather than behind what they report themselves
+    assert statuses['addrindexrs']['lag'] == 10
+    assert statuses['counterparty']['lag'] == 5
+
+
+def test_lag_without_bitcoind(stubs):
+    rpc, _, _, _, use_specs = stubs
+    use_specs([('counterparty-testnet', 'counterparty', rpc(counterparty_replies(2500000, 2500003)), None)])
+    statuses = fednode.get_services_status(['counterparty-testnet'], timeout=2)
+    assert statuses[0]['lag'] == 3  # against the backend height counterparty-server reports
+
+
+def test_connection_refused(stubs):
+    _, _, _, refused, use_specs = stubs
+    use_specs([('counterblock', 'counterblock', refused(), None)])
+    status = fednode.get_services_status(['counterblock'], timeout=2)[0]
+    assert not status['up']
+    assert status['error'] and status['height'] is None and status['lag'] is None
+
+
+def test_timeout(stubs):
+    _, _, silent, _, use_specs = stubs
+    use_specs([
+        ('addrindexrs-testnet', 'addrindexrs', silent(), None),
+        ('counterparty-testnet', 'counterparty', silent(), None),
+    ])
+    statuses = fednode.get_services_status(['addrindexrs-testnet', 'counterparty-testnet'], timeout=0.5)
+    for status in statuses:
+        assert not status['up']
+        assert 'timed out' in status['error']
+        assert 500 <= status['latency_ms'] < 2000  # bounded by the timeout, and probed concurrently
+
+
+def test_rpc_error(stubs):
+    rpc, _, _, _, use_specs = stubs
+    # bitcoind answers RPC errors with an HTTP error status and a JSON body
+    use_specs([('bitcoin-testnet', 'bitcoind', rpc({'getblockchaininfo': (500, {'result': None,
+        'error': {'code': -28, 'message': "Loading block index..."}})}), None)])
+    status = fednode.get_services_status(['bitcoin-testnet'], timeout=2)[0]
+    assert not status['up']
+    assert status['error'] == "Loading block index..."
+
+
+def test_only_requested_services_are_probed(stubs):
+    rpc, _, _, refused, use_specs = stubs
+    use_specs([
+        ('bitcoin', 'bitcoind', rpc(bitcoind_replies(1, 1)), None),
+        ('counterblock', 'counterblock', refused(), None),
+    ])
+    assert [status['service'] for status in fednode.get_services_status(['bitcoin'], timeout=2)] == ['bitcoin']
@@ -0,0 +1,84 @@
+import re
+import threading
+import time
+
+import pytest
+
+import fednode
+
+zmq = pytest.importorskip('zmq')
+
+BLOCK_HASH = bytes.fromhex('00000000000000000002a7c4c1e48d76c5a37902165a270156b7a8d72728a054')
+
+
+@pytest.fixture
+def pipeline(monkeypatch):
+    """Stub stage heights, bitcoind's getblockheader, and a local PUB socket standing in for bitcoind's ZMQ feed"""
+    heights = {'addrindexrs': 99, 'counterparty': 99, 'counterblock': 99}
+
+    def probe_service_status(service, probe, port, config_file, host='127.0.0.1', timeout=None):
+        return {'service': service, 'up': True, 'height': heights[service]}
+
+    monkeypatch.setattr(fednode, 'probe_service_status', probe_service_status)
+    monkeypatch.setattr(fednode.BlockTracer, 'get_block_height', lambda self, block_hash: 100)
+    monkeypatch.setattr(fednode, 'TRACE_POLL_INTERVAL', 0.02)
+
+    context = zmq.Context()
+    publisher = context.socket(zmq.XPUB)  # an XPUB, to know when the tracer has subscribed
+    port = publisher.bind_to_random_port('tcp://127.0.0.1')
+
+    def publish(schedule):
+        # once subscribed, announce the block, then raise the stage heights at the given delays after it
+        def run():
+            assert publisher.poll(10000)
+            assert publisher.recv() == b'\x01hashblock'
+            publisher.send_multipart([b'hashblock', BLOCK_HASH, b'\x00\x00\x00\x00'])
+            notified = time.time()
+            for delay, service in schedule:
+                time.sleep(max(notified + delay - time.time(), 0))
+                heights[service] = 100
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    yield 'tcp://127.0.0.1:{}'.format(port), publish
+    publisher.close(linger=0)
+    context.term()
+
+
+def parse_block_line(output):
+    line = [l for l in output.splitlines() if l.startswith('block 100 ')][0]
+    assert BLOCK_HASH.hex()[:16] in line
+    return dict((stage, None if seconds == 'TIMEOUT' else float(seconds))
+        for stage, seconds in re.findall(r'([\w-]+) ([\d.]+|TIMEOUT)s?', line.split(': ', 1)[1]))
+
+
+def test_stage_timings(pipeline, capsys):
+    zmq_url, publish = pipeline
+    publisher = publish([(0.3, 'addrindexrs'), (0.8, 'counterparty')])
+    assert fednode.trace_blocks('mainnet', zmq_url, count=1, timeout=10, services=['addrindexrs', 'counterparty'])
+    publisher.join(5)
+    output = capsys.readouterr().out
+    times = parse_block_line(output)
+    assert list(times) == ['addrindexrs', 'counterparty']  # counterblock isn't installed, so isn't traced
+    # each stage is timed from the one before it
+    assert times['addrindexrs'] == pytest.approx(0.3, abs=0.15)
+    assert times['counterparty'] == pytest.approx(0.5, abs=0.15)
+    assert re.search(r'counterparty [\d.]+s <- slowest', output)
+    assert re.search(r'^end to end\s+0\.[6-9]\d+s', output, re.MULTILINE)
+    assert "Slowest stage: counterparty" in output
+
+
+def test_stage_timeout(pipeline, capsys):
+    zmq_url, publish = pipeline
+    publisher = publish([(0.1, 'addrindexrs')])  # and counterparty never gets there
+    start = time.time()
+    assert fednode.trace_blocks('mainnet', zmq_url, count=1, timeout=0.5, services=['addrindexrs', 'counterparty'])
+    assert time.time() - start < 5
+    publisher.join(5)
+    output = capsys.readouterr().out
+    times = parse_block_line(output)
+    assert times['addrindexrs'] == pytest.approx(0.1, abs=0.1)
+    assert times['counterparty'] is None
+    assert re.search(r'counterparty TIMEOUT', output)
+    assert not re.search(r'^end to end', output, re.MULTILINE)  # incomplete blocks aren't in the end to end latency
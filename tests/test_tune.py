@@ -0,0 +1,103 @@
+import os
+
+import pytest
+
+import fednode
+
+GB = 1024 ** 3
+FULL = ['bitcoin', 'bitcoin-testnet', 'addrindexrs', 'addrindexrs-testnet', 'counterparty', 'counterparty-testnet',
+    'counterblock', 'counterblock-testnet', 'mongodb', 'redis', 'xcp-proxy', 'xcp-proxy-testnet',
+    'counterwallet', 'armory-utxsvr', 'armory-utxsvr-testnet']
+REPLICAS = ['counterparty-replica1', 'counterparty-replica2']
+
+
+def memory_budget(memory):
+    return (memory - max(fednode.TUNE_HOST_RESERVED_MEMORY, memory // 10)) // 1024 ** 2
+
+
+@pytest.mark.parametrize('cores,memory,disk', [(2, 4 * GB, 'hdd'), (4, 8 * GB, 'ssd'), (16, 64 * GB, 'hdd'), (64, 512 * GB, 'ssd')])
+def test_limits_fit_the_budget(cores, memory, disk):
+    profile = fednode.compute_tune_profile(FULL + REPLICAS + ['unknown'], cores, memory, disk)
+    limits = profile['services']
+    assert sorted(limits) == sorted(FULL + REPLICAS)
+    assert sum(l['mem_limit'] for l in limits.values()) <= memory_budget(memory)
+    for service, values in profile['bitcoin'].items():
+        # the UTXO cache and the mempool leave bitcoind room for the rest of itself, within its limit
+        assert values['dbcache'] + values['maxmempool'] + fednode.TUNE_BITCOIN_OVERHEAD <= limits[service]['mem_limit']
+        assert 1 <= values['par'] <= max(cores - 1, 1)
+    # replicas get as much as their primary
+    assert limits['counterparty-replica1'] == limits['counterparty-replica2'] == limits['counterparty']
+
+
+def test_small_host():
+    # not even the floor fits, so everything gets less, but still no more than the budget in all
+    memory = 3 * GB
+    profile = fednode.compute_tune_profile(FULL + REPLICAS, 2, memory, 'ssd')
+    limits = [l['mem_limit'] for l in profile['services'].values()]
+    assert min(limits) < fednode.TUNE_MIN_MEMORY
+    assert sum(limits) <= memory_budget(memory)
+    assert profile['bitcoin']['bitcoin']['dbcache'] >= 4
+
+
+def test_hdd_gets_a_bigger_dbcache():
+    ssd = fednode.compute_tune_profile(FULL, 8, 16 * GB, 'ssd')
+    hdd = fednode.compute_tune_profile(FULL, 8, 16 * GB, 'hdd')
+    assert hdd['services'] == ssd['services']
+    assert hdd['bitcoin']['bitcoin']['dbcache'] > ssd['bitcoin']['bitcoin']['dbcache']
+
+
+def test_render_tune_compose():
+    profile = fednode.compute_tune_profile(['bitcoin', 'addrindexrs', 'redis'], 4, 8 * GB, 'ssd')
+    rendered = fednode.render_tune_compose(profile)
+    model = fednode.parse_simple_yaml(rendered)
+    assert model['version'] == '2'
+    assert model['services']['bitcoin'] == {'mem_limit': '{}m'.format(profile['services']['bitcoin']['mem_limit']),
+        'cpu_shares': str(profile['services']['bitcoin']['cpu_shares'])}
+    assert model['services']['addrindexrs']['environment'] == [
+        'ADDRINDEXRS_TXID_LIMIT={}'.format(profile['addrindexrs']['addrindexrs']['ADDRINDEXRS_TXID_LIMIT'])]
+    assert model['services']['redis']['command'].endswith('--maxmemory {}'.format(profile['redis']['redis']['maxmemory']))
+
+
+@pytest.fixture
+def scriptdir(tmp_path, monkeypatch):
+    monkeypatch.setattr(fednode, 'SCRIPTDIR', str(tmp_path))
+    monkeypatch.setattr(fednode, 'get_compose_services', lambda compose_path: ['bitcoin', 'addrindexrs', 'counterparty', 'redis'])
+    os.makedirs(str(tmp_path / 'config' / 'bitcoin'))
+    (tmp_path / 'config' / 'bitcoin' / 'bitcoin.conf').write_text("rpcuser=rpc\ndbcache=450\nrpcthreads=4\ntxindex=1\n")
+    with open(str(tmp_path / fednode.REPLICAS_COMPOSE_FILE), 'w') as f:
+        f.write(fednode.render_replicas_compose({'counterparty': 1}, {}))
+    return tmp_path
+
+
+def test_tune_dry_run(scriptdir, capsys):
+    profile = fednode.tune('docker-compose.yml', 4, 8 * GB, 'ssd', dry_run=True)
+    assert 'counterparty-replica1' in profile['services']
+    bitcoin = profile['bitcoin']['bitcoin']
+    output = capsys.readouterr().out
+    conf_path = str(scriptdir / 'config' / 'bitcoin' / 'bitcoin.conf')
+    tune_path = str(scriptdir / fednode.TUNE_COMPOSE_FILE)
+    conf_diff = output[output.index(conf_path + ':'):output.index(tune_path + ':')]
+    for line in ["-dbcache=450", "+dbcache={}".format(bitcoin['dbcache']),
+            "-rpcthreads=4", "+rpcthreads={}".format(bitcoin['rpcthreads']),
+            "+maxmempool={}".format(bitcoin['maxmempool']), "+par={}".format(bitcoin['par'])]:
+        assert "\n{}\n".format(line) in conf_diff
+    # the other settings are left alone
+    assert "\n rpcuser=rpc\n" in conf_diff and "-txindex" not in conf_diff and "+txindex" not in conf_diff
+    tune_diff = output[output.index(tune_path + ':'):]
+    assert "+  counterparty-replica1:\n" in tune_diff
+    assert "+    mem_limit: {}m\n".format(profile['services']['counterparty-replica1']['mem_limit']) in tune_diff
+    # nothing written
+    assert (scriptdir / 'config' / 'bitcoin' / 'bitcoin.conf').read_text() == "rpcuser=rpc\ndbcache=450\nrpcthreads=4\ntxindex=1\n"
+    assert not os.path.exists(tune_path)
+
+
+def test_tune_applies(scriptdir, capsys):
+    profile = fednode.tune('docker-compose.yml', 4, 8 * GB, 'ssd')
+    conf = (scriptdir / 'config' / 'bitcoin' / 'bitcoin.conf').read_text()
+    assert conf.startswith("rpcuser=rpc\ndbcache={}\n".format(profile['bitcoin']['bitcoin']['dbcache']))
+    assert (scriptdir / fednode.TUNE_COMPOSE_FILE).read_text() == fednode.render_tune_compose(profile)
+    capsys.readouterr()
+    # and a rerun has nothing left to change
+    fednode.tune('docker-compose.yml', 4, 8 * GB, 'ssd')
+    output = capsys.readouterr().out
+    assert output.count(": unchanged") == 2
@@ -0,0 +1,97 @@
+import sqlite3
+
+import pytest
+
+import fednode
+
+
+def report_rows(output):
+    # TABLE/INDEX rows of the report, as name -> (pages, unused %, fragmentation %)
+    lines = output.split("TABLE/INDEX", 1)[1].split("\n\n")[0].splitlines()[1:]
+    rows = {}
+    for line in lines:
+        name, pages, size, unused, fragmentation = line.split()
+        rows[name] = (int(pages), float(unused.rstrip('%')), float(fragmentation.rstrip('%')))
+    return rows
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    db_path = str(tmp_path / 'counterparty.db')
+    db = sqlite3.connect(db_path)
+    db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    db.execute("CREATE TABLE contiguous (id INTEGER PRIMARY KEY, data TEXT)")
+    db.execute("CREATE TABLE interleaved_a (id INTEGER PRIMARY KEY, data TEXT)")
+    db.execute("CREATE TABLE interleaved_b (id INTEGER PRIMARY KEY, data TEXT)")
+    # written in one go, so its pages follow each other on disk
+    db.executemany("INSERT INTO contiguous VALUES (?, ?)", [(i, 'x' * 1000) for i in range(400)])
+    db.commit()
+    # written a page's worth at a time each, in turn, so their pages alternate
+    for i in range(100):
+        db.executemany("INSERT INTO interleaved_a VALUES (?, ?)", [(i * 4 + j, 'a' * 900) for j in range(4)])
+        db.commit()
+        db.executemany("INSERT INTO interleaved_b VALUES (?, ?)", [(i * 4 + j, 'b' * 900) for j in range(4)])
+        db.commit()
+    db.execute("DELETE FROM contiguous WHERE id >= 200")
+    db.commit()
+    db.close()
+    return db_path
+
+
+def test_fragmentation_report(db_path, capsys):
+    db = sqlite3.connect(db_path)
+    page_size, freelist_count = db.execute("PRAGMA page_size").fetchone()[0], db.execute("PRAGMA freelist_count").fetchone()[0]
+    db.close()
+    assert freelist_count > 0
+
+    assert fednode.vacuum_analyze(db_path)
+    output = capsys.readouterr().out
+    assert "auto_vacuum incremental" in output
+    assert "Free pages: {} ".format(freelist_count) in output
+    assert "Estimated savings: {:.1f} MB from free pages".format(freelist_count * page_size / 1024.0 ** 2) in output
+    assert "NOTE: --incremental" not in output
+
+    rows = report_rows(output)
+    assert set(rows) >= {'contiguous', 'interleaved_a', 'interleaved_b', 'sqlite_schema'}
+    assert rows['contiguous'][2] < 5.0
+    assert rows['interleaved_a'][2] > 50.0 and rows['interleaved_b'][2] > 50.0
+    # biggest first
+    pages = [r[0] for r in rows.values()]
+    assert pages == sorted(pages, reverse=True)
+
+
+def test_incremental_vacuum(db_path, capsys, monkeypatch):
+    monkeypatch.setattr(fednode, 'VACUUM_INCREMENTAL_PAUSE', 0)
+    monkeypatch.setattr(fednode, 'VACUUM_INCREMENTAL_STEP', 16)
+    db = sqlite3.connect(db_path)
+    page_count, freelist_count = db.execute("PRAGMA page_count").fetchone()[0], db.execute("PRAGMA freelist_count").fetchone()[0]
+    db.close()
+
+    assert fednode.vacuum_incremental(db_path, budget=20)
+    db = sqlite3.connect(db_path)
+    assert db.execute("PRAGMA page_count").fetchone()[0] == page_count - 20
+    db.close()
+    assert "Reclaimed 20 pages (0.1 MB) in" in capsys.readouterr().out
+    # (the ANALYZE at the end takes a free page for its statistics table)
+    assert fednode.vacuum_incremental(db_path)
+    db = sqlite3.connect(db_path)
+    assert db.execute("PRAGMA freelist_count").fetchone()[0] == 0
+    assert db.execute("PRAGMA page_count").fetchone()[0] == page_count - freelist_count + 1
+    assert db.execute("SELECT COUNT(*) FROM contiguous").fetchone()[0] == 200
+    assert db.execute("PRAGMA integrity_check").fetchone()[0] == 'ok'
+    db.close()
+    assert ", 0 free pages left" in capsys.readouterr().out
+
+
+def test_incremental_needs_the_mode(tmp_path, capsys):
+    db_path = str(tmp_path / 'plain.db')
+    db = sqlite3.connect(db_path)
+    db.execute("CREATE TABLE t (x)")
+    db.close()
+    assert not fednode.vacuum_incremental(db_path)
+    assert fednode.vacuum_analyze(db_path)
+    assert "NOTE: --incremental needs" in capsys.readouterr().out
+    assert fednode.vacuum_enable_incremental(db_path)
+    db = sqlite3.connect(db_path)
+    assert db.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    db.close()
@@ -0,0 +1,119 @@
+import hashlib
+import json
+import sqlite3
+
+import pytest
+
+import fednode
+
+
+def block_hashes(block_index, salt=''):
+    return [hashlib.sha256("{}{}{}".format(kind, block_index, salt).encode()).hexdigest() for kind in ('ledger', 'txlist', 'messages')]
+
+
+def add_blocks(db_path, first, last):
+    db = sqlite3.connect(db_path)
+    for block_index in range(first, last + 1):
+        block_hash = "{:064x}".format(block_index)
+        db.execute("INSERT INTO blocks VALUES (?, ?, ?, ?, ?, ?)",
+            [block_index, block_hash] + block_hashes(block_index) + ["{:064x}".format(block_index - 1)])
+        db.execute("INSERT INTO transactions VALUES (?, ?, ?)", (block_index, block_index, block_hash))
+        db.execute("INSERT INTO messages VALUES (?, ?)", (block_index, block_index))
+        db.execute("INSERT INTO credits VALUES (?, ?)", (block_index, 'XCP'))
+    db.commit()
+    db.close()
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(fednode, 'VALIDATE_CHECKPOINT_INTERVAL', 10)
+    monkeypatch.setattr(fednode, 'VALIDATE_RANGE_BLOCKS', 7)
+    db_path = str(tmp_path / 'counterparty.db')
+    db = sqlite3.connect(db_path)
+    db.execute("""CREATE TABLE blocks (block_index INTEGER PRIMARY KEY, block_hash TEXT, ledger_hash TEXT, txlist_hash TEXT,
+        messages_hash TEXT, previous_block_hash TEXT)""")
+    db.execute("CREATE TABLE transactions (tx_index INTEGER PRIMARY KEY, block_index INTEGER, block_hash TEXT)")
+    db.execute("CREATE TABLE messages (message_index INTEGER PRIMARY KEY, block_index INTEGER)")
+    db.execute("CREATE TABLE credits (block_index INTEGER, asset TEXT)")
+    db.execute("CREATE INDEX credits_block_index ON credits (block_index)")
+    db.close()
+    add_blocks(db_path, 100, 150)
+    return db_path
+
+
+def load_state(state_path):
+    with open(state_path) as f:
+        return json.load(f)['counterparty']
+
+
+def test_incremental_validate(db_path, tmp_path, capsys):
+    state_path = str(tmp_path / 'validate.json')
+    assert fednode.validate_incremental(db_path, 'counterparty', state_path, jobs=2)
+    state = load_state(state_path)
+    # everything but the last VALIDATE_CONFIRMATIONS blocks, with a checkpoint every 10 blocks and at the high-water mark
+    assert state['high_water'] == 140
+    assert sorted(state['checkpoints'], key=int) == ['100', '110', '120', '130', '140']
+    assert state['checkpoints']['120'] == block_hashes(120)
+    assert "OK: blocks 100 to 140 validated" in capsys.readouterr().out
+
+    assert fednode.validate_incremental(db_path, 'counterparty', state_path, jobs=2)
+    assert "Nothing to validate: blocks up to 140 already are (tip at 150)" in capsys.readouterr().out
+
+    # only the new blocks get checked; the checkpoint at the old high-water mark goes unless it's on the interval
+    add_blocks(db_path, 151, 175)
+    assert fednode.validate_incremental(db_path, 'counterparty', state_path, jobs=2)
+    state = load_state(state_path)
+    assert state['high_water'] == 165
+    assert sorted(state['checkpoints'], key=int) == ['100', '110', '120', '130', '140', '150', '160', '165']
+    assert "OK: blocks 141 to 165 validated" in capsys.readouterr().out
+
+
+def test_changed_checkpoint(db_path, tmp_path, capsys):
+    state_path = str(tmp_path / 'validate.json')
+    assert fednode.validate_incremental(db_path, 'counterparty', state_path, jobs=1)
+    before = load_state(state_path)
+    db = sqlite3.connect(db_path)
+    db.execute("UPDATE blocks SET ledger_hash = ? WHERE block_index = 120", (block_hashes(120, 'reparsed')[0],))
+    db.commit()
+    db.close()
+
+    assert not fednode.validate_incremental(db_path, 'counterparty', state_path, jobs=1)
+    assert "1 recorded checkpoint(s) changed since they were validated (first at block 120)" in capsys.readouterr().out
+    assert load_state(state_path) == before
+
+    # --reset starts over from the first block
+    assert fednode.validate_incremental(db_path, 'counterparty', state_path, jobs=1, reset=True)
+    assert "OK: blocks 100 to 140 validated" in capsys.readouterr().out
+    assert load_state(state_path)['checkpoints']['120'][0] == block_hashes(120, 'reparsed')[0]
+
+
+def test_problems_keep_the_high_water_mark(db_path, tmp_path, capsys):
+    state_path = str(tmp_path / 'validate.json')
+    assert fednode.validate_incremental(db_path, 'counterparty', state_path, jobs=2)
+    add_blocks(db_path, 151, 175)
+    db = sqlite3.connect(db_path)
+    db.execute("UPDATE blocks SET txlist_hash = 'garbage' WHERE block_index = 152")
+    db.execute("UPDATE blocks SET ledger_hash = (SELECT ledger_hash FROM blocks WHERE block_index = 154) WHERE block_index = 155")
+    db.execute("DELETE FROM messages WHERE block_index = 158")
+    db.execute("UPDATE transactions SET block_hash = 'other' WHERE block_index = 160")
+    db.commit()
+    db.close()
+
+    assert not fednode.validate_incremental(db_path, 'counterparty', state_path, jobs=2)
+    output = capsys.readouterr().out
+    for problem in ["block 152: malformed txlist_hash", "block 155: same ledger_hash as the block before",
+            "1 messages missing in blocks", "1 transactions in blocks"]:
+        assert problem in output
+    assert "the high-water mark stays at 140" in output
+    assert load_state(state_path)['high_water'] == 140
+
+
+def test_block_range_gaps(db_path):
+    db = sqlite3.connect(db_path)
+    db.execute("DELETE FROM blocks WHERE block_index IN (120, 121)")
+    db.commit()
+    db.close()
+    errors, checkpoints = fednode.validate_block_range(db_path, 115, 125)
+    assert "blocks 120 to 121 are missing" in errors
+    assert "2 rows of credits in blocks 115-125 reference missing blocks" in errors
+    assert sorted(checkpoints) == [125]